@@ -0,0 +1,403 @@
+"""Throughput and peak-memory benchmarks for every pipeline stage.
+
+Fixtures are synthetic paintings built from the schema of
+`met_paintings_complete_raw.json`: each record is a real raw object with its
+descriptive fields (title, artist, date, medium, dimensions, ...) drawn
+independently from other real objects and a fresh objectID, so every size
+(1k/10k/100k by default) has realistic field lengths and Unicode without
+repeating records. Fixtures are generated once per size and seed under
+`processed-data/benchmarks/fixtures/`.
+
+Stages:
+- harvest: `get_met_paintings_raw` (async) against a local stub of the Met API
+- format: `format_paintings`
+- clean: `restore_from_backup_and_clean`
+- templates: `create_bulk_training_data`
+- tokenize: `token_cache.build_token_cache`
+- collate: `collation.PackedDataset` + `Collator` over every packed batch
+- generate: `onnx_generation.generate_guides` with a tiny random Mistral
+
+Every stage runs in a fresh spawned process, so its peak RSS is its own.
+Results are appended to `processed-data/benchmarks/history.jsonl`;
+`python benchmarks.py compare` flags throughput drops and memory growth
+between two runs.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+from instrumentation import peak_rss_kb, reset_peak_rss
+from storage import iter_records, write_records
+
+BENCH_DIR = 'processed-data/benchmarks'
+# Resolved against this file so checks that build synthetic data run from any directory
+SOURCE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'raw-data', 'met_paintings_complete_raw.json')
+HISTORY_FILE = os.path.join(BENCH_DIR, 'history.jsonl')
+FIXTURE_VERSION = 1
+SIZES = [1000, 10000, 100000]
+STAGES = ['harvest', 'format', 'clean', 'templates', 'tokenize', 'collate', 'generate']
+# Fields drawn independently per synthetic record
+VARIED_FIELDS = ['title', 'artistDisplayName', 'artistDisplayBio', 'objectDate', 'medium', 'dimensions',
+                 'culture', 'period', 'department', 'creditLine', 'classification']
+
+
+def synthetic_raw_paintings(count: int, source_file: str = SOURCE_FILE, seed: int = 0):
+    """`count` raw Met objects with the real schema, mixing fields of random real objects"""
+    records = list(iter_records(source_file))
+    rng = random.Random(seed)
+    for i in range(count):
+        raw = dict(rng.choice(records))
+        for field in VARIED_FIELDS:
+            raw[field] = rng.choice(records).get(field, '')
+        raw['objectID'] = 10_000_000 + i
+        raw['objectURL'] = f"https://www.metmuseum.org/art/collection/search/{raw['objectID']}"
+        yield raw
+
+
+def prepare_fixtures(size: int, seed: int = 0, bench_dir: str = BENCH_DIR) -> Dict[str, str]:
+    """Raw, formatted and training-example fixtures for `size` paintings, built on first use"""
+    fixture_dir = os.path.join(bench_dir, 'fixtures', f"v{FIXTURE_VERSION}-seed{seed}-{size}")
+    files = {name: os.path.join(fixture_dir, f"{name}.jsonl") for name in ('raw', 'formatted', 'training')}
+    if os.path.exists(os.path.join(fixture_dir, 'done')):
+        return files
+
+    from clean_unicode import restore_from_backup_and_clean
+    from generate_audio_scripts import create_bulk_training_data
+
+    print(f"Building {size}-painting fixtures in {fixture_dir}")
+    shutil.rmtree(fixture_dir, ignore_errors=True)
+    os.makedirs(fixture_dir)
+    write_records(files['raw'], synthetic_raw_paintings(size, seed=seed))
+    restore_from_backup_and_clean(files['raw'], files['formatted'])
+    create_bulk_training_data(files['formatted'], files['training'], seed=seed)
+    open(os.path.join(fixture_dir, 'done'), 'w').close()
+    return files
+
+
+class StubMetAPI:
+    """Local stand-in for the Met collection API serving a raw fixture (/search and /objects/<id>).
+
+    Objects are read from the JSONL fixture by byte offset on request, so a
+    100k-object stub stays small.
+    """
+
+    def __init__(self, raw_file: str, host: str = '127.0.0.1', port: int = 0):
+        self.raw_file = raw_file
+        self.offsets: Dict[int, tuple] = {}
+        with open(raw_file, 'rb') as f:
+            offset = 0
+            for line in f:
+                self.offsets[json.loads(line)['objectID']] = (offset, len(line))
+                offset += len(line)
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                if path == '/search':
+                    body = json.dumps({'total': len(stub.offsets), 'objectIDs': list(stub.offsets)}).encode()
+                elif path.startswith('/objects/') and int(path.rsplit('/', 1)[1]) in stub.offsets:
+                    offset, length = stub.offsets[int(path.rsplit('/', 1)[1])]
+                    with open(stub.raw_file, 'rb') as f:
+                        f.seek(offset)
+                        body = f.read(length)
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _stage_harvest(files: Dict[str, str], work_dir: str, options: Dict) -> int:
+    from data_collection import get_met_paintings_raw
+
+    return len(get_met_paintings_raw(options['harvest_limit'], use_async=True, api_base=options['api_base'],
+                                     raw_file=os.path.join(work_dir, 'raw.jsonl'),
+                                     checkpoint_dir=os.path.join(work_dir, 'harvest'), cache_file=None,
+                                     rate_limit=1e6, concurrency=16))
+
+
+def _stage_format(files: Dict[str, str], work_dir: str, options: Dict) -> int:
+    from data_collection import FORMAT_FIELDS, format_paintings
+
+    return format_paintings(iter_records(files['raw'], columns=FORMAT_FIELDS),
+                            os.path.join(work_dir, 'formatted.jsonl'))
+
+
+def _stage_clean(files: Dict[str, str], work_dir: str, options: Dict) -> int:
+    from clean_unicode import restore_from_backup_and_clean
+
+    return restore_from_backup_and_clean(files['raw'], os.path.join(work_dir, 'formatted.jsonl'))
+
+
+def _stage_templates(files: Dict[str, str], work_dir: str, options: Dict) -> int:
+    from generate_audio_scripts import create_bulk_training_data
+
+    return create_bulk_training_data(files['formatted'], os.path.join(work_dir, 'training.jsonl'))
+
+
+def _stage_tokenize(files: Dict[str, str], work_dir: str, options: Dict) -> int:
+    from token_cache import TokenizedDataset, build_token_cache
+
+    return len(TokenizedDataset(build_token_cache(files['training'], cache_dir=os.path.join(work_dir, 'tokens'))))
+
+
+def _stage_collate(files: Dict[str, str], work_dir: str, options: Dict) -> int:
+    from collation import Collator, PackedDataset
+    from token_cache import TokenizedDataset
+
+    # The cache is built before timing starts (see _run_stage)
+    dataset = TokenizedDataset(options['token_cache'])
+    packed = PackedDataset(dataset, 512)
+    collator = Collator(pad_token_id=dataset.pad_token_id)
+    for start in range(0, len(packed), 8):
+        collator([packed[i] for i in range(start, min(start + 8, len(packed)))])
+    return len(dataset)
+
+
+def _stage_generate(files: Dict[str, str], work_dir: str, options: Dict) -> int:
+    from onnx_generation import OnnxGenerator, generate_guides
+    from token_cache import load_tokenizer
+
+    generator = OnnxGenerator(options['tiny_model_dir'])
+    tokenizer = load_tokenizer()
+    paintings = [painting for _, painting in zip(range(options['generate_count']), iter_records(files['formatted']))]
+    tokens = 0
+    for start in range(0, len(paintings), 8):
+        batch = [tokenizer.encode(f"Title: {p['title']}\n\nAudio guide:").ids for p in paintings[start:start + 8]]
+        tokens += sum(len(output) for output in
+                      generator.generate(batch, max_new_tokens=32, eos_token_id=-1, pad_token_id=0))
+    generate_guides(generator, tokenizer, paintings[:1], max_new_tokens=8)
+    return tokens
+
+
+# Imported before timing starts, so the numbers cover the work rather than module start-up
+STAGE_MODULES = {'harvest': ['data_collection', 'aiohttp'], 'format': ['data_collection'], 'clean': ['clean_unicode'],
+                 'templates': ['generate_audio_scripts'], 'tokenize': ['token_cache', 'tokenizers'],
+                 'collate': ['collation', 'token_cache'], 'generate': ['onnx_generation', 'onnxruntime', 'token_cache']}
+STAGE_UNITS = {'harvest': 'objects', 'format': 'paintings', 'clean': 'paintings', 'templates': 'examples',
+               'tokenize': 'examples', 'collate': 'examples', 'generate': 'tokens'}
+
+
+def _run_stage(stage: str, files: Dict[str, str], options: Dict) -> Dict:
+    """Child process: run one stage and report wall time, items and peak RSS"""
+    import contextlib
+    import io
+
+    import importlib
+
+    for module in STAGE_MODULES[stage]:
+        importlib.import_module(module)
+    # Stage progress output would swamp the report
+    with tempfile.TemporaryDirectory() as work_dir, contextlib.redirect_stdout(io.StringIO()):
+        if stage == 'collate':
+            from collation import Collator, PackedDataset
+            from token_cache import TokenizedDataset, build_token_cache
+
+            options = {**options, 'token_cache': build_token_cache(files['training'],
+                                                                    cache_dir=os.path.join(work_dir, 'tokens'))}
+            # torch initialises lazily (about 0.5 GB and a second on the first batch); pay that before timing
+            dataset = TokenizedDataset(options['token_cache'])
+            Collator(pad_token_id=dataset.pad_token_id)([PackedDataset(dataset, 512)[0]])
+        reset_peak_rss()
+        baseline = peak_rss_kb()
+        start = time.perf_counter()
+        items = globals()[f"_stage_{stage}"](files, work_dir, options)
+        seconds = time.perf_counter() - start
+        peak = peak_rss_kb()
+    return {
+        'items': items,
+        'unit': STAGE_UNITS[stage],
+        'seconds': round(seconds, 4),
+        'items_per_sec': round(items / seconds, 2) if seconds else None,
+        'peak_rss_mb': round(peak / 1024, 1),
+        'peak_rss_growth_mb': round((peak - baseline) / 1024, 1),
+    }
+
+
+def _tiny_model(bench_dir: str = BENCH_DIR) -> str:
+    """Tiny random Mistral exported with the KV cache, built once"""
+    model_dir = os.path.join(bench_dir, 'tiny-model')
+    if not os.path.exists(os.path.join(model_dir, 'model.onnx')):
+        import torch
+
+        from export_model import export_with_past, tiny_mistral
+
+        os.makedirs(model_dir, exist_ok=True)
+        export_with_past(tiny_mistral(), os.path.join(model_dir, 'model.onnx'), torch.tensor([[1, 2, 3]]))
+    return model_dir
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(sizes: List[int] = SIZES, stages: List[str] = STAGES, seed: int = 0,
+                   repeats: int = 1, harvest_limit: int = 2000, generate_count: int = 32,
+                   label: Optional[str] = None, history_file: str = HISTORY_FILE) -> Dict:
+    """Run every stage at every fixture size (best of `repeats` fresh processes) and append to the history.
+
+    Harvesting fetches at most `harvest_limit` objects per size over HTTP;
+    generation decodes `generate_count` guides with the tiny model once per
+    run, independent of size.
+    """
+    run = {'run_id': time.strftime('%Y%m%dT%H%M%S'), 'label': label, 'commit': git_commit(),
+           'python': platform.python_version(), 'machine': platform.machine(), 'cpus': os.cpu_count(),
+           'results': {}}
+    options = {'harvest_limit': harvest_limit, 'generate_count': generate_count}
+    if 'generate' in stages:
+        options['tiny_model_dir'] = _tiny_model()
+
+    context = multiprocessing.get_context('spawn')
+    for size in sizes:
+        files = prepare_fixtures(size, seed)
+        with StubMetAPI(files['raw']) as stub:
+            for stage in stages:
+                if stage == 'generate' and size != sizes[0]:
+                    continue
+                key = 'generate@tiny' if stage == 'generate' else f"{stage}@{size}"
+                best = None
+                for _ in range(repeats):
+                    with ProcessPoolExecutor(1, mp_context=context) as pool:
+                        result = pool.submit(_run_stage, stage, files, {**options, 'api_base': stub.url}).result()
+                    if best is None or result['seconds'] < best['seconds']:
+                        best = result
+                run['results'][key] = best
+                print(f"{key:<18} {best['items']:>8} {best['unit']:<10} {best['seconds']:>9.3f}s "
+                      f"{best['items_per_sec']:>12.1f}/s  peak {best['peak_rss_mb']:>7.1f} MB "
+                      f"(+{best['peak_rss_growth_mb']} MB)")
+
+    os.makedirs(os.path.dirname(history_file) or '.', exist_ok=True)
+    with open(history_file, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(run) + '\n')
+    print(f"Run {run['run_id']} appended to {history_file}")
+    return run
+
+
+def load_history(history_file: str = HISTORY_FILE) -> List[Dict]:
+    with open(history_file, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _change(new: Optional[float], old: Optional[float]) -> Optional[float]:
+    """Relative change, or None when either side is missing or the baseline is zero"""
+    if new is None or not old:
+        return None
+    return new / old - 1
+
+
+def _format_change(old: Optional[float], new: Optional[float], change: Optional[float], unit: str) -> str:
+    def value(number):
+        return f"{number:>12.1f}{unit}" if number is not None else f"{'n/a':>12}{' ' * len(unit)}"
+    return f"{value(old)} -> {value(new)} ({f'{change:+.1%}' if change is not None else 'n/a'})"
+
+
+def compare_runs(baseline: Optional[str] = None, candidate: Optional[str] = None,
+                 history_file: str = HISTORY_FILE, throughput_tolerance: float = 0.10,
+                 memory_tolerance: float = 0.20) -> List[Dict]:
+    """Compare two runs (run_id or label; default the last two) and return the regressions.
+
+    A benchmark regresses when its throughput falls by more than
+    `throughput_tolerance` or its peak RSS grows by more than `memory_tolerance`.
+    Changes against a missing or zero baseline (a stage too fast to time, or
+    one that produced no items) are reported as n/a and never flagged.
+    """
+    runs = load_history(history_file)
+
+    def find(name, default_index):
+        if name is None:
+            return runs[default_index]
+        matches = [run for run in runs if name in (run['run_id'], run.get('label'))]
+        if not matches:
+            raise ValueError(f"No run {name!r} in {history_file}")
+        return matches[-1]
+
+    if len(runs) < 2 and (baseline is None or candidate is None):
+        raise ValueError(f"Need two runs in {history_file} to compare")
+    base, new = find(baseline, -2), find(candidate, -1)
+    print(f"Comparing {base['run_id']} ({base.get('commit')}) -> {new['run_id']} ({new.get('commit')})")
+
+    regressions = []
+    for key in sorted(set(base['results']) & set(new['results'])):
+        old_result, new_result = base['results'][key], new['results'][key]
+        throughput = _change(new_result['items_per_sec'], old_result['items_per_sec'])
+        memory = _change(new_result['peak_rss_mb'], old_result['peak_rss_mb'])
+        flags = []
+        if throughput is not None and throughput < -throughput_tolerance:
+            flags.append('SLOWER')
+        if memory is not None and memory > memory_tolerance:
+            flags.append('MORE MEMORY')
+        if flags:
+            regressions.append({'benchmark': key, 'throughput_change': throughput, 'memory_change': memory,
+                                'flags': flags})
+        print(f"{key:<18} "
+              f"{_format_change(old_result['items_per_sec'], new_result['items_per_sec'], throughput, '/s')}  "
+              f"{_format_change(old_result['peak_rss_mb'], new_result['peak_rss_mb'], memory, ' MB')}  "
+              f"{' '.join(flags)}")
+    print(f"{len(regressions)} regression(s)")
+    return regressions
+
+
+if __name__ == "__main__":
+    import sys
+
+    parser = argparse.ArgumentParser(description="Pipeline benchmarks with synthetic fixtures")
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help="run benchmarks and append to the history")
+    run_parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    run_parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    run_parser.add_argument('--repeats', type=int, default=1)
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--label', default=None)
+    compare_parser = commands.add_parser('compare', help="flag regressions between two runs")
+    compare_parser.add_argument('baseline', nargs='?', default=None, help="run_id or label (default: previous run)")
+    compare_parser.add_argument('candidate', nargs='?', default=None, help="run_id or label (default: latest run)")
+    compare_parser.add_argument('--throughput-tolerance', type=float, default=0.10)
+    compare_parser.add_argument('--memory-tolerance', type=float, default=0.20)
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        run_benchmarks(args.sizes, args.stages, args.seed, args.repeats, label=args.label)
+    else:
+        regressions = compare_runs(args.baseline, args.candidate, throughput_tolerance=args.throughput_tolerance,
+                                   memory_tolerance=args.memory_tolerance)
+        sys.exit(1 if regressions else 0)
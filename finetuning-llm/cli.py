@@ -0,0 +1,216 @@
+"""Single entry point for the finetuning-llm tools: `python cli.py <command> [options]`.
+
+Commands, in pipeline order:
+- harvest: fetch raw objects from the Met API (resumable, optionally async)
+- format: raw objects -> formatted paintings, as data_collection.py does
+- clean: raw objects -> formatted paintings with smart text cleaning
+- images: download painting images and store fixed-size thumbnails
+- generate: seed scripts, template variations and near-duplicate removal
+- split: the notebook's train/val split of the training examples
+- merge: merge the LoRA adapters into the base model
+- export: export a merged model to ONNX
+- quantize: quantize an ONNX model (dynamic INT8, static INT8 or int4)
+
+Each command imports its modules inside its handler, so `--help` and the
+data commands never load torch, transformers, peft or onnxruntime.
+tests/test_cli.py runs the commands under `-X importtime` (`import_profile`)
+and fails if one of them loads a heavy dependency or startup exceeds its
+time budget.
+"""
+
+import argparse
+import os
+import sys
+
+HEAVY_MODULES = ('torch', 'transformers', 'peft', 'onnxruntime', 'onnx')
+
+
+def cmd_harvest(args):
+    from data_collection import get_met_paintings_raw
+
+    raw_paintings = get_met_paintings_raw(args.limit, use_async=args.use_async, raw_file=args.raw_file,
+                                          checkpoint_dir=args.checkpoint_dir, refresh=args.refresh,
+                                          cache_file=args.cache_file or None, concurrency=args.concurrency,
+                                          rate_limit=args.rate_limit)
+    print(f"Got {len(raw_paintings)} raw paintings")
+
+
+def cmd_format(args):
+    from data_collection import FORMAT_FIELDS, format_paintings
+    from storage import iter_records
+
+    format_paintings(iter_records(args.raw_file, columns=FORMAT_FIELDS), args.formatted_file, args.index_dir or None)
+
+
+def cmd_clean(args):
+    from clean_unicode import restore_from_backup_and_clean
+
+    restore_from_backup_and_clean(args.raw_file, args.formatted_file, processes=args.processes,
+                                  index_dir=args.index_dir or None)
+
+
+def cmd_images(args):
+    from image_store import painting_images, prefetch_images
+    from storage import iter_records
+
+    raw_paintings = iter_records(args.raw_file, columns=['objectID', 'primaryImage', 'primaryImageSmall'])
+    prefetch_images(painting_images(raw_paintings), args.store_dir, concurrency=args.concurrency,
+                    rate_limit=args.rate_limit, processes=args.processes, refresh=args.refresh)
+
+
+def cmd_generate(args):
+    from generate_audio_scripts import create_bulk_training_data, save_seed_scripts
+
+    save_seed_scripts(args.seed_file)
+    create_bulk_training_data(args.formatted_file, args.output_file, seed=args.seed, variants=args.variants,
+                              workers=args.workers)
+    if args.dedup_file:
+        from dedup import deduplicate_training_file
+
+        deduplicate_training_file(args.output_file, args.dedup_file, threshold=args.threshold)
+
+
+def cmd_split(args):
+    from pipeline import split_training_file
+
+    counts = split_training_file(args.input_file, args.train_file, args.val_file, args.test_size, args.random_state)
+    print(f"Split {counts['train']} train / {counts['val']} val examples")
+
+
+def cmd_merge(args):
+    from export_model import merge_lora
+
+    merge_lora(args.base_model, args.adapter_dir, args.merged_dir, streaming=not args.in_memory)
+
+
+def cmd_export(args):
+    import torch
+
+    from export_model import export_to_onnx
+
+    export_to_onnx(args.merged_dir, args.onnx_dir, opset=args.opset, with_past=not args.no_past,
+                   dtype=torch.float32 if args.float32 else torch.float16)
+
+
+def cmd_quantize(args):
+    from export_model import quantize_onnx
+
+    quantize_onnx(args.onnx_dir, args.quant_dir, mode=args.mode)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Paintings audio-guide data and model tools")
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+
+    harvest = commands.add_parser('harvest', help="fetch raw objects from the Met collection API")
+    harvest.add_argument('--limit', type=int, default=1500)
+    harvest.add_argument('--refresh', action='store_true',
+                         help="re-run the search and re-fetch objects whose metadataDate changed")
+    harvest.add_argument('--async', dest='use_async', action='store_true',
+                         help="fetch concurrently over a pooled session")
+    harvest.add_argument('--raw-file', default='raw-data/met_paintings_complete_raw.json')
+    harvest.add_argument('--checkpoint-dir', default='raw-data/harvest')
+    harvest.add_argument('--cache-file', default='raw-data/http-cache.sqlite',
+                         help="HTTP response cache ('' disables it)")
+    harvest.add_argument('--concurrency', type=int, default=16)
+    harvest.add_argument('--rate-limit', type=float, default=80, help="requests per second")
+    harvest.set_defaults(handler=cmd_harvest)
+
+    for name, handler, help_text in (('format', cmd_format, "format raw objects into paintings"),
+                                     ('clean', cmd_clean, "format raw objects with smart text cleaning")):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument('--raw-file', default='raw-data/met_paintings_complete_raw.json',
+                             help=".json, .jsonl or .parquet")
+        command.add_argument('--formatted-file', default='raw-data/met_paintings_formatted.json',
+                             help=".json, .jsonl or .parquet")
+        command.add_argument('--index-dir', default='processed-data/search-index',
+                             help="search index built in the same pass ('' skips it)")
+        if name == 'clean':
+            command.add_argument('--processes', type=int, default=None, help="clean batches in a process pool")
+        command.set_defaults(handler=handler)
+
+    images = commands.add_parser('images', help="prefetch painting images into the thumbnail store")
+    images.add_argument('--raw-file', default='raw-data/met_paintings_complete_raw.json')
+    images.add_argument('--store-dir', default='processed-data/images')
+    images.add_argument('--refresh', action='store_true', help="revalidate stored images with conditional requests")
+    images.add_argument('--concurrency', type=int, default=16)
+    images.add_argument('--rate-limit', type=float, default=80, help="requests per second")
+    images.add_argument('--processes', type=int, default=None, help="resize processes (default: CPU count)")
+    images.set_defaults(handler=cmd_images)
+
+    generate = commands.add_parser('generate', help="generate and deduplicate template training examples")
+    generate.add_argument('--formatted-file', default='raw-data/met_paintings_formatted.json')
+    generate.add_argument('--output-file', default='raw-data/training_examples_bulk.json')
+    generate.add_argument('--seed-file', default='raw-data/seed_scripts.json')
+    generate.add_argument('--dedup-file', default='raw-data/training_examples_dedup.json',
+                          help="near-duplicate-free copy of the output ('' skips dedup)")
+    generate.add_argument('--threshold', type=float, default=0.8, help="dedup Jaccard threshold")
+    generate.add_argument('--seed', type=int, default=0)
+    generate.add_argument('--variants', type=int, default=2)
+    generate.add_argument('--workers', type=int, default=None, help="generate shards in a process pool")
+    generate.set_defaults(handler=cmd_generate)
+
+    split = commands.add_parser('split', help="train/val split as in finetune.ipynb")
+    split.add_argument('--input-file', default='raw-data/training_examples_dedup.json')
+    split.add_argument('--train-file', default='processed-data/train_data.json')
+    split.add_argument('--val-file', default='processed-data/val_data.json')
+    split.add_argument('--test-size', type=float, default=0.1)
+    split.add_argument('--random-state', type=int, default=42)
+    split.set_defaults(handler=cmd_split)
+
+    merge = commands.add_parser('merge', help="merge LoRA adapters into the base model")
+    merge.add_argument('--base-model', default='mistralai/Mistral-7B-Instruct-v0.3')
+    merge.add_argument('--adapter-dir', default='./trained-models/paintings-audio-guide-final')
+    merge.add_argument('--merged-dir', default='./fp16-merged-model')
+    merge.add_argument('--in-memory', action='store_true',
+                       help="merge with peft merge_and_unload instead of streaming the shards")
+    merge.set_defaults(handler=cmd_merge)
+
+    export = commands.add_parser('export', help="export a merged model to ONNX")
+    export.add_argument('--merged-dir', default='./fp16-merged-model')
+    export.add_argument('--onnx-dir', default='./onnx-model')
+    export.add_argument('--opset', type=int, default=14)
+    export.add_argument('--no-past', action='store_true', help="export without the KV cache")
+    export.add_argument('--float32', action='store_true', help="float32 export (needed for static INT8)")
+    export.set_defaults(handler=cmd_export)
+
+    quantize = commands.add_parser('quantize', help="quantize an ONNX model")
+    quantize.add_argument('--onnx-dir', default='./onnx-model')
+    quantize.add_argument('--quant-dir', default='./onnx-int8')
+    quantize.add_argument('--mode', choices=('dynamic', 'static', 'int4'), default='dynamic')
+    quantize.set_defaults(handler=cmd_quantize)
+    return parser
+
+
+def import_profile(args, cwd: str = None):
+    """Run `python args` under -X importtime; returns (total import seconds, cumulative us per module)"""
+    import subprocess
+
+    result = subprocess.run([sys.executable, '-X', 'importtime', *args], cwd=cwd, capture_output=True, text=True,
+                            env={**os.environ, 'PYTHONPATH': os.path.dirname(os.path.abspath(__file__))})
+    if result.returncode != 0:
+        raise RuntimeError(f"python {' '.join(args)} failed:\n{result.stdout}\n{result.stderr}")
+    modules, total = {}, 0
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package (nested imports indented)
+        if not line.startswith('import time:') or line.startswith('import time: self'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = int(cumulative)
+        if not name.startswith(' ' * 2):
+            total += int(cumulative)
+    return total / 1e6, modules
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 2
+    args.handler(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
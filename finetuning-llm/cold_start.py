@@ -0,0 +1,264 @@
+"""Fast onnxruntime start-up: a pre-optimized graph cache, warm-up and cold-start measurement.
+
+Creating a session for the exported model parses the graph, runs every
+graph optimization pass and only then allocates; the first inference then
+pays for arena growth and kernel set-up on top. `open_generator`:
+
+- serializes the optimized graph once (`optimized_model_filepath`, weights in
+  page-aligned external data) into `<model_dir>/.ort-optimized/<key>/`, keyed
+  by the onnxruntime version, the CPU feature flags (`ORT_ENABLE_ALL` emits
+  hardware-specific kernels) and the model fingerprint, and loads that graph
+  with optimizations disabled on later starts;
+- optionally pre-runs representative prefill/decode shapes (`warm_up`), so
+  the first real request is not the slow one.
+
+`measure_cold_start` times fresh processes for every combination of these
+features (and of any model directories passed, e.g. inline vs external
+weights) and breaks each start into phases.
+"""
+
+import hashlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+from guide_cache import model_fingerprint
+
+DEFAULT_SHAPES = ((1, 64), (4, 64), (8, 128))
+
+
+def cpu_features() -> str:
+    """Machine type plus the sorted CPU flags (x86 `flags` / ARM `Features`) of the first core"""
+    flags = ''
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            for line in f:
+                if line.startswith(('flags', 'Features')):
+                    flags = ' '.join(sorted(line.split(':', 1)[1].split()))
+                    break
+    except OSError:
+        flags = platform.processor()
+    return f"{platform.machine()} {flags}"
+
+
+def optimized_cache_dir(model_dir: str, model_file: str = 'model.onnx') -> str:
+    import onnxruntime as ort
+
+    key = hashlib.sha256(f"{ort.__version__}\n{cpu_features()}\n{model_file}".encode()).hexdigest()[:12]
+    return os.path.join(model_dir, '.ort-optimized', f"ort{ort.__version__}-{key}-{model_fingerprint(model_dir)[:12]}")
+
+
+def _session_options(session_options=None):
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    if session_options is not None:
+        options.intra_op_num_threads = session_options.intra_op_num_threads
+        options.inter_op_num_threads = session_options.inter_op_num_threads
+        options.execution_mode = session_options.execution_mode
+    return options
+
+
+def build_optimized_graph(model_dir: str, model_file: str = 'model.onnx', session_options=None) -> str:
+    """Optimize the graph once and save it (with external weights) into its cache directory"""
+    import onnxruntime as ort
+
+    cache_dir = optimized_cache_dir(model_dir, model_file)
+    tmp_dir = f"{cache_dir}.tmp-{os.getpid()}"
+    os.makedirs(tmp_dir, exist_ok=True)
+    options = _session_options(session_options)
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    # ORT warns that ENABLE_ALL graphs are hardware-specific; the cache key already covers that
+    options.log_severity_level = 3
+    options.optimized_model_filepath = os.path.join(tmp_dir, model_file)
+    options.add_session_config_entry('session.optimized_model_external_initializers_file_name', 'model.onnx.data')
+    options.add_session_config_entry('session.optimized_model_external_initializers_min_size_in_bytes', '1024')
+    ort.InferenceSession(os.path.join(model_dir, model_file), sess_options=options,
+                         providers=['CPUExecutionProvider'])
+    try:
+        os.rename(tmp_dir, cache_dir)
+    except OSError:
+        # Another process finished the same cache first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return cache_dir
+
+
+def warm_up(generator, shapes: Sequence[Tuple[int, int]] = DEFAULT_SHAPES, decode_steps: int = 2) -> float:
+    """Run prefill plus a few cached decode steps for each (batch, prompt length); returns the seconds spent"""
+    start = time.perf_counter()
+    for batch, length in shapes:
+        input_ids = np.full((batch, length), 1000, dtype=np.int64)
+        attention_mask = np.ones_like(input_ids)
+        logits, past = generator.forward(input_ids, attention_mask)
+        for _ in range(decode_steps if generator.has_past else 0):
+            input_ids = logits[:, -1:].argmax(axis=-1).astype(np.int64)
+            attention_mask = np.ones((batch, attention_mask.shape[1] + 1), dtype=np.int64)
+            logits, past = generator.forward(input_ids, attention_mask, past)
+    return time.perf_counter() - start
+
+
+def open_generator(model_dir: str = 'onnx-model', model_file: str = 'model.onnx',
+                   optimized_cache: bool = True, warm_up_shapes: Optional[Sequence[Tuple[int, int]]] = DEFAULT_SHAPES,
+                   session_options=None):
+    """OnnxGenerator started through the optimized-graph cache and warmed up; returns (generator, phase seconds).
+
+    `session_options` threading settings are kept. Pass `warm_up_shapes=None`
+    to skip the warm-up.
+    """
+    import onnxruntime as ort
+
+    from onnx_generation import OnnxGenerator
+
+    phases = {}
+    if optimized_cache:
+        start = time.perf_counter()
+        cache_dir = optimized_cache_dir(model_dir, model_file)
+        phases['cache_key_s'] = time.perf_counter() - start
+        if not os.path.exists(os.path.join(cache_dir, model_file)):
+            start = time.perf_counter()
+            build_optimized_graph(model_dir, model_file, session_options)
+            phases['cache_build_s'] = time.perf_counter() - start
+        options = _session_options(session_options)
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+        start = time.perf_counter()
+        generator = OnnxGenerator(cache_dir, model_file, session_options=options)
+    else:
+        start = time.perf_counter()
+        generator = OnnxGenerator(model_dir, model_file, session_options=session_options)
+    phases['session_s'] = time.perf_counter() - start
+
+    if warm_up_shapes:
+        phases['warm_up_s'] = warm_up(generator, warm_up_shapes)
+    return generator, {name: round(seconds, 4) for name, seconds in phases.items()}
+
+
+def _child_run(config: Dict) -> Dict:
+    """One cold start inside a fresh interpreter: imports, session, warm-up, then a typical first request"""
+    start = time.perf_counter()
+    import onnxruntime  # noqa: F401
+
+    from onnx_generation import OnnxGenerator  # noqa: F401
+    phases = {'import_s': round(time.perf_counter() - start, 4)}
+
+    generator, open_phases = open_generator(config['model_dir'], optimized_cache=config['optimized_cache'],
+                                            warm_up_shapes=DEFAULT_SHAPES if config['warm_up'] else None)
+    phases.update(open_phases)
+    prompt = [1] + [1000 + i % 500 for i in range(config['prompt_length'] - 1)]
+    start = time.perf_counter()
+    generator.generate([prompt], max_new_tokens=config['new_tokens'], eos_token_id=-1, pad_token_id=0)
+    phases['first_request_s'] = round(time.perf_counter() - start, 4)
+    phases['ready_s'] = round(sum(v for k, v in phases.items() if k != 'first_request_s'), 4)
+    phases['total_s'] = round(phases['ready_s'] + phases['first_request_s'], 4)
+    return phases
+
+
+def _drop_page_cache() -> bool:
+    try:
+        os.sync()
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('3\n')
+        return True
+    except OSError:
+        return False
+
+
+def measure_cold_start(model_dirs: Optional[Dict[str, str]] = None, repeats: int = 3,
+                       prompt_length: int = 64, new_tokens: int = 16, drop_page_cache: bool = False) -> Dict:
+    """Median phase timings of fresh-process starts, with and without the optimized cache and warm-up.
+
+    `model_dirs` maps a label to a model directory, e.g. an inline-weights
+    export and the external-data layout of the same model. The optimized
+    cache is built once per model before timing, so "cache" runs measure the
+    cache hit; its one-off build time is reported separately. With
+    `drop_page_cache` (root only) every run starts with a cold page cache.
+    """
+    model_dirs = model_dirs or {'onnx-model': 'onnx-model'}
+    results = {}
+    for label, model_dir in model_dirs.items():
+        start = time.perf_counter()
+        cache_dir = optimized_cache_dir(model_dir)
+        if os.path.exists(cache_dir):
+            shutil.rmtree(cache_dir)
+        build_optimized_graph(model_dir)
+        results[f"{label}: cache build (once)"] = {'cache_build_s': round(time.perf_counter() - start, 4)}
+
+        for optimized_cache in (False, True):
+            for warm in (False, True):
+                config = {'model_dir': model_dir, 'optimized_cache': optimized_cache, 'warm_up': warm,
+                          'prompt_length': prompt_length, 'new_tokens': new_tokens}
+                runs = []
+                for _ in range(repeats):
+                    if drop_page_cache:
+                        _drop_page_cache()
+                    output = subprocess.run([sys.executable, __file__, '--child', json.dumps(config)],
+                                            capture_output=True, text=True, check=True,
+                                            cwd=os.path.dirname(os.path.abspath(__file__)))
+                    runs.append(json.loads(output.stdout.strip().splitlines()[-1]))
+                name = f"{label}: {'cache' if optimized_cache else 'no cache'}, {'warm-up' if warm else 'no warm-up'}"
+                results[name] = {phase: round(float(np.median([run[phase] for run in runs])), 4)
+                                 for phase in runs[0]}
+
+    phases = ['cache_build_s', 'import_s', 'session_s', 'warm_up_s', 'ready_s', 'first_request_s', 'total_s']
+    print(f"{'configuration':<44}" + ''.join(f"{phase[:-2]:>15}" for phase in phases))
+    for name, result in results.items():
+        print(f"{name:<44}" + ''.join(f"{result[phase]:>15.3f}" if phase in result else f"{'-':>15}"
+                                      for phase in phases))
+    return results
+
+
+def check_tiny_model():
+    """Cold-start matrix on a tiny random Mistral, inline weights vs page-aligned external data.
+
+    Also checks that the cached optimized graph and the external-data layout
+    give the same logits as the original export.
+    """
+    import tempfile
+
+    import torch
+
+    from export_model import export_with_past, layout_external_data, tiny_mistral
+    from onnx_generation import OnnxGenerator
+
+    with tempfile.TemporaryDirectory() as tmp:
+        inline_dir, external_dir = os.path.join(tmp, 'inline'), os.path.join(tmp, 'external')
+        os.makedirs(inline_dir)
+        export_with_past(tiny_mistral(), os.path.join(inline_dir, 'model.onnx'), torch.tensor([[1, 2, 3]]))
+        shutil.copytree(inline_dir, external_dir)
+        layout_external_data(os.path.join(external_dir, 'model.onnx'))
+
+        import onnx
+
+        data = onnx.load(os.path.join(external_dir, 'model.onnx'), load_external_data=False)
+        offsets = [int(entry.value) for tensor in data.graph.initializer for entry in tensor.external_data
+                   if entry.key == 'offset']
+        assert offsets and all(offset % 4096 == 0 for offset in offsets)
+
+        input_ids = np.array([[1, 415, 3290, 302, 264]], dtype=np.int64)
+        reference, _ = OnnxGenerator(inline_dir).forward(input_ids, np.ones_like(input_ids))
+        for model_dir in (inline_dir, external_dir):
+            for optimized_cache in (False, True):
+                generator, _ = open_generator(model_dir, optimized_cache=optimized_cache, warm_up_shapes=((2, 8),))
+                logits, _ = generator.forward(input_ids, np.ones_like(input_ids))
+                assert np.abs(logits - reference).max() < 1e-4
+
+        measure_cold_start({'inline': inline_dir, 'external': external_dir}, repeats=1)
+    print("Check passed: cached optimized graph and external-data layout match the original export")
+
+
+if __name__ == "__main__":
+    if "--child" in sys.argv:
+        print(json.dumps(_child_run(json.loads(sys.argv[sys.argv.index("--child") + 1]))))
+        sys.exit(0)
+    if "--check" in sys.argv:
+        check_tiny_model()
+        sys.exit(0)
+
+    measure_cold_start({'onnx-model': sys.argv[1] if len(sys.argv) > 1 else 'onnx-model'},
+                       drop_page_cache='--drop-page-cache' in sys.argv)
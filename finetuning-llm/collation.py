@@ -0,0 +1,288 @@
+"""Packing and length-bucketed dynamic padding for the tokenized training splits.
+
+`tokenize_function` in finetune.ipynb pads every example to 512 tokens while
+most examples are 150-250 tokens long, so most of each batch is padding.
+This module offers two replacements over a `token_cache.TokenizedDataset`:
+
+- `PackedDataset` + `collate`: several examples per row of at most
+  `max_length` tokens (best-fit decreasing). Position ids restart at every
+  example and an optional block-diagonal causal mask keeps examples from
+  attending to each other.
+- `LengthBucketSampler` + `collate`: batches of similar-length examples,
+  padded only to the longest example in the batch.
+
+Label masking follows `tokenize_function` (positions before the prompt
+length are ignored) and additionally ignores padding, all as array ops.
+"""
+
+import bisect
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+
+from token_cache import IGNORE_INDEX, TokenizedDataset
+
+
+def mask_labels(input_ids: np.ndarray, prompt_lengths: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """Labels for a right-padded (batch, seq) id matrix: prompt and padding set to IGNORE_INDEX"""
+    positions = np.arange(input_ids.shape[1])[None, :]
+    labels = input_ids.astype(np.int64)
+    labels[(positions < prompt_lengths[:, None]) | (positions >= lengths[:, None])] = IGNORE_INDEX
+    return labels
+
+
+def pack_rows(lengths: Sequence[int], max_length: int = 512) -> List[List[int]]:
+    """Group example indices into rows of at most `max_length` tokens (best-fit decreasing)"""
+    order = sorted(range(len(lengths)), key=lambda i: (-lengths[i], i))
+    rows: List[List[int]] = []
+    # Sorted (remaining capacity, row index) of rows that can still take an example
+    free: List[tuple] = []
+    for i in order:
+        length = min(int(lengths[i]), max_length)
+        slot = bisect.bisect_left(free, (length, -1))
+        if slot < len(free):
+            remaining, row = free.pop(slot)
+            rows[row].append(i)
+            remaining -= length
+        else:
+            row = len(rows)
+            rows.append([i])
+            remaining = max_length - length
+        if remaining > 0:
+            bisect.insort(free, (remaining, row))
+    return rows
+
+
+class PackedDataset:
+    """Rows of several examples concatenated, with per-example positions and labels"""
+
+    def __init__(self, dataset: TokenizedDataset, max_length: Optional[int] = None):
+        self.dataset = dataset
+        self.max_length = max_length or dataset.max_length
+        self.rows = pack_rows(dataset.lengths, self.max_length)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, i: int) -> Dict:
+        examples = self.rows[i]
+        lengths = self.dataset.lengths[examples]
+        prompt_lengths = self.dataset.prompt_lengths[examples]
+        input_ids = np.concatenate([self.dataset.tokens(j) for j in examples]).astype(np.int64)
+
+        # Offsets of each example in the row, and each token's position within its example
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        example_of_token = np.repeat(np.arange(len(examples)), lengths)
+        position_ids = np.arange(len(input_ids)) - starts[example_of_token]
+
+        labels = input_ids.copy()
+        labels[position_ids < prompt_lengths[example_of_token]] = IGNORE_INDEX
+        return {
+            'input_ids': input_ids,
+            'labels': labels,
+            'position_ids': position_ids,
+            'sequence_ids': example_of_token,
+        }
+
+
+class LengthBucketSampler:
+    """Batches of indices with similar lengths.
+
+    Indices are shuffled, cut into buckets of `batch_size * bucket_batches`,
+    sorted by length within each bucket and split into batches; batch order
+    is shuffled again so lengths still vary from step to step.
+    """
+
+    def __init__(self, lengths: Sequence[int], batch_size: int, bucket_batches: int = 50,
+                 shuffle: bool = True, seed: int = 42, drop_last: bool = False):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * bucket_batches
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def batches(self) -> List[np.ndarray]:
+        rng = np.random.default_rng(self.seed + self.epoch)
+        indices = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = indices[start:start + self.bucket_size]
+            bucket = bucket[np.argsort(-self.lengths[bucket], kind='stable')]
+            for batch_start in range(0, len(bucket), self.batch_size):
+                batch = bucket[batch_start:batch_start + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch)
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        for batch in self.batches():
+            yield batch.tolist()
+
+    def __len__(self) -> int:
+        return len(self.batches())
+
+
+def collate(items: List[Dict], pad_token_id: int, pad_to_multiple_of: Optional[int] = 8,
+            block_diagonal_mask: bool = True, return_tensors: Optional[str] = 'pt', mask_dtype=None) -> Dict:
+    """Right-pad a list of dataset items to the longest one in the batch.
+
+    Accepts TokenizedDataset items (one example each) or PackedDataset rows.
+    Packed rows get `position_ids`, and with `block_diagonal_mask` a 4D
+    additive attention mask (batch, 1, seq, seq) that is causal within each
+    example and blocks attention across examples and to padding, in
+    `mask_dtype` (the model's compute dtype; float32 by default).
+    """
+    lengths = np.array([len(item['input_ids']) for item in items])
+    width = int(lengths.max()) if len(items) else 0
+    if pad_to_multiple_of:
+        width = -(-width // pad_to_multiple_of) * pad_to_multiple_of
+
+    packed = bool(items) and 'position_ids' in items[0]
+    input_ids = np.full((len(items), width), pad_token_id, dtype=np.int64)
+    for row, item in enumerate(items):
+        input_ids[row, :lengths[row]] = item['input_ids']
+    if packed:
+        labels = np.full((len(items), width), IGNORE_INDEX, dtype=np.int64)
+        for row, item in enumerate(items):
+            labels[row, :lengths[row]] = item['labels']
+    else:
+        prompt_lengths = np.array([item['prompt_length'] for item in items])
+        labels = mask_labels(input_ids, prompt_lengths, lengths)
+    attention_mask = (np.arange(width)[None, :] < lengths[:, None]).astype(np.int64)
+    batch = {'input_ids': input_ids, 'labels': labels, 'attention_mask': attention_mask}
+
+    if packed:
+        position_ids = np.zeros((len(items), width), dtype=np.int64)
+        # Padding gets its own sequence id so it never matches a real token
+        sequence_ids = np.full((len(items), width), -1, dtype=np.int64)
+        for row, item in enumerate(items):
+            position_ids[row, :lengths[row]] = item['position_ids']
+            sequence_ids[row, :lengths[row]] = item['sequence_ids']
+        batch['position_ids'] = position_ids
+        if block_diagonal_mask:
+            same_example = sequence_ids[:, :, None] == sequence_ids[:, None, :]
+            causal = np.tril(np.ones((width, width), dtype=bool))[None]
+            allowed = same_example & causal & (sequence_ids[:, :, None] >= 0)
+            batch['attention_mask'] = allowed[:, None]
+
+    if return_tensors == 'pt':
+        import torch
+
+        batch = {key: torch.from_numpy(value) for key, value in batch.items()}
+        if packed and block_diagonal_mask:
+            # transformers uses a 4D mask as is: additive, 0 to attend and dtype min to block
+            dtype = mask_dtype or torch.float32
+            allowed = batch['attention_mask']
+            mask = torch.zeros(allowed.shape, dtype=dtype)
+            batch['attention_mask'] = mask.masked_fill(~allowed, torch.finfo(dtype).min)
+    return batch
+
+
+class Collator:
+    """Callable wrapper around `collate` for DataLoader/Trainer `data_collator`"""
+
+    def __init__(self, pad_token_id: int, pad_to_multiple_of: Optional[int] = 8,
+                 block_diagonal_mask: bool = True, return_tensors: Optional[str] = 'pt', mask_dtype=None):
+        self.pad_token_id = pad_token_id
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.block_diagonal_mask = block_diagonal_mask
+        self.return_tensors = return_tensors
+        self.mask_dtype = mask_dtype
+
+    def __call__(self, items: List[Dict]) -> Dict:
+        return collate(items, self.pad_token_id, self.pad_to_multiple_of,
+                       self.block_diagonal_mask, self.return_tensors, self.mask_dtype)
+
+
+def effective_token_ratio(dataset: TokenizedDataset, batch_size: int = 8, strategy: str = 'bucketed',
+                          max_length: Optional[int] = None, pad_to_multiple_of: Optional[int] = 8) -> float:
+    """Share of batch positions holding real tokens under a batching strategy.
+
+    `strategy` is 'max_length' (the notebook's fixed 512 padding), 'bucketed'
+    (LengthBucketSampler + dynamic padding) or 'packed' (PackedDataset rows,
+    `batch_size` rows per batch, padded to the longest row).
+    """
+    max_length = max_length or dataset.max_length
+    lengths = dataset.lengths
+    real = int(lengths.sum())
+    if strategy == 'max_length':
+        return real / (len(lengths) * max_length)
+
+    if strategy == 'packed':
+        rows = pack_rows(lengths, max_length)
+        row_lengths = np.array([lengths[row].sum() for row in rows])
+        batches = [row_lengths[i:i + batch_size] for i in range(0, len(row_lengths), batch_size)]
+    elif strategy == 'bucketed':
+        batches = [lengths[batch] for batch in LengthBucketSampler(lengths, batch_size).batches()]
+    else:
+        raise ValueError(f"Unknown strategy {strategy!r}")
+
+    total = 0
+    for batch in batches:
+        width = int(batch.max())
+        if pad_to_multiple_of:
+            width = -(-width // pad_to_multiple_of) * pad_to_multiple_of
+        total += width * len(batch)
+    return real / total
+
+
+def verify_masking(dataset: TokenizedDataset, data_file: str, tokenizer_dir: str = 'onnx-model',
+                   limit: Optional[int] = None) -> int:
+    """Compare packed and bucketed labels with the notebook's per-token masking loop.
+
+    The reference re-tokenizes `data_file` with the bundled tokenizer and masks
+    `min(prompt_length, len(label_ids))` leading tokens one at a time, as
+    `tokenize_function` does; the padding it would add is never a training
+    target, so only real tokens are compared. Returns the number of examples
+    checked and raises AssertionError on the first mismatch.
+    """
+    from storage import iter_records
+    from token_cache import load_tokenizer
+
+    tokenizer = load_tokenizer(tokenizer_dir)
+    reference = {}
+    for i, example in enumerate(iter_records(data_file)):
+        if limit is not None and i >= limit:
+            break
+        full_ids = tokenizer.encode(example['prompt'] + example['completion']).ids[:dataset.max_length]
+        prompt_length = len(tokenizer.encode(example['prompt'], add_special_tokens=False).ids)
+        label_ids = list(full_ids)
+        for j in range(min(prompt_length, len(label_ids))):
+            label_ids[j] = IGNORE_INDEX
+        reference[i] = (full_ids, label_ids)
+
+    packed = PackedDataset(dataset)
+    for row in range(len(packed)):
+        item = packed[row]
+        for k, example in enumerate(packed.rows[row]):
+            if example in reference:
+                tokens = item['sequence_ids'] == k
+                assert item['input_ids'][tokens].tolist() == reference[example][0], f"example {example} tokens"
+                assert item['labels'][tokens].tolist() == reference[example][1], f"example {example} packed labels"
+
+    for batch in LengthBucketSampler(dataset.lengths, 8).batches():
+        collated = collate([dataset[i] for i in batch], dataset.pad_token_id, return_tensors=None)
+        for row, i in enumerate(batch):
+            if i in reference:
+                n = len(reference[i][1])
+                assert collated['labels'][row, :n].tolist() == reference[i][1], f"example {i} bucketed labels"
+                assert (collated['labels'][row, n:] == IGNORE_INDEX).all(), f"example {i} padding labels"
+    return len(reference)
+
+
+if __name__ == "__main__":
+    from token_cache import load_token_cache
+
+    data_file = 'processed-data/train_data.json'
+    dataset = load_token_cache(data_file)
+    for strategy in ('max_length', 'bucketed', 'packed'):
+        print(f"{strategy:>10}: {effective_token_ratio(dataset, strategy=strategy):.1%} real tokens")
+    checked = verify_masking(dataset, data_file)
+    print(f"Packed and bucketed labels match the notebook masking for {checked} examples")
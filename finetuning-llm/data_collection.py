@@ -1,50 +1,132 @@
-import requests
+import argparse
+import asyncio
 import json
+import random
 import time
 import os
-from typing import List, Dict
+from typing import List, Dict, Optional, Callable, Iterable, Iterator
+
+from harvest_checkpoint import HarvestCheckpoint
+from http_cache import ResponseCache, cached_get_json, record_response
+from instrumentation import count as count_metric, span
+from storage import iter_records, write_records
 
 # Create data directories
 os.makedirs('raw-data', exist_ok=True)
 
-def get_met_paintings_raw(limit: int = 100) -> List[Dict]:
-    """Get complete raw painting data from Met Museum API"""
-    
-    # Check if we already have complete raw data
-    raw_file = 'raw-data/met_paintings_complete_raw.json'
-    if os.path.exists(raw_file):
-        print(f"Loading existing raw data from {raw_file}")
-        with open(raw_file, 'r') as f:
-            return json.load(f)
-    
-    print("Fetching fresh data from Met Museum API...")
-    
-    # Step 1: Get list of painting object IDs
-    search_url = "https://collectionapi.metmuseum.org/public/collection/v1/search"
-    params = {
-        'hasImages': 'true',
-        'isHighlight': 'true',
-        'q': 'painting'
-    }
-    
-    response = requests.get(search_url, params=params)
-    object_ids = response.json().get('objectIDs', [])
-    print(f"Found {len(object_ids)} object IDs")
-    object_ids = object_ids[:limit]  # Limit to the specified number
+MET_API_BASE = "https://collectionapi.metmuseum.org/public/collection/v1"
+# The Met asks clients to stay at or below 80 requests per second
+MET_RATE_LIMIT = 80
+REQUIRED_FIELDS = ['title', 'artistDisplayName', 'objectDate', 'medium']
+SEARCH_PARAMS = {
+    'hasImages': 'true',
+    'isHighlight': 'true',
+    'q': 'painting'
+}
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+def get_met_paintings_raw(limit: int = 100,
+                          use_async: bool = False,
+                          api_base: str = MET_API_BASE,
+                          raw_file: str = 'raw-data/met_paintings_complete_raw.json',
+                          checkpoint_dir: str = 'raw-data/harvest',
+                          refresh: bool = False,
+                          cache_file: Optional[str] = 'raw-data/http-cache.sqlite',
+                          cache_max_bytes: int = 512 * 1024 ** 2,
+                          concurrency: int = 16,
+                          rate_limit: float = MET_RATE_LIMIT) -> List[Dict]:
+    """Get complete raw painting data from Met Museum API.
+    
+    Every fetched object is checkpointed to JSONL shards under `checkpoint_dir`,
+    so a rerun fetches only the objectIDs that are still missing (or failed).
+    With `refresh`, the search is re-run and objects the API reports as updated
+    since the last search are re-fetched if their metadataDate changed.
+    `raw_file` is rewritten from the shards as a derived export. Object
+    details go through the on-disk response cache at `cache_file` (None
+    disables it), so re-fetches of unchanged objects are answered with 304s.
+    """
+    import requests
+
+    checkpoint = HarvestCheckpoint(checkpoint_dir)
+    cache = ResponseCache(cache_file, max_bytes=cache_max_bytes) if cache_file else None
+    
+    # Seed the checkpoint from a monolithic file written before checkpointing existed
+    if not checkpoint.object_ids and os.path.exists(raw_file):
+        print(f"Seeding harvest checkpoint from existing raw data in {raw_file}")
+        checkpoint.import_objects(iter_records(raw_file))
+    
+    to_fetch = []
+    if refresh or not checkpoint.object_ids:
+        previous_search = checkpoint.manifest['searched_at']
+        
+        # Step 1: Get list of painting object IDs
+        print("Fetching object IDs from Met Museum API...")
+        response = requests.get(f"{api_base}/search", params=SEARCH_PARAMS)
+        object_ids = response.json().get('objectIDs') or []
+        print(f"Found {len(object_ids)} object IDs")
+        checkpoint.set_object_ids(object_ids, searched_at=time.strftime('%Y-%m-%d'))
+        
+        if refresh:
+            to_fetch = updated_object_ids(api_base, previous_search, checkpoint, checkpoint.object_ids[:limit])
+            print(f"{len(to_fetch)} harvested objects have newer metadata")
+    
+    object_ids = checkpoint.object_ids[:limit]  # Limit to the specified number
+    to_fetch += checkpoint.missing(object_ids)
+    
+    # Step 2: Get complete details for each painting not checkpointed yet
+    if to_fetch:
+        print(f"Fetching {len(to_fetch)} objects ({len(object_ids) - len(to_fetch)} already harvested)...")
+        
+        def on_fetched(obj_id, raw_data, error):
+            count_metric('harvest_objects_total', status='failed' if error is not None else 'fetched')
+            if error is not None:
+                checkpoint.record_failure(obj_id, error)
+            else:
+                checkpoint.record(obj_id, raw_data, keep=has_required_fields(raw_data))
+        
+        try:
+            with span('harvest', mode='async' if use_async else 'sequential') as s:
+                if use_async:
+                    asyncio.run(harvest_met_paintings(
+                        len(to_fetch), api_base=api_base, concurrency=concurrency,
+                        rate_limit=rate_limit, object_ids=to_fetch, on_fetched=on_fetched, cache=cache
+                    ))
+                else:
+                    fetch_objects_sequential(to_fetch, api_base=api_base, on_fetched=on_fetched, cache=cache)
+                s.add(len(to_fetch))
+        finally:
+            checkpoint.save()
+            if cache:
+                print(f"Response cache: {cache.stats['hits']} hits, {cache.stats['revalidated']} revalidated, "
+                      f"{cache.stats['misses']} misses, {cache.stats['updated']} updated, {cache.stats['evicted']} evicted")
+                cache.close()
+    
+    # Save complete raw data
+    count = checkpoint.export(raw_file, object_ids)
+    summary = checkpoint.summary()
+    print(f"Saved {count} complete raw paintings to {raw_file} "
+          f"({summary['failed']} failed, {summary['filtered']} filtered)")
+    return list(checkpoint.iter_objects(object_ids))
+
+
+def fetch_objects_sequential(object_ids: List[int], api_base: str = MET_API_BASE,
+                             on_fetched: Optional[Callable] = None,
+                             cache: Optional[ResponseCache] = None) -> List[Dict]:
+    """Fetch object details one at a time, keeping those with the required fields"""
     raw_paintings = []
     
-    # Step 2: Get complete details for each painting
     for i, obj_id in enumerate(object_ids):
         try:
-            detail_url = f"https://collectionapi.metmuseum.org/public/collection/v1/objects/{obj_id}"
-            detail_response = requests.get(detail_url)
-            raw_data = detail_response.json()  # Store EVERYTHING
+            detail_url = f"{api_base}/objects/{obj_id}"
+            raw_data = cached_get_json(detail_url, cache)  # Store EVERYTHING
+            if on_fetched:
+                on_fetched(obj_id, raw_data, None)
             
             # Only store if it has basic required fields
-            if all(raw_data.get(field) for field in ['title', 'artistDisplayName', 'objectDate', 'medium']):
+            if has_required_fields(raw_data):
                 raw_paintings.append(raw_data)
             else:
-                print(f"Skipping object {obj_id} due to missing required fields ({', '.join(field for field in ['title', 'artistDisplayName', 'objectDate', 'medium'] if not raw_data.get(field))})")
+                print(f"Skipping object {obj_id} due to missing required fields ({', '.join(missing_required_fields(raw_data))})")
             
             # Rate limiting: ~50 requests per second
             time.sleep(0.02)
@@ -54,25 +136,186 @@ def get_met_paintings_raw(limit: int = 100) -> List[Dict]:
                 
         except Exception as e:
             print(f"Error fetching object {obj_id}: {e}")
+            if on_fetched:
+                on_fetched(obj_id, None, e)
             continue
     
-    # Save complete raw data
-    with open(raw_file, 'w') as f:
-        json.dump(raw_paintings, f, indent=2)
-    
-    print(f"Saved {len(raw_paintings)} complete raw paintings to {raw_file}")
     return raw_paintings
 
 
+def updated_object_ids(api_base: str, since: Optional[str], checkpoint: HarvestCheckpoint,
+                       object_ids: List[int]) -> List[int]:
+    """Harvested objects the API lists as modified since `since` (YYYY-MM-DD)"""
+    if not since:
+        return []
+    import requests
+
+    response = requests.get(f"{api_base}/objects", params={'metadataDate': since})
+    changed = set(response.json().get('objectIDs') or [])
+    return [obj_id for obj_id in object_ids
+            if obj_id in changed and checkpoint.metadata_date(obj_id) is not None]
+
+
+def missing_required_fields(raw_data: Dict) -> List[str]:
+    """Required fields that are absent or empty in a raw object"""
+    return [field for field in REQUIRED_FIELDS if not raw_data.get(field)]
+
+
+def has_required_fields(raw_data: Dict) -> bool:
+    """Whether a raw object has every field the formatter needs"""
+    return not missing_required_fields(raw_data)
+
+
+class TokenBucket:
+    """Async token bucket: allows `rate` acquisitions per second with bursts up to `capacity`"""
+    
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self):
+        # Holding the lock while sleeping keeps waiters in FIFO order
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 30.0, retry_after: Optional[str] = None) -> float:
+    """Full-jitter exponential backoff, honouring a numeric Retry-After header when present"""
+    if retry_after:
+        try:
+            return min(cap, float(retry_after))
+        except ValueError:
+            pass
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+async def fetch_json_async(session, url: str, limiter: TokenBucket, params: Optional[Dict] = None,
+                           max_retries: int = 5, cache: Optional[ResponseCache] = None) -> Dict:
+    """GET a JSON document through the rate limiter, retrying 429/5xx and connection errors.
+    
+    With a `cache`, stored entries are revalidated with a conditional GET.
+    """
+    import aiohttp
+    
+    entry = cache.lookup(url) if cache else None
+    if entry and entry['fresh']:
+        cache.hit(url)
+        return json.loads(entry['body'])
+    headers = cache.request_headers(entry) if cache else None
+    
+    for attempt in range(max_retries + 1):
+        await limiter.acquire()
+        if attempt:
+            count_metric('http_retries_total')
+        start = time.perf_counter()
+        try:
+            async with session.get(url, params=params, headers=headers) as response:
+                if response.status == 304 and entry:
+                    record_response(time.perf_counter() - start, response.status, 0)
+                    cache.hit(url, revalidated=True)
+                    return json.loads(entry['body'])
+                if response.status not in RETRY_STATUSES:
+                    response.raise_for_status()
+                    body = await response.read()
+                    record_response(time.perf_counter() - start, response.status, len(body))
+                    if cache:
+                        cache.store(url, body, response.headers, replaced=entry is not None)
+                    return json.loads(body)
+                record_response(time.perf_counter() - start, response.status, 0)
+                if attempt == max_retries:
+                    response.raise_for_status()
+                delay = backoff_delay(attempt, retry_after=response.headers.get('Retry-After'))
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            count_metric('http_errors_total', error=type(e).__name__)
+            if attempt == max_retries:
+                raise
+            delay = backoff_delay(attempt)
+        await asyncio.sleep(delay)
+
 
-def format_paintings(raw_paintings: List[Dict]) -> List[Dict]:
-    """Format raw paintings into our training structure"""
+async def harvest_met_paintings(limit: int = 100,
+                                api_base: str = MET_API_BASE,
+                                concurrency: int = 16,
+                                rate_limit: float = MET_RATE_LIMIT,
+                                max_retries: int = 5,
+                                object_ids: Optional[List[int]] = None,
+                                on_fetched: Optional[Callable] = None,
+                                cache: Optional[ResponseCache] = None) -> List[Dict]:
+    """Fetch raw painting data concurrently over one pooled session.
+    
+    Returns the same list as `fetch_objects_sequential`: objects in search
+    order, filtered on REQUIRED_FIELDS. `on_fetched(obj_id, raw_data, error)`
+    is called for every object as soon as it completes.
+    """
+    import aiohttp
     
-    formatted_file = 'raw-data/met_paintings_formatted.json'
+    print(f"Fetching fresh data from Met Museum API ({concurrency} concurrent, {rate_limit} req/s)...")
+    
+    limiter = TokenBucket(rate_limit)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=60)
+    
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        if object_ids is None:
+            search = await fetch_json_async(session, f"{api_base}/search", limiter,
+                                            params=SEARCH_PARAMS, max_retries=max_retries)
+            object_ids = search.get('objectIDs') or []
+            print(f"Found {len(object_ids)} object IDs")
+        object_ids = object_ids[:limit]
+        
+        results: List[Optional[Dict]] = [None] * len(object_ids)
+        pending = iter(enumerate(object_ids))
+        done = 0
+        
+        async def worker():
+            nonlocal done
+            for i, obj_id in pending:
+                try:
+                    raw_data = await fetch_json_async(session, f"{api_base}/objects/{obj_id}", limiter,
+                                                      max_retries=max_retries, cache=cache)
+                    if on_fetched:
+                        on_fetched(obj_id, raw_data, None)
+                    if has_required_fields(raw_data):
+                        results[i] = raw_data
+                    else:
+                        print(f"Skipping object {obj_id} due to missing required fields ({', '.join(missing_required_fields(raw_data))})")
+                except Exception as e:
+                    print(f"Error fetching object {obj_id}: {e}")
+                    if on_fetched:
+                        on_fetched(obj_id, None, e)
+                
+                done += 1
+                if done % 20 == 0:
+                    print(f"Processed {done}/{len(object_ids)} paintings...")
+        
+        await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    
+    return [raw for raw in results if raw is not None]
+
+
+# Raw fields read by the formatter; columnar sources decode only these
+FORMAT_FIELDS = [
+    'title', 'artistDisplayName', 'objectDate', 'medium', 'objectID',
+    'primaryImage', 'primaryImageSmall', 'objectURL', 'department',
+    'culture', 'period', 'dimensions', 'creditLine'
+]
+
+
+def iter_formatted_paintings(raw_paintings: Iterable[Dict]) -> Iterator[Dict]:
+    """Format raw paintings into our training structure, one record at a time"""
     
-    formatted_paintings = []
     for raw in raw_paintings:
-        formatted = {
+        yield {
             'title': raw['title'],
             'artist': raw['artistDisplayName'],
             'date': raw['objectDate'],
@@ -89,32 +332,66 @@ def format_paintings(raw_paintings: List[Dict]) -> List[Dict]:
             'dimensions': raw.get('dimensions', ''),
             'credit_line': raw.get('creditLine', '')
         }
-        formatted_paintings.append(formatted)
+
+
+def format_paintings(raw_paintings: Iterable[Dict],
+                     formatted_file: str = 'raw-data/met_paintings_formatted.json',
+                     index_dir: Optional[str] = None) -> int:
+    """Format raw paintings and stream them to `formatted_file` (.json, .jsonl or .parquet).
+    
+    With `index_dir`, the search index (search_index.py) is built in the same pass.
+    """
+    paintings = iter_formatted_paintings(raw_paintings)
+    builder = None
+    if index_dir:
+        from search_index import SearchIndexBuilder
+        
+        builder = SearchIndexBuilder(index_dir)
+        paintings = builder.tee(paintings)
     
     # Save formatted data
-    with open(formatted_file, 'w') as f:
-        json.dump(formatted_paintings, f, indent=2)
+    with span('format') as s:
+        count = write_records(formatted_file, paintings)
+        s.add(count)
     
-    print(f"Saved {len(formatted_paintings)} formatted paintings to {formatted_file}")
-    return formatted_paintings
+    print(f"Saved {count} formatted paintings to {formatted_file}")
+    if builder:
+        manifest = builder.finish()
+        print(f"Indexed {manifest['count']} paintings for search in {index_dir}")
+    return count
 
 # Test it
 if __name__ == "__main__":
-    # # Get raw data
-    # raw_paintings = get_met_paintings_raw(1500)
-    # print(f"Got {len(raw_paintings)} raw paintings")
+    parser = argparse.ArgumentParser(description="Harvest and format Met Museum paintings")
+    parser.add_argument('--harvest', type=int, metavar='LIMIT',
+                        help="fetch up to LIMIT objects, resuming from the harvest checkpoint")
+    parser.add_argument('--refresh', action='store_true',
+                        help="re-run the search and re-fetch objects whose metadataDate changed")
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help="fetch concurrently over a pooled session")
+    parser.add_argument('--raw-file', default='raw-data/met_paintings_complete_raw.json',
+                        help="raw objects to format (.json, .jsonl or .parquet)")
+    parser.add_argument('--formatted-file', default='raw-data/met_paintings_formatted.json',
+                        help="formatted output (.json, .jsonl or .parquet)")
+    parser.add_argument('--index-dir', default='processed-data/search-index',
+                        help="search index written alongside the formatted output ('' skips it)")
+    args = parser.parse_args()
+    
+    if args.harvest or args.refresh:
+        raw_paintings = get_met_paintings_raw(args.harvest or 1500, use_async=args.use_async, refresh=args.refresh)
+        print(f"Got {len(raw_paintings)} raw paintings")
     
     # Get raw data
-    if not os.path.exists('raw-data/met_paintings_complete_raw.json'):
-        raw_paintings=[]
+    if not os.path.exists(args.raw_file):
+        raw_paintings = []
         print("Raw data not found")
     else:
-        raw_paintings = json.load(open('raw-data/met_paintings_complete_raw.json', 'r'))
+        raw_paintings = iter_records(args.raw_file, columns=FORMAT_FIELDS)
 
     # Format the data
-    formatted_paintings = format_paintings(raw_paintings)
-    print(f"Formatted {len(formatted_paintings)} paintings")
+    count = format_paintings(raw_paintings, args.formatted_file, args.index_dir or None)
+    print(f"Formatted {count} paintings")
     
     # Show example
     print("\nExample formatted painting:")
-    print(json.dumps(formatted_paintings[0], indent=2))
\ No newline at end of file
+    print(json.dumps(next(iter_records(args.formatted_file)), indent=2))
\ No newline at end of file
@@ -0,0 +1,160 @@
+"""MinHash + LSH near-duplicate removal for template-generated training examples.
+
+Each completion is reduced to a MinHash signature over word shingles, and
+signatures are bucketed by LSH bands so only examples sharing a band are
+ever compared. Candidates are compared against their bucket's first member
+(not pairwise), which keeps the work linear in the number of examples even
+when a template produces very large buckets.
+"""
+
+import re
+import zlib
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+from storage import iter_records, write_records
+
+# Largest prime below 2**32: (a * x + b) with a, b, x < 2**32 never overflows uint64
+_PRIME = np.uint64(4294967291)
+_WORD = re.compile(r"\w+")
+
+
+def shingle_hashes(text: str, size: int = 5) -> np.ndarray:
+    """crc32 hashes of the lowercase word `size`-grams of a text"""
+    words = _WORD.findall(text.lower())
+    if len(words) < size:
+        grams = [' '.join(words)]
+    else:
+        grams = [' '.join(words[i:i + size]) for i in range(len(words) - size + 1)]
+    return np.unique(np.fromiter((zlib.crc32(g.encode('utf-8')) for g in grams), dtype=np.uint64, count=len(grams)))
+
+
+class MinHasher:
+    """Deterministic universal-hash permutations for MinHash signatures"""
+
+    def __init__(self, num_perm: int = 128, seed: int = 1):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.a = rng.integers(1, int(_PRIME), size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, int(_PRIME), size=num_perm, dtype=np.uint64)
+
+    def signature(self, hashes: np.ndarray) -> np.ndarray:
+        permuted = (hashes[:, None] * self.a[None, :] + self.b[None, :]) % _PRIME
+        return permuted.min(axis=0).astype(np.uint32)
+
+
+def lsh_params(threshold: float, num_perm: int) -> Tuple[int, int]:
+    """(bands, rows) minimising the sum of false-positive and false-negative mass around `threshold`"""
+    def probability(s, bands, rows):
+        return 1 - (1 - s ** rows) ** bands
+
+    best, best_error = (num_perm, 1), float('inf')
+    for bands in range(1, num_perm + 1):
+        rows = num_perm // bands
+        if rows == 0:
+            break
+        below = np.linspace(0, threshold, 200)
+        above = np.linspace(threshold, 1, 200)
+        false_positive = np.trapezoid(probability(below, bands, rows), below)
+        false_negative = np.trapezoid(1 - probability(above, bands, rows), above)
+        if false_positive + false_negative < best_error:
+            best, best_error = (bands, rows), false_positive + false_negative
+    return best
+
+
+def _find(parent: List[int], i: int) -> int:
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def near_duplicate_clusters(texts: Iterable[str], threshold: float = 0.8, num_perm: int = 128,
+                            shingle_size: int = 5) -> List[int]:
+    """Cluster id (index of the cluster's first member) for every text"""
+    hasher = MinHasher(num_perm)
+    bands, rows = lsh_params(threshold, num_perm)
+    buckets: List[Dict[bytes, int]] = [{} for _ in range(bands)]
+    signatures: List[np.ndarray] = []
+    parent: List[int] = []
+
+    for i, text in enumerate(texts):
+        signature = hasher.signature(shingle_hashes(text, shingle_size))
+        signatures.append(signature)
+        parent.append(i)
+        for band in range(bands):
+            key = signature[band * rows:(band + 1) * rows].tobytes()
+            first = buckets[band].setdefault(key, i)
+            if first == i:
+                continue
+            # Estimated Jaccard similarity against the bucket's first member
+            if np.count_nonzero(signatures[first] == signature) >= threshold * num_perm:
+                root, other = _find(parent, i), _find(parent, first)
+                if root != other:
+                    parent[max(root, other)] = min(root, other)
+
+    return [_find(parent, i) for i in range(len(parent))]
+
+
+def _count_tokens(example: Dict, tokenize: Optional[Callable[[str], List]]) -> int:
+    text = example['prompt'] + example['completion']
+    return len(tokenize(text)) if tokenize else len(text.split())
+
+
+def deduplicate_training_file(input_file: str = 'raw-data/training_examples_bulk.json',
+                              output_file: str = 'raw-data/training_examples_dedup.json',
+                              threshold: float = 0.8,
+                              num_perm: int = 128,
+                              shingle_size: int = 5,
+                              protected: Optional[Set[str]] = None,
+                              tokenize: Optional[Callable[[str], List]] = None) -> Dict:
+    """Keep one example per near-duplicate completion cluster.
+
+    Examples whose completion is in `protected` (the seed scripts by default)
+    are always kept; a cluster containing one drops all its other members.
+    Otherwise the first example of each cluster is kept. Two streaming passes
+    over `input_file`: one to build signatures, one to write the survivors.
+    Token counts use whitespace words unless a `tokenize` callable is given.
+    """
+    if protected is None:
+        from generate_audio_scripts import seed_training_examples
+        protected = {example['completion'] for example in seed_training_examples()}
+
+    is_protected = []
+
+    def completions():
+        for example in iter_records(input_file, columns=['completion']):
+            is_protected.append(example['completion'] in protected)
+            yield example['completion']
+
+    clusters = near_duplicate_clusters(completions(), threshold, num_perm, shingle_size)
+    # Clusters containing a protected example keep only their protected members
+    protected_clusters = {cluster for cluster, flag in zip(clusters, is_protected) if flag}
+
+    report = {'examples': len(clusters), 'kept': 0, 'removed': 0,
+              'clusters': len(set(clusters)), 'tokens_total': 0, 'tokens_removed': 0}
+
+    def survivors():
+        for i, example in enumerate(iter_records(input_file)):
+            tokens = _count_tokens(example, tokenize)
+            report['tokens_total'] += tokens
+            cluster = clusters[i]
+            if is_protected[i] or (cluster == i and cluster not in protected_clusters):
+                report['kept'] += 1
+                yield example
+            else:
+                report['removed'] += 1
+                report['tokens_removed'] += tokens
+
+    write_records(output_file, survivors(), ensure_ascii=False)
+
+    print(f"Deduplicated {report['examples']} examples at Jaccard >= {threshold}: "
+          f"kept {report['kept']}, removed {report['removed']} "
+          f"({report['tokens_removed']:,} of {report['tokens_total']:,} tokens)")
+    print(f"Saved to {output_file}")
+    return report
+
+
+if __name__ == "__main__":
+    deduplicate_training_file()
@@ -1,24 +1,44 @@
 #!/usr/bin/env python3
+"""Merge the LoRA adapters, export the merged model to ONNX and quantize it.
+
+torch, transformers, peft and onnxruntime are imported inside the functions
+that use them, so importing this module (e.g. from cli.py to quantize an
+existing graph) costs none of their startup time or memory.
+"""
+import mmap
 import os
 from pathlib import Path
 
-import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from peft import PeftModelForCausalLM
-from onnxruntime.quantization import quantize_dynamic, QuantType
+from instrumentation import timed
 
 
+@timed('merge_lora')
 def merge_lora(
     base_name: str,
     adapter_dir: str,
     merged_dir: str = "./fp16-merged-model",
     offload_folder: str = "./offload",
+    streaming: bool = False,
 ):
     """
     1) Load base in FP16 with device_map + offload_folder (no 4-bit!)
     2) Load and merge LoRA adapters
     3) Save merged FP16 model + tokenizer
+
+    With `streaming`, lora_merge.py merges the safetensors shards tensor by
+    tensor instead, keeping peak memory to about the largest tensor.
     """
+    import torch
+
+    if streaming:
+        from lora_merge import stream_merge_lora
+
+        stream_merge_lora(base_name, adapter_dir, merged_dir, dtype=torch.float16)
+        return merged_dir
+
+    from peft import PeftModelForCausalLM
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
     os.makedirs(offload_folder, exist_ok=True)
     print(f"Merging LoRA from {adapter_dir} into base {base_name}")
 
@@ -58,19 +78,193 @@ def merge_lora(
     return merged_dir
 
 
+def past_names(num_layers: int):
+    """ONNX input names of the per-layer key/value cache"""
+    return [f"past_key_values.{i}.{kind}" for i in range(num_layers) for kind in ("key", "value")]
+
+
+def present_names(num_layers: int):
+    """ONNX output names of the updated per-layer key/value cache"""
+    return [f"present.{i}.{kind}" for i in range(num_layers) for kind in ("key", "value")]
+
+
+def _with_past(model):
+    """Flat-tensor wrapper so the exporter sees the KV cache as plain graph inputs/outputs.
+
+    One merged graph serves prefill and decode: prefill passes a zero-length
+    past (batch, kv_heads, 0, head_dim), decode passes the previous presents.
+    """
+    import torch
+    from transformers.cache_utils import DynamicCache
+
+    class WithPast(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+            self.num_layers = model.config.num_hidden_layers
+
+        def forward(self, input_ids, attention_mask, position_ids, *past):
+            cache = DynamicCache()
+            for layer in range(self.num_layers):
+                cache.update(past[2 * layer], past[2 * layer + 1], layer)
+            outputs = self.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=cache,
+                use_cache=True,
+            )
+            present = [tensor for layer in outputs.past_key_values.to_legacy_cache() for tensor in layer]
+            return (outputs.logits, *present)
+
+    return WithPast(model)
+
+
+def export_with_past(model, onnx_path: str, example_ids, opset: int = 14):
+    """Export `model` with past_key_values.* inputs and present.* outputs for every layer.
+
+    Inputs: input_ids and position_ids (batch, sequence), attention_mask
+    (batch, past_sequence + sequence) and the per-layer cache; outputs:
+    logits plus present.* of length past_sequence + sequence. `example_ids`
+    is the torch.Tensor of token ids traced for the export.
+    """
+    import torch
+
+    config = model.config
+    num_layers = config.num_hidden_layers
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+    dtype = next(model.parameters()).dtype
+
+    # Trace with a non-empty past so the concat-with-cache path is recorded
+    batch, sequence, past_length = example_ids.shape[0], example_ids.shape[1], 2
+    past = [torch.zeros(batch, config.num_key_value_heads, past_length, head_dim, dtype=dtype)
+            for _ in range(2 * num_layers)]
+    attention_mask = torch.ones(batch, past_length + sequence, dtype=torch.int64)
+    position_ids = torch.arange(past_length, past_length + sequence, dtype=torch.int64).expand(batch, -1)
+
+    dynamic_axes = {
+        "input_ids": {0: "batch", 1: "sequence"},
+        "attention_mask": {0: "batch", 1: "total_sequence"},
+        "position_ids": {0: "batch", 1: "sequence"},
+        "logits": {0: "batch", 1: "sequence"},
+    }
+    for name in past_names(num_layers):
+        dynamic_axes[name] = {0: "batch", 2: "past_sequence"}
+    for name in present_names(num_layers):
+        dynamic_axes[name] = {0: "batch", 2: "total_sequence"}
+
+    torch.onnx.export(
+        _with_past(model),
+        (example_ids, attention_mask, position_ids, *past),
+        onnx_path,
+        input_names=["input_ids", "attention_mask", "position_ids", *past_names(num_layers)],
+        output_names=["logits", *present_names(num_layers)],
+        dynamic_axes=dynamic_axes,
+        opset_version=opset,
+        do_constant_folding=True,
+        dynamo=False,
+    )
+    return onnx_path
+
+
+def layout_external_data(
+    onnx_path: str,
+    data_file: str = "model.onnx.data",
+    alignment: int = mmap.ALLOCATIONGRANULARITY,
+    size_threshold: int = 1024,
+):
+    """
+    Move every initializer of at least `size_threshold` bytes into one
+    external data file, each starting on an `alignment` boundary, so
+    onnxruntime can memory-map weights straight from the page cache and
+    processes loading the same file share its pages. Tensors are copied one
+    at a time (the graph is loaded without its weights), and the per-tensor
+    files torch writes for >2 GB models are removed afterwards.
+    """
+    import onnx
+    from onnx.external_data_helper import ExternalDataInfo, uses_external_data
+
+    model_dir = os.path.dirname(os.path.abspath(onnx_path))
+    model = onnx.load(onnx_path, load_external_data=False)
+    tmp_data = os.path.join(model_dir, data_file + ".tmp")
+    old_files = set()
+    offset = 0
+    with open(tmp_data, "wb") as out:
+        for tensor in model.graph.initializer:
+            if uses_external_data(tensor):
+                info = ExternalDataInfo(tensor)
+                source = os.path.join(model_dir, info.location)
+                old_files.add(os.path.abspath(source))
+                length = info.length if info.length is not None else os.path.getsize(source) - (info.offset or 0)
+                if length < size_threshold:
+                    with open(source, "rb") as f:
+                        f.seek(info.offset or 0)
+                        tensor.raw_data = f.read(length)
+                    del tensor.external_data[:]
+                    tensor.data_location = onnx.TensorProto.DEFAULT
+                    continue
+            elif tensor.HasField("raw_data") and len(tensor.raw_data) >= size_threshold:
+                source, length = None, len(tensor.raw_data)
+            else:
+                continue
+
+            padding = -offset % alignment
+            out.write(b"\0" * padding)
+            offset += padding
+            if source is None:
+                out.write(tensor.raw_data)
+                tensor.ClearField("raw_data")
+            else:
+                with open(source, "rb") as f:
+                    f.seek(info.offset or 0)
+                    remaining = length
+                    while remaining:
+                        chunk = f.read(min(remaining, 1 << 24))
+                        out.write(chunk)
+                        remaining -= len(chunk)
+            del tensor.external_data[:]
+            for key, value in (("location", data_file), ("offset", offset), ("length", length)):
+                entry = tensor.external_data.add()
+                entry.key, entry.value = key, str(value)
+            tensor.data_location = onnx.TensorProto.EXTERNAL
+            offset += length
+
+    onnx.save_model(model, onnx_path)
+    os.replace(tmp_data, os.path.join(model_dir, data_file))
+    for path in old_files - {os.path.abspath(os.path.join(model_dir, data_file))}:
+        os.remove(path)
+    print(f"Wrote {offset / 2 ** 20:.1f} MB of {alignment}-byte aligned external data to {data_file}")
+    return onnx_path
+
+
+@timed('export_to_onnx')
 def export_to_onnx(
     merged_dir: str,
     onnx_dir: str = "./onnx-model",
     opset: int = 14,
+    with_past: bool = True,
+    dtype=None,
 ):
+    """
+    Export the merged model to onnx_dir/model.onnx. With `with_past` (default)
+    the graph takes and returns the KV cache so onnx_generation.py decodes
+    incrementally; without it only (input_ids, attention_mask) -> logits.
+    `dtype` is a torch.dtype. Static INT8 calibration needs a
+    `dtype=torch.float32` export; the default is torch.float16.
+    """
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    dtype = dtype or torch.float16
     print(f"Loading merged model from {merged_dir} onto CPU for export")
     model = AutoModelForCausalLM.from_pretrained(
         merged_dir,
-        torch_dtype=torch.float16,
+        torch_dtype=dtype,
         device_map="cpu",
         trust_remote_code=True,   
     )
     model.eval()
+    precision = str(dtype).replace("torch.", "")
 
     tokenizer = AutoTokenizer.from_pretrained(merged_dir)
     if tokenizer.pad_token is None:
@@ -87,7 +281,14 @@ def export_to_onnx(
 
     Path(onnx_dir).mkdir(parents=True, exist_ok=True)
     onnx_path = os.path.join(onnx_dir, "model.onnx")
-    print(f"Exporting to ONNX (float16) at {onnx_path}")
+    if with_past:
+        print(f"Exporting to ONNX ({precision}, KV cache for {model.config.num_hidden_layers} layers) at {onnx_path}")
+        export_with_past(model, onnx_path, ids, opset=opset)
+        layout_external_data(onnx_path)
+        print(f"ONNX ({precision}) model written to {onnx_dir}")
+        return onnx_dir
+
+    print(f"Exporting to ONNX ({precision}) at {onnx_path}")
     torch.onnx.export(
         model,
         (ids, mask),
@@ -102,18 +303,40 @@ def export_to_onnx(
         opset_version=opset,
         do_constant_folding=True,
     )
-    print(f"ONNX (float16) model written to {onnx_dir}")
+    layout_external_data(onnx_path)
+    print(f"ONNX ({precision}) model written to {onnx_dir}")
     return onnx_dir
 
 
+@timed('quantize_onnx')
 def quantize_onnx(
     onnx_dir: str,
     quant_dir: str = "./onnx-int8",
-    weight_type: QuantType = QuantType.QInt8,
+    weight_type=None,
+    mode: str = "dynamic",
+    **options,
 ):
     """
-    Apply dynamic INT8 quantization on the ONNX graph for CPU inference.
+    Quantize the ONNX graph for CPU inference. `mode` is "dynamic" (INT8
+    weights, activation scales computed per call), "static" (INT8 calibrated
+    on validation prompts) or "int4" (block-wise 4-bit weight-only
+    MatMulNBits); `options` go to the quantization.py function of that mode.
+    Dynamic mode takes an onnxruntime.quantization.QuantType `weight_type`
+    (QInt8 by default).
     """
+    if mode == "static":
+        from quantization import quantize_static_int8
+
+        return quantize_static_int8(onnx_dir, quant_dir, **options)
+    if mode == "int4":
+        from quantization import quantize_int4
+
+        return quantize_int4(onnx_dir, quant_dir, **options)
+    if mode != "dynamic":
+        raise ValueError(f"Unknown quantization mode {mode!r}; expected 'dynamic', 'static' or 'int4'")
+
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
     input_path = os.path.join(onnx_dir, "model.onnx")
     output_path = os.path.join(quant_dir, "model.onnx")
     Path(quant_dir).mkdir(parents=True, exist_ok=True)
@@ -122,17 +345,91 @@ def quantize_onnx(
     quantize_dynamic(
         model_input=input_path,
         model_output=output_path,
-        weight_type=weight_type,
+        weight_type=weight_type or QuantType.QInt8,
     )
     print(f"Quantized ONNX (INT8) model written to {quant_dir}")
     return quant_dir
 
 
+def tiny_mistral(config_dir: str = "./onnx-model", seed: int = 0):
+    """Randomly initialised Mistral with the real config's shape ratios (GQA, vocab) but tiny dimensions"""
+    import torch
+    from transformers import MistralConfig, MistralForCausalLM
+
+    config = MistralConfig.from_pretrained(config_dir)
+    # The saved config describes the 4-bit training setup; the tiny model is plain float32
+    del config.quantization_config
+    heads_per_kv = config.num_attention_heads // config.num_key_value_heads
+    config.update({
+        "hidden_size": 64,
+        "intermediate_size": 128,
+        "num_hidden_layers": 2,
+        "num_key_value_heads": 2,
+        "num_attention_heads": 2 * heads_per_kv,
+        "head_dim": 64 // (2 * heads_per_kv),
+        "torch_dtype": "float32",
+    })
+    torch.manual_seed(seed)
+    return MistralForCausalLM(config).eval()
+
+
+def verify_kv_export(work_dir: str = "./onnx-tiny", max_new_tokens: int = 24, atol: float = 1e-3):
+    """
+    Export a tiny random Mistral with the KV cache, decode a left-padded batch
+    of prompts greedily through onnxruntime, and check every step's logits and
+    tokens against the uncached PyTorch forward over the full sequence.
+    """
+    import numpy as np
+    import torch
+
+    from onnx_generation import OnnxGenerator, position_ids_for
+    from token_cache import load_tokenizer
+
+    model = tiny_mistral()
+    tokenizer = load_tokenizer()
+    prompts = [
+        tokenizer.encode("Title: Dutch Girl in White\nArtist: Robert Henri\n\nAudio guide:").ids,
+        tokenizer.encode("Title: The Harvesters\nAudio guide:").ids,
+    ]
+
+    Path(work_dir).mkdir(parents=True, exist_ok=True)
+    export_with_past(model, os.path.join(work_dir, "model.onnx"), torch.tensor([prompts[0]]))
+    generator = OnnxGenerator(work_dir)
+    tokens, scores = generator.generate(prompts, max_new_tokens=max_new_tokens, eos_token_id=-1,
+                                        pad_token_id=2, output_scores=True)
+
+    worst = 0.0
+    with torch.no_grad():
+        for step, step_scores in enumerate(scores):
+            sequences = [prompt + generated[:step] for prompt, generated in zip(prompts, tokens)]
+            width = max(len(sequence) for sequence in sequences)
+            input_ids = torch.full((len(sequences), width), 2, dtype=torch.int64)
+            attention_mask = torch.zeros((len(sequences), width), dtype=torch.int64)
+            for row, sequence in enumerate(sequences):
+                input_ids[row, width - len(sequence):] = torch.tensor(sequence)
+                attention_mask[row, width - len(sequence):] = 1
+            position_ids = torch.from_numpy(position_ids_for(attention_mask.numpy(), width))
+            reference = model(input_ids=input_ids, attention_mask=attention_mask,
+                              position_ids=position_ids).logits[:, -1].numpy()
+            worst = max(worst, float(np.abs(reference - step_scores).max()))
+            assert (reference.argmax(axis=1) == [generated[step] for generated in tokens]).all(), step
+
+    assert worst < atol, worst
+    print(f"KV-cache export matches the uncached forward over {len(scores)} steps (max |dlogit| {worst:.2e})")
+    return worst
+
+
 if __name__ == "__main__":
+    import sys
+
+    if "--verify-kv" in sys.argv:
+        verify_kv_export()
+        sys.exit(0)
+
     BASE     = "mistralai/Mistral-7B-Instruct-v0.3"
     ADAPTERS = "./trained-models/paintings-audio-guide-final"
 
-    merged_fp16 = merge_lora(BASE, ADAPTERS)
+    merged_fp16 = merge_lora(BASE, ADAPTERS, streaming=True)
     onnx_fp16   = export_to_onnx(merged_fp16)
     onnx_int8   = quantize_onnx(onnx_fp16)
 
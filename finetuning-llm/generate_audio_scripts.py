@@ -1,6 +1,17 @@
 import json
+import os
 import random
-from typing import List, Dict
+import shutil
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import chain, islice
+from string import Formatter
+from typing import Callable, List, Dict, Iterable, Iterator, Optional, Tuple
+
+from instrumentation import span
+from storage import iter_records, write_records
 
 def create_seed_scripts() -> List[Dict]:
     """Hand-crafted high-quality examples covering different categories"""
@@ -129,10 +140,10 @@ def create_seed_scripts() -> List[Dict]:
     
     return seed_scripts
 
-def save_seed_scripts():
+def save_seed_scripts(path: str = 'raw-data/seed_scripts.json'):
     """Save seed scripts for reference"""
     seeds = create_seed_scripts()
-    with open('raw-data/seed_scripts.json', 'w') as f:
+    with open(path, 'w') as f:
         json.dump(seeds, f, indent=2)
     print(f"Saved {len(seeds)} seed scripts")
     return seeds
@@ -182,128 +193,307 @@ def create_script_templates() -> List[str]:
     
     return templates
 
-def generate_script_variations(painting: Dict, templates: List[str]) -> List[str]:
-    """Generate multiple script variations for a single painting"""
+# Content pools for variation
+OPENINGS = ['Meet', 'Step into', 'Enter', 'Discover', 'Experience', 'Admire']
+TECHNIQUES = ['masterful brushwork', 'bold composition', 'subtle gradations', 'dynamic energy', 'refined technique']
+VISUAL_ELEMENTS = ['color harmony', 'dramatic lighting', 'expressive lines', 'textural richness', 'spatial depth']
+CONTEXTS = ['artistic innovation', 'cultural significance', 'historical importance', 'technical mastery', 'emotional resonance']
+
+# How each template slot is filled from the painting fields `p` and a random generator `rng`
+SLOT_GENERATORS: Dict[str, Callable[[Dict, random.Random], str]] = {
+    'opening': lambda p, rng: rng.choice(OPENINGS),
+    'title': lambda p, rng: p['title'],
+    'artist': lambda p, rng: p['artist'],
+    'date': lambda p, rng: p['date'],
+    'medium': lambda p, rng: p['medium'],
+    'dimensions': lambda p, rng: p['dimensions'],
+    'technique_description': lambda p, rng: rng.choice(TECHNIQUES),
+    'visual_element': lambda p, rng: rng.choice(VISUAL_ELEMENTS),
+    'emotional_impact': lambda p, rng: rng.choice(CONTEXTS),
+    'artist_context': lambda p, rng: f"{p['artist']}'s distinctive style",
+    'historical_context': lambda p, rng: f"the world of {p['date']}",
+    'technique_focus': lambda p, rng: f"showcases {rng.choice(TECHNIQUES)}",
+    'visual_technique': lambda p, rng: f"{rng.choice(VISUAL_ELEMENTS)} creates depth",
+    'composition_note': lambda p, rng: f"the {rng.choice(['balanced', 'dynamic', 'harmonious'])} composition",
+    'viewer_experience': lambda p, rng: "invites close contemplation",
+    'art_movement': lambda p, rng: "influential",
+    'style_description': lambda p, rng: f"The {rng.choice(['bold', 'subtle', 'masterful'])} approach",
+    'scale_impact': lambda p, rng: f"The {p['dimensions']} scale enhances the impact",
+    'technical_mastery': lambda p, rng: f"{p['artist']}'s {rng.choice(TECHNIQUES)} is evident throughout",
+    'emotional_connection': lambda p, rng: "creating an immediate emotional connection",
+    'technique_specialty': lambda p, rng: rng.choice(TECHNIQUES),
+    'technical_details': lambda p, rng: f"the {rng.choice(VISUAL_ELEMENTS)} demonstrates skill",
+    'visual_impact': lambda p, rng: f"Notice the {rng.choice(['interplay of light and shadow', 'careful attention to detail', 'bold use of color'])}",
+    'cultural_significance': lambda p, rng: "reflecting the artistic values of its time",
+    'scale_description': lambda p, rng: "transforms your viewing experience",
+    'artistic_approach': lambda p, rng: f"{p['medium']} allows {p['artist']} to",
+    'viewer_relationship': lambda p, rng: "places you in direct dialogue with the work",
+    'lasting_impression': lambda p, rng: "leaving a memorable impression",
+}
+
+@lru_cache(maxsize=8192)
+def _word_stats(text: str) -> Tuple[int, bool, bool]:
+    """(word count, starts with a word character, ends with a word character)"""
+    return len(text.split()), bool(text) and not text[0].isspace(), bool(text) and not text[-1].isspace()
+
+class TemplateRenderer:
+    """A script template pre-parsed into literal text and the slots it references.
     
-    # Extract painting info
-    title = painting['title']
-    artist = painting['artist'] 
-    date = painting['date']
-    medium = painting['medium']
-    dimensions = painting.get('dimensions', 'canvas')
+    Rendering fills only those slots, and the word count of the result is
+    derived from precomputed literal word counts plus per-slot counts instead
+    of re-splitting the script.
+    """
+    
+    def __init__(self, template: str):
+        self.template = template
+        pieces = []  # str literals, or slot names wrapped in a 1-tuple
+        for literal, field, spec, conversion in Formatter().parse(template):
+            if literal:
+                pieces.append(literal)
+            if field is not None:
+                if spec or conversion:
+                    raise ValueError(f"Unsupported format spec in template slot {{{field}}}")
+                pieces.append((field,))
+        
+        self.slots = tuple(dict.fromkeys(piece[0] for piece in pieces if isinstance(piece, tuple)))
+        self.missing_slots = [slot for slot in self.slots if slot not in SLOT_GENERATORS]
+        self._literal_words = 0
+        # Per slot occurrence: (slot, literal before ends in a word, literal after starts with one)
+        self._occurrences = []
+        self._simple = True
+        for k, piece in enumerate(pieces):
+            if isinstance(piece, str):
+                words, starts_word, ends_word = _word_stats(piece)
+                self._literal_words += words
+                # Adjacent literals only arise around slots, which are handled below
+                continue
+            before = pieces[k - 1] if k > 0 else ''
+            after = pieces[k + 1] if k + 1 < len(pieces) else ''
+            if isinstance(before, tuple) or isinstance(after, tuple):
+                self._simple = False
+            else:
+                self._occurrences.append((piece[0], _word_stats(before)[2], _word_stats(after)[1]))
+        self._pieces = pieces
     
-    # Content pools for variation
-    openings = ['Meet', 'Step into', 'Enter', 'Discover', 'Experience', 'Admire']
-    techniques = ['masterful brushwork', 'bold composition', 'subtle gradations', 'dynamic energy', 'refined technique']
-    visual_elements = ['color harmony', 'dramatic lighting', 'expressive lines', 'textural richness', 'spatial depth']
-    contexts = ['artistic innovation', 'cultural significance', 'historical importance', 'technical mastery', 'emotional resonance']
+    def render(self, painting: Dict, rng: random.Random) -> Tuple[str, int]:
+        """Fill the template for one painting; returns (script, word count)"""
+        values = {slot: SLOT_GENERATORS[slot](painting, rng) for slot in self.slots}
+        script = self.template.format_map(values)
+        if not self._simple:
+            return script, len(script.split())
+        
+        # Words split across a literal and a slot ("{artist}'s") are counted once
+        word_count = self._literal_words
+        for slot, before_ends_word, after_starts_word in self._occurrences:
+            value = values[slot]
+            if value:
+                words, starts_word, ends_word = _word_stats(value)
+                word_count += words - (before_ends_word and starts_word) - (ends_word and after_starts_word)
+            else:
+                word_count -= before_ends_word and after_starts_word
+        return script, word_count
+
+@lru_cache(maxsize=None)
+def compile_template(template: str) -> TemplateRenderer:
+    return TemplateRenderer(template)
+
+def painting_rng(painting: Dict, seed: int = 0) -> random.Random:
+    """Random generator seeded from the painting identity, independent of processing order"""
+    key = painting.get('met_id')
+    if key is None:
+        key = f"{painting.get('title')}|{painting.get('artist')}|{painting.get('date')}"
+    return random.Random(f"{seed}:{key}")
+
+def generate_script_variations(painting: Dict, templates: List, rng: Optional[random.Random] = None,
+                               variants: int = 2) -> List[str]:
+    """Generate multiple script variations for a single painting.
+    
+    `templates` may be template strings or TemplateRenderers; pass `rng`
+    (e.g. from painting_rng) for reproducible output. Up to `variants`
+    distinct templates are tried.
+    """
+    rng = rng or random  # module-level functions share the global generator
+    renderers = [t if isinstance(t, TemplateRenderer) else compile_template(t) for t in templates]
+    
+    # Extract painting info
+    fields = {
+        'title': painting['title'],
+        'artist': painting['artist'],
+        'date': painting['date'],
+        'medium': painting['medium'],
+        'dimensions': painting.get('dimensions', 'canvas'),
+    }
     
     variations = []
     
     # Generate 2-3 variations per painting using different templates
-    for template in random.sample(templates, min(2, len(templates))):
-        try:
-            script = template.format(
-                opening=random.choice(openings),
-                title=title,
-                artist=artist,
-                date=date,
-                medium=medium, 
-                dimensions=dimensions,
-                technique_description=random.choice(techniques),
-                visual_element=random.choice(visual_elements),
-                emotional_impact=random.choice(contexts),
-                artist_context=f"{artist}'s distinctive style",
-                historical_context=f"the world of {date}",
-                technique_focus=f"showcases {random.choice(techniques)}",
-                visual_technique=f"{random.choice(visual_elements)} creates depth",
-                composition_note=f"the {random.choice(['balanced', 'dynamic', 'harmonious'])} composition",
-                viewer_experience="invites close contemplation",
-                art_movement="influential", 
-                style_description=f"The {random.choice(['bold', 'subtle', 'masterful'])} approach",
-                scale_impact=f"The {dimensions} scale enhances the impact",
-                technical_mastery=f"{artist}'s {random.choice(techniques)} is evident throughout",
-                emotional_connection="creating an immediate emotional connection",
-                technique_specialty=random.choice(techniques),
-                technical_details=f"the {random.choice(visual_elements)} demonstrates skill",
-                visual_impact=f"Notice the {random.choice(['interplay of light and shadow', 'careful attention to detail', 'bold use of color'])}",
-                cultural_significance="reflecting the artistic values of its time",
-                scale_description=f"transforms your viewing experience",
-                artistic_approach=f"{medium} allows {artist} to",
-                viewer_relationship="places you in direct dialogue with the work",
-                lasting_impression="leaving a memorable impression"
-            )
-            
-            # Clean up and ensure reasonable length (60-100 words)
-            script = script.replace('  ', ' ').strip()
-            word_count = len(script.split())
-            
-            if 50 <= word_count <= 120:  # Allow some flexibility
-                variations.append(script)
-                
-        except KeyError as e:
+    for renderer in rng.sample(renderers, min(variants, len(renderers))):
+        if renderer.missing_slots:
             continue  # Skip templates that don't work with this painting
+        
+        script, word_count = renderer.render(fields, rng)
+        
+        # Clean up and ensure reasonable length (60-100 words)
+        if 50 <= word_count <= 120:  # Allow some flexibility
+            variations.append(script.replace('  ', ' ').strip())
     
     return variations
 
-def create_bulk_training_data():
-    """Generate training data from all paintings using templates"""
-    
-    # Load paintings and seeds
-    with open('raw-data/met_paintings_formatted.json', 'r') as f:
-        paintings = json.load(f)
-    
-    seeds = create_seed_scripts()
-    templates = create_script_templates()
-    
-    training_examples = []
-    
-    # Add seed scripts first (high quality)
-    for seed in seeds:
-        prompt = f"Title: {seed['title']}\nArtist: {seed['artist']}\nDate: {seed['date']}\nMedium: {seed['medium']}\nDimensions: {seed['dimensions']}\n\nAudio guide:"
-        completion = f" {seed['script']} <END>"
+def seed_training_examples() -> Iterator[Dict]:
+    """Hand-crafted seed scripts as prompt/completion pairs"""
+    for seed_script in create_seed_scripts():
+        prompt = f"Title: {seed_script['title']}\nArtist: {seed_script['artist']}\nDate: {seed_script['date']}\nMedium: {seed_script['medium']}\nDimensions: {seed_script['dimensions']}\n\nAudio guide:"
+        completion = f" {seed_script['script']} <END>"
         
-        training_examples.append({
+        yield {
             "prompt": prompt,
             "completion": completion
-        })
-    
-    # # Generate variations for subset of paintings (start with 200-300)
-    # selected_paintings = random.sample(paintings, min(300, len(paintings)))
+        }
+
+def painting_training_examples(paintings: Iterable[Dict], templates: List, seed: int = 0,
+                               variants: int = 2) -> Iterator[Dict]:
+    """Template variations for each painting, each from its own seeded generator"""
+    renderers = [compile_template(t) if isinstance(t, str) else t for t in templates]
     
     for painting in paintings:
-        variations = generate_script_variations(painting, templates)
+        variations = generate_script_variations(painting, renderers, painting_rng(painting, seed), variants)
         
         for script in variations:
             prompt = f"Title: {painting['title']}\nArtist: {painting['artist']}\nDate: {painting['date']}\nMedium: {painting['medium']}\nDimensions: {painting.get('dimensions', 'Not specified')}\n\nAudio guide:"
             completion = f" {script} <END>"
             
-            training_examples.append({
+            yield {
                 "prompt": prompt, 
                 "completion": completion
-            })
+            }
+
+def iter_training_examples(paintings: Iterable[Dict], templates: List[str], seed: int = 0,
+                           variants: int = 2) -> Iterator[Dict]:
+    """Seed scripts first (high quality), then template variations for each painting"""
     
-    # Save training data
-    output_file = 'raw-data/training_examples_bulk.json'
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(training_examples, f, indent=2, ensure_ascii=False)
+    yield from seed_training_examples()
+    
+    # # Generate variations for subset of paintings (start with 200-300)
+    # selected_paintings = random.sample(paintings, min(300, len(paintings)))
+    
+    yield from painting_training_examples(paintings, templates, seed, variants)
+
+# Painting fields read by the generator; columnar sources decode only these
+TRAINING_FIELDS = ['met_id', 'title', 'artist', 'date', 'medium', 'dimensions']
+
+def _generate_shard(shard_file: str, paintings: List[Dict], templates: List[str], seed: int, variants: int) -> int:
+    """Worker: write one shard of painting variations as JSONL"""
+    return write_records(shard_file, painting_training_examples(paintings, templates, seed, variants),
+                         ensure_ascii=False)
+
+def _chunks(records: Iterable[Dict], size: int) -> Iterator[List[Dict]]:
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def generate_sharded(paintings: Iterable[Dict], templates: List[str], shard_dir: str, seed: int = 0,
+                     variants: int = 2, workers: Optional[int] = None, shard_size: int = 500) -> List[str]:
+    """Generate variations for fixed-size shards of paintings across a process pool.
+    
+    Shard boundaries depend only on `shard_size`, and each painting draws from
+    a generator seeded by its met_id, so shard contents are identical for any
+    worker count. Returns the shard files in order.
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    shard_files = []
     
-    print(f"Generated {len(training_examples)} training examples:")
-    print(f"- {len(seeds)} high-quality seed scripts")
-    print(f"- {len(training_examples) - len(seeds)} template-generated variations")
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        in_flight = deque()
+        for index, chunk in enumerate(_chunks(paintings, shard_size)):
+            shard_file = os.path.join(shard_dir, f"examples-{index:05d}.jsonl")
+            shard_files.append(shard_file)
+            in_flight.append(pool.submit(_generate_shard, shard_file, chunk, templates, seed, variants))
+            # Bound the paintings held in memory to a few shards per worker
+            if len(in_flight) >= 2 * workers:
+                in_flight.popleft().result()
+        while in_flight:
+            in_flight.popleft().result()
+    
+    return shard_files
+
+def merge_shards(output_file: str, shard_files: List[str]) -> int:
+    """Write seed examples followed by the shards, in order; returns the example count"""
+    if not output_file.endswith('.jsonl'):
+        examples = chain(seed_training_examples(), chain.from_iterable(iter_records(f) for f in shard_files))
+        return write_records(output_file, examples, ensure_ascii=False)
+    
+    # Shards are already JSONL in the output encoding, so append their bytes directly
+    count = write_records(output_file, seed_training_examples(), ensure_ascii=False)
+    with open(output_file, 'ab') as out:
+        for shard_file in shard_files:
+            with open(shard_file, 'rb') as shard:
+                for line in shard:
+                    out.write(line)
+                    count += 1
+    return count
+
+def create_bulk_training_data(formatted_file: str = 'raw-data/met_paintings_formatted.json',
+                              output_file: str = 'raw-data/training_examples_bulk.json',
+                              seed: int = 0,
+                              variants: int = 2,
+                              workers: Optional[int] = None,
+                              shard_size: int = 500) -> int:
+    """Generate training data from all paintings using templates.
+    
+    Paintings are streamed from `formatted_file` and examples streamed to
+    `output_file`; either can be .json, .jsonl or .parquet. Each painting's
+    variations come from a generator seeded by `seed` and its met_id, so the
+    same seed reproduces the same output. With `workers`, paintings are
+    generated in shards across a process pool (see generate_sharded) and
+    merged in shard order; the output is byte-identical to the serial run.
+    """
+    
+    # Load paintings and seeds
+    paintings = iter_records(formatted_file, columns=TRAINING_FIELDS)
+    
+    num_seeds = len(create_seed_scripts())
+    templates = create_script_templates()
+    
+    with span('templates', workers=workers or 1) as s:
+        if workers:
+            shard_dir = f"{os.path.splitext(output_file)[0]}-shards"
+            shard_files = generate_sharded(paintings, templates, shard_dir, seed, variants, workers, shard_size)
+            count = merge_shards(output_file, shard_files)
+            shutil.rmtree(shard_dir)
+        else:
+            # Save training data
+            count = write_records(output_file, iter_training_examples(paintings, templates, seed, variants),
+                                  ensure_ascii=False)
+        s.add(count)
+    
+    print(f"Generated {count} training examples:")
+    print(f"- {num_seeds} high-quality seed scripts")
+    print(f"- {count - num_seeds} template-generated variations")
     print(f"Saved to {output_file}")
     
-    return training_examples
+    return count
 
 if __name__ == "__main__":
     # Create seed scripts
     seeds = save_seed_scripts()
     
     # Generate bulk training data
-    training_data = create_bulk_training_data()
+    output_file = 'raw-data/training_examples_bulk.json'
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    count = create_bulk_training_data(output_file=output_file, workers=workers)
+    
+    # Drop near-duplicate completions before the train/val split
+    from dedup import deduplicate_training_file
+    deduplicate_training_file(output_file, 'raw-data/training_examples_dedup.json')
     
     # Show sample
     print("\nSample training example:")
-    sample = random.choice(training_data)
+    sample = next(islice(iter_records(output_file), random.randrange(count), None))
     print("PROMPT:", sample['prompt'][:100] + "...")
     print("COMPLETION:", sample['completion'][:100] + "...")
\ No newline at end of file
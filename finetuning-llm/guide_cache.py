@@ -0,0 +1,252 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional
+
+from clean_unicode import smart_clean_text
+from storage import iter_records
+
+PROMPT_FIELDS = ['title', 'artist', 'date', 'medium', 'dimensions']
+DEFAULT_PARAMS = {'max_new_tokens': 100, 'temperature': 0.0, 'repetition_penalty': 1.1}
+
+
+def normalized_fields(painting: Dict) -> Dict[str, str]:
+    """The prompt fields after smart_clean_text, with the prompt's 'Not specified' default for dimensions"""
+    fields = {}
+    for field in PROMPT_FIELDS:
+        value = painting.get(field)
+        if field == 'dimensions' and not value:
+            value = 'Not specified'
+        fields[field] = smart_clean_text(value if isinstance(value, str) else str(value or ''))
+    return fields
+
+
+def model_fingerprint(model_dir: str = 'onnx-model', files: Optional[List[str]] = None,
+                      chunk_size: int = 1 << 20) -> str:
+    """sha256 over the model artifact files (ONNX graphs, external weight data and tokenizer.json by default).
+
+    Digests are remembered in `<model_dir>/.fingerprints.json` against each
+    file's size and mtime, so multi-GB weights are only re-hashed after they change.
+    """
+    if files is None:
+        files = sorted(name for name in os.listdir(model_dir)
+                       if name.endswith(('.onnx', '.data', '.onnx_data')) or name == 'tokenizer.json')
+    memo_file = os.path.join(model_dir, '.fingerprints.json')
+    try:
+        with open(memo_file, 'r') as f:
+            memo = json.load(f)
+    except (OSError, ValueError):
+        memo = {}
+
+    digest = hashlib.sha256()
+    changed = False
+    for name in files:
+        stat = os.stat(os.path.join(model_dir, name))
+        stamp = f"{stat.st_size}:{stat.st_mtime_ns}"
+        entry = memo.get(name)
+        if not entry or entry['stamp'] != stamp:
+            file_digest = hashlib.sha256()
+            with open(os.path.join(model_dir, name), 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    file_digest.update(chunk)
+            entry = memo[name] = {'stamp': stamp, 'sha256': file_digest.hexdigest()}
+            changed = True
+        digest.update(name.encode())
+        digest.update(entry['sha256'].encode())
+
+    if changed:
+        try:
+            with open(memo_file, 'w') as f:
+                json.dump(memo, f, indent=2)
+        except OSError:
+            pass
+    return digest.hexdigest()
+
+
+class GuideCache:
+    """Generated guides keyed by normalised painting fields, model version and decoding parameters.
+
+    Guides live in a single SQLite file with a bounded in-memory LRU in
+    front of it. The key hashes the smart_clean_text-normalised prompt
+    fields, `model_version` (e.g. `model_fingerprint()`) and the decoding
+    parameters, so a different model or setting never serves a stale guide.
+    Rows of other versions are kept (several processes may share the file
+    with different artifacts) unless `prune` is set, which deletes every row
+    not generated by `model_version`.
+    """
+
+    def __init__(self, path: str = 'processed-data/guide-cache.sqlite', model_version: Optional[str] = None,
+                 memory_entries: int = 1024, prune: bool = False):
+        self.path = path
+        self.model_version = model_version or ''
+        self.memory_entries = memory_entries
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'stored': 0, 'invalidated': 0}
+        self._memory: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('''CREATE TABLE IF NOT EXISTS guides (
+            key TEXT PRIMARY KEY,
+            model_version TEXT NOT NULL,
+            params TEXT NOT NULL,
+            title TEXT,
+            artist TEXT,
+            guide TEXT NOT NULL,
+            created REAL NOT NULL
+        )''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS guides_model_version ON guides (model_version)')
+        self._db.commit()
+        if prune and model_version is not None:
+            self.invalidate(keep_version=model_version)
+
+    def key(self, painting: Dict, params: Optional[Dict] = None) -> str:
+        payload = json.dumps({
+            'fields': normalized_fields(painting),
+            'model': self.model_version,
+            'params': params or DEFAULT_PARAMS,
+        }, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, painting: Dict, params: Optional[Dict] = None) -> Optional[str]:
+        key = self.key(painting, params)
+        with self._lock:
+            guide = self._memory.get(key)
+            if guide is not None:
+                self._memory.move_to_end(key)
+                self.stats['memory_hits'] += 1
+                return guide
+            row = self._db.execute('SELECT guide FROM guides WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['disk_hits'] += 1
+            self._remember(key, row[0])
+            return row[0]
+
+    def put(self, painting: Dict, guide: str, params: Optional[Dict] = None):
+        self.put_many([(painting, guide)], params)
+
+    def put_many(self, items: Iterable, params: Optional[Dict] = None):
+        """Store (painting, guide) pairs in one transaction"""
+        now = time.time()
+        params_json = json.dumps(params or DEFAULT_PARAMS, sort_keys=True)
+        rows = []
+        for painting, guide in items:
+            key = self.key(painting, params)
+            rows.append((key, self.model_version, params_json, painting.get('title'), painting.get('artist'),
+                         guide, now))
+        with self._lock:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO guides (key, model_version, params, title, artist, guide, created) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)', rows
+            )
+            self._db.commit()
+            for row in rows:
+                self._remember(row[0], row[5])
+            self.stats['stored'] += len(rows)
+
+    def get_or_generate(self, painting: Dict, generate: Callable[[Dict], str], params: Optional[Dict] = None) -> str:
+        guide = self.get(painting, params)
+        if guide is None:
+            guide = generate(painting)
+            self.put(painting, guide, params)
+        return guide
+
+    def warm_up(self, generate_batch: Callable[[List[Dict]], List[str]],
+                formatted_file: str = 'raw-data/met_paintings_formatted.json',
+                params: Optional[Dict] = None, batch_size: int = 8, limit: Optional[int] = None) -> Dict[str, int]:
+        """Generate and store guides for every painting in `formatted_file` that is not cached yet.
+
+        `generate_batch` maps a list of paintings to their guides (for example
+        `onnx_generation.generate_guides` bound to a generator and tokenizer).
+        Each batch is committed as it completes, so an interrupted warm-up
+        resumes where it stopped.
+        """
+        report = {'paintings': 0, 'cached': 0, 'generated': 0}
+        pending: List[Dict] = []
+        seen = set()
+
+        def flush():
+            guides = generate_batch(pending)
+            self.put_many(zip(pending, guides), params)
+            report['generated'] += len(pending)
+            pending.clear()
+
+        for painting in iter_records(formatted_file, columns=PROMPT_FIELDS):
+            if limit is not None and report['paintings'] >= limit:
+                break
+            report['paintings'] += 1
+            key = self.key(painting, params)
+            if key in seen or self.contains(key):
+                report['cached'] += 1
+                continue
+            seen.add(key)
+            pending.append(painting)
+            if len(pending) >= batch_size:
+                flush()
+        if pending:
+            flush()
+        print(f"Guide cache warm-up: {report['paintings']} paintings, {report['cached']} already cached, "
+              f"{report['generated']} generated")
+        return report
+
+    def contains(self, key: str) -> bool:
+        with self._lock:
+            if key in self._memory:
+                return True
+            return self._db.execute('SELECT 1 FROM guides WHERE key = ?', (key,)).fetchone() is not None
+
+    def invalidate(self, keep_version: Optional[str] = None) -> int:
+        """Delete every guide (or every guide not generated by `keep_version`); returns the rows removed"""
+        with self._lock:
+            if keep_version is None:
+                cursor = self._db.execute('DELETE FROM guides')
+            else:
+                cursor = self._db.execute('DELETE FROM guides WHERE model_version != ?', (keep_version,))
+            self._db.commit()
+            self._memory.clear()
+            self.stats['invalidated'] += cursor.rowcount
+            return cursor.rowcount
+
+    def _remember(self, key: str, guide: str):
+        self._memory[key] = guide
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM guides').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def open_guide_cache(model_dir: str = 'onnx-model', path: str = 'processed-data/guide-cache.sqlite',
+                     memory_entries: int = 1024, prune: bool = False) -> GuideCache:
+    """Guide cache bound to the current model artifact; with `prune`, guides of other artifacts are dropped"""
+    return GuideCache(path, model_fingerprint(model_dir), memory_entries, prune=prune)
+
+
+if __name__ == "__main__":
+    import sys
+    from functools import partial
+
+    from onnx_generation import OnnxGenerator, generate_guides
+    from token_cache import load_tokenizer
+
+    args = [arg for arg in sys.argv[1:] if arg != '--prune']
+    limit = int(args[0]) if args else None
+    cache = open_guide_cache(prune='--prune' in sys.argv)
+    if cache.stats['invalidated']:
+        print(f"Pruned {cache.stats['invalidated']} guides of other model versions")
+    generator = OnnxGenerator('onnx-model')
+    tokenizer = load_tokenizer('onnx-model')
+    cache.warm_up(partial(generate_guides, generator, tokenizer, **DEFAULT_PARAMS), limit=limit)
+    print(f"{len(cache)} guides cached in {cache.path}")
@@ -0,0 +1,541 @@
+"""Micro-batching HTTP inference service for audio guides over the exported ONNX model.
+
+Requests are queued; one decode thread takes whatever arrives within
+`max_wait_ms` of the first queued request (up to `max_batch_size`), groups
+it by prompt-length bucket so each batch pads to a similar shape, and
+decodes every group with the KV cache. Each new token is streamed to its
+client as soon as it is produced, and a sequence leaves its batch (its rows
+are dropped from the cache) as soon as it emits EOS or `<END>` instead of
+decoding to the token budget.
+
+Endpoints:
+- POST /generate: {"title", "artist", "date", "medium", "dimensions"} or
+  {"prompt"}, optional "max_new_tokens" and "stream" (default true).
+  Streams NDJSON lines {"text": delta} and a final
+  {"done": true, "guide", "tokens", "stop", "ttft_ms", "latency_ms"}
+- GET /metrics: queue depth, batch sizes, stop reasons, latencies
+- GET /metrics/prometheus: the instrumentation registry (spans, TTFT and
+  latency histograms) in Prometheus text format; empty unless metrics are
+  enabled with PAINTINGS_METRICS
+- GET /health
+
+With a guide cache (`--cache`), painting requests are answered from the
+cache when the same normalised fields, model and decoding parameters were
+generated before, and new guides are stored once they finish.
+"""
+
+import argparse
+import json
+import queue
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from cold_start import open_generator
+from guide_cache import GuideCache, model_fingerprint
+from instrumentation import count, observe, prometheus_text
+from onnx_generation import OnnxGenerator, choose_tokens, guide_prompt, left_pad
+from token_cache import load_tokenizer
+
+END_MARKER = "<END>"
+
+
+class StopStreamer:
+    """Incremental detokenizer that stops at `<END>` and never streams part of the marker"""
+
+    def __init__(self, tokenizer, stop_text: str = END_MARKER):
+        self.tokenizer = tokenizer
+        self.stop_text = stop_text
+        self.tokens: List[int] = []
+        self.sent = 0
+        self.text = ""
+
+    def push(self, token: int) -> Tuple[str, bool]:
+        """(text safe to stream now, whether the stop marker was reached)"""
+        self.tokens.append(token)
+        text = self.tokenizer.decode(self.tokens, skip_special_tokens=True)
+        end = text.find(self.stop_text)
+        if end >= 0:
+            self.text = text[:end].rstrip()
+            return self._advance(len(self.text)), True
+        self.text = text
+        # Hold back a tail that could still become the stop marker, and the whitespace before it
+        held = next((n for n in range(min(len(self.stop_text) - 1, len(text)), 0, -1)
+                     if self.stop_text.startswith(text[-n:])), 0)
+        return self._advance(len(text[:len(text) - held].rstrip())), False
+
+    def flush(self) -> str:
+        return self._advance(len(self.text))
+
+    def _advance(self, upto: int) -> str:
+        delta = self.text[self.sent:upto] if upto > self.sent else ""
+        self.sent = max(self.sent, upto)
+        return delta
+
+
+class GuideRequest:
+    """One queued generation; the HTTP handler reads its `events` queue"""
+
+    def __init__(self, prompt_ids: List[int], max_new_tokens: int, streamer: StopStreamer, eos_ids: set):
+        self.prompt_ids = prompt_ids
+        self.max_new_tokens = max_new_tokens
+        self.streamer = streamer
+        self.eos_ids = eos_ids
+        self.events: "queue.Queue[Dict]" = queue.Queue()
+        self.created = time.perf_counter()
+        self.first_token_at: Optional[float] = None
+        self.generated = 0
+        self.cancelled = False
+        self.result: Optional[Dict] = None
+
+    def push(self, token: int) -> Optional[str]:
+        """Consume one generated token; returns the stop reason once the sequence is finished"""
+        if self.cancelled:
+            return 'cancelled'
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        if token in self.eos_ids:
+            return self.finish('eos')
+        self.generated += 1
+        delta, stopped = self.streamer.push(token)
+        if delta:
+            self.events.put({'text': delta})
+        if stopped:
+            return self.finish('end')
+        if self.generated >= self.max_new_tokens:
+            return self.finish('length')
+        return None
+
+    def finish(self, reason: str) -> str:
+        delta = self.streamer.flush()
+        if delta:
+            self.events.put({'text': delta})
+        now = time.perf_counter()
+        self.result = {
+            'done': True,
+            'guide': self.streamer.text.strip(),
+            'tokens': self.generated,
+            'stop': reason,
+            'ttft_ms': round(((self.first_token_at or now) - self.created) * 1000, 2),
+            'latency_ms': round((now - self.created) * 1000, 2),
+        }
+        self.events.put(self.result)
+        return reason
+
+
+class ServerMetrics:
+    """Thread-safe counters plus recent latency windows for /metrics"""
+
+    def __init__(self, window: int = 1000):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.batches = 0
+        self.decode_steps = 0
+        self.tokens = 0
+        self.batch_sizes: Counter = Counter()
+        self.stop_reasons: Counter = Counter()
+        self.cache_hits = 0
+        self.ttft_ms = deque(maxlen=window)
+        self.latency_ms = deque(maxlen=window)
+
+    def record_batch(self, size: int):
+        with self.lock:
+            self.batches += 1
+            self.batch_sizes[size] += 1
+
+    def record_step(self, rows: int):
+        with self.lock:
+            self.decode_steps += 1
+            self.tokens += rows
+
+    def record_done(self, event: Dict):
+        count('guide_requests_total', stop=event['stop'])
+        count('guide_tokens_total', event['tokens'])
+        observe('guide_ttft_seconds', event['ttft_ms'] / 1000)
+        observe('guide_latency_seconds', event['latency_ms'] / 1000)
+        with self.lock:
+            self.stop_reasons[event['stop']] += 1
+            self.ttft_ms.append(event['ttft_ms'])
+            self.latency_ms.append(event['latency_ms'])
+
+    def snapshot(self, queue_depth: int, active: int) -> Dict:
+        def percentiles(values):
+            if not values:
+                return {}
+            array = np.asarray(values)
+            return {f"p{p}": round(float(np.percentile(array, p)), 2) for p in (50, 95, 99)}
+
+        with self.lock:
+            batched = sum(size * count for size, count in self.batch_sizes.items())
+            return {
+                'queue_depth': queue_depth,
+                'active_sequences': active,
+                'requests_total': self.requests,
+                'batches_total': self.batches,
+                'mean_batch_size': round(batched / self.batches, 2) if self.batches else 0,
+                'batch_size_histogram': {str(size): count for size, count in sorted(self.batch_sizes.items())},
+                'decode_steps_total': self.decode_steps,
+                'tokens_generated_total': self.tokens,
+                'stop_reasons': dict(self.stop_reasons),
+                'cache_hits_total': self.cache_hits,
+                'ttft_ms': percentiles(self.ttft_ms),
+                'latency_ms': percentiles(self.latency_ms),
+            }
+
+
+class MicroBatcher:
+    """Queue plus decode thread that batches requests arriving within a short window"""
+
+    def __init__(self, generator: OnnxGenerator, tokenizer,
+                 max_batch_size: int = 8,
+                 max_wait_ms: float = 10.0,
+                 bucket_width: int = 16,
+                 max_new_tokens: int = 100,
+                 temperature: float = 0.0,
+                 repetition_penalty: float = 1.1,
+                 seed: Optional[int] = None):
+        self.generator = generator
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.bucket_width = bucket_width
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.repetition_penalty = repetition_penalty
+        self.rng = np.random.default_rng(seed)
+        self.eos_ids = {tokenizer.token_to_id('</s>')}
+        self.pad_token_id = tokenizer.token_to_id('</s>')
+        self.queue: "queue.Queue[GuideRequest]" = queue.Queue()
+        self.metrics = ServerMetrics()
+        self.active = 0
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+
+    def submit(self, prompt: str, max_new_tokens: Optional[int] = None) -> GuideRequest:
+        request = GuideRequest(self.tokenizer.encode(prompt).ids,
+                               min(max_new_tokens or self.max_new_tokens, self.max_new_tokens),
+                               StopStreamer(self.tokenizer), self.eos_ids)
+        with self.metrics.lock:
+            self.metrics.requests += 1
+        self.queue.put(request)
+        return request
+
+    def decoding_params(self, max_new_tokens: Optional[int] = None) -> Dict:
+        """Parameters that determine a guide, as used in guide cache keys"""
+        return {'max_new_tokens': min(max_new_tokens or self.max_new_tokens, self.max_new_tokens),
+                'temperature': self.temperature, 'repetition_penalty': self.repetition_penalty}
+
+    def metrics_snapshot(self) -> Dict:
+        return self.metrics.snapshot(self.queue.qsize(), self.active)
+
+    def _collect(self) -> List[GuideRequest]:
+        """First queued request plus whatever arrives within the wait window"""
+        try:
+            batch = [self.queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stopping.is_set():
+            requests = [request for request in self._collect() if not request.cancelled]
+            groups: Dict[int, List[GuideRequest]] = {}
+            for request in requests:
+                groups.setdefault(len(request.prompt_ids) // self.bucket_width, []).append(request)
+            for group in groups.values():
+                self.metrics.record_batch(len(group))
+                self.active = len(group)
+                try:
+                    self._decode(group)
+                except Exception as error:
+                    for request in group:
+                        request.events.put({'done': True, 'error': str(error), 'stop': 'error'})
+                self.active = 0
+
+    def _decode(self, requests: List[GuideRequest]):
+        generator = self.generator
+        input_ids, attention_mask = left_pad([request.prompt_ids for request in requests], self.pad_token_id)
+        step_ids, past = input_ids, None
+        active = list(requests)
+
+        while active:
+            logits, present = generator.forward(step_ids if generator.has_past else input_ids, attention_mask, past)
+            tokens = choose_tokens(logits[:, -1].astype(np.float32), input_ids, attention_mask,
+                                   self.temperature, self.repetition_penalty, self.rng)
+            self.metrics.record_step(len(active))
+
+            keep = []
+            for row, (request, token) in enumerate(zip(active, tokens)):
+                reason = request.push(int(token))
+                if reason is None:
+                    keep.append(row)
+                elif reason != 'cancelled':
+                    self.metrics.record_done(request.result)
+            if not keep:
+                break
+
+            # Finished sequences leave the batch: drop their rows from ids, mask and cache
+            keep = np.asarray(keep)
+            active = [active[row] for row in keep]
+            self.active = len(active)
+            step_ids = tokens[keep, None].astype(np.int64)
+            input_ids = np.concatenate([input_ids[keep], step_ids], axis=1)
+            attention_mask = np.concatenate([attention_mask[keep], np.ones((len(keep), 1), dtype=np.int64)], axis=1)
+            past = [tensor[keep] for tensor in present] if generator.has_past else None
+
+
+def parse_generate_request(data: bytes) -> Tuple[Dict, str]:
+    """(body, prompt) of a /generate request; ValueError describes what is wrong with it"""
+    body = json.loads(data or b'{}')
+    if not isinstance(body, dict):
+        raise ValueError(f"body must be a JSON object, not {type(body).__name__}")
+    max_new_tokens = body.get('max_new_tokens')
+    if max_new_tokens is not None and (type(max_new_tokens) is not int or max_new_tokens < 1):
+        raise ValueError(f"max_new_tokens must be a positive integer, not {max_new_tokens!r}")
+    if body.get('prompt') is not None:
+        if not isinstance(body['prompt'], str) or not body['prompt']:
+            raise ValueError("prompt must be a non-empty string")
+        return body, body['prompt']
+    try:
+        fields = [body[field] for field in ('title', 'artist', 'date', 'medium')]
+    except KeyError as error:
+        raise ValueError(f"missing painting field {error}") from None
+    return body, guide_prompt(*fields, body.get('dimensions', 'Not specified'))
+
+
+def make_handler(batcher: MicroBatcher, cache: Optional[GuideCache] = None):
+    class GuideHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status: int, payload: Dict):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _write_chunk(self, payload: Dict):
+            data = (json.dumps(payload, ensure_ascii=False) + '\n').encode('utf-8')
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self._send_json(200, batcher.metrics_snapshot())
+            elif self.path == '/metrics/prometheus':
+                body = prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            elif self.path == '/health':
+                self._send_json(200, {'status': 'ok'})
+            else:
+                self._send_json(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/generate':
+                self._send_json(404, {'error': 'not found'})
+                return
+            try:
+                body, prompt = parse_generate_request(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            except ValueError as error:
+                self._send_json(400, {'error': f"expected a prompt or painting fields: {error}"})
+                return
+
+            cacheable = cache is not None and 'prompt' not in body
+            params = batcher.decoding_params(body.get('max_new_tokens'))
+            guide = cache.get(body, params) if cacheable else None
+            if guide is not None:
+                with batcher.metrics.lock:
+                    batcher.metrics.cache_hits += 1
+                self._respond_cached(guide, body.get('stream', True))
+                return
+
+            request = batcher.submit(prompt, body.get('max_new_tokens'))
+            if not body.get('stream', True):
+                while True:
+                    event = request.events.get()
+                    if event.get('done'):
+                        self._store(event, body, params, cacheable)
+                        self._send_json(500 if 'error' in event else 200, event)
+                        return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            try:
+                while True:
+                    event = request.events.get()
+                    if event.get('done'):
+                        self._store(event, body, params, cacheable)
+                    self._write_chunk(event)
+                    if event.get('done'):
+                        break
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                request.cancelled = True
+
+        def _store(self, event: Dict, painting: Dict, params: Dict, cacheable: bool):
+            if cacheable and 'error' not in event and event['stop'] != 'cancelled':
+                cache.put(painting, event['guide'], params)
+
+        def _respond_cached(self, guide: str, stream: bool):
+            event = {'done': True, 'guide': guide, 'tokens': 0, 'stop': 'cache', 'ttft_ms': 0.0, 'latency_ms': 0.0}
+            if not stream:
+                self._send_json(200, event)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            self._write_chunk({'text': guide})
+            self._write_chunk(event)
+            self.wfile.write(b"0\r\n\r\n")
+
+    return GuideHandler
+
+
+def serve(model_dir: str = 'onnx-model', host: str = '127.0.0.1', port: int = 8765,
+          tokenizer_dir: Optional[str] = None, cache_file: Optional[str] = None,
+          **batcher_options) -> Tuple[ThreadingHTTPServer, MicroBatcher]:
+    """Start the batcher and an HTTP server (not yet serving; call serve_forever).
+
+    The session comes from cold_start.open_generator: the cached optimized
+    graph, warmed up on representative shapes before the first request.
+    """
+    generator, phases = open_generator(model_dir)
+    print(f"Model ready: {phases}")
+    batcher = MicroBatcher(generator, load_tokenizer(tokenizer_dir or model_dir), **batcher_options).start()
+    cache = GuideCache(cache_file, model_fingerprint(model_dir)) if cache_file else None
+    server = ThreadingHTTPServer((host, port), make_handler(batcher, cache))
+    server.daemon_threads = True
+    return server, batcher
+
+
+def stream_guide(url: str, painting: Dict, **options) -> Tuple[List[str], Dict]:
+    """Local client: POST a painting and collect the streamed deltas and the final event"""
+    import urllib.request
+
+    request = urllib.request.Request(url, data=json.dumps({**painting, **options}).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'}, method='POST')
+    deltas = []
+    with urllib.request.urlopen(request) as response:
+        for line in response:
+            event = json.loads(line)
+            if event.get('done'):
+                return deltas, event
+            deltas.append(event['text'])
+    raise RuntimeError("stream ended without a final event")
+
+
+def check_tiny_server(clients: int = 6, max_new_tokens: int = 32):
+    """Serve a tiny random Mistral, hit it with concurrent streaming clients and compare with unbatched greedy.
+
+    A repeated painting (with different whitespace) must then come from the guide cache.
+    """
+    import os
+    import tempfile
+    import urllib.request
+    from concurrent.futures import ThreadPoolExecutor
+
+    import torch
+
+    from export_model import export_with_past, tiny_mistral
+    from onnx_generation import generate_guide
+
+    paintings = [
+        {'title': 'Dutch Girl in White', 'artist': 'Robert Henri', 'date': '1907', 'medium': 'Oil on canvas',
+         'dimensions': '24 x 20 in. (61 x 50.8 cm)'},
+        {'title': 'The Harvesters', 'artist': 'Pieter Bruegel the Elder', 'date': '1565', 'medium': 'Oil on wood',
+         'dimensions': '46 7/8 x 63 3/4 in. (119 x 162 cm)'},
+        {'title': 'Wheat Field with Cypresses', 'artist': 'Vincent van Gogh', 'date': '1889',
+         'medium': 'Oil on canvas'},
+    ]
+    paintings = [paintings[i % len(paintings)] for i in range(clients)]
+    tokenizer = load_tokenizer()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        export_with_past(tiny_mistral(), os.path.join(work_dir, 'model.onnx'), torch.tensor([[1, 2, 3]]))
+        server, batcher = serve(work_dir, port=0, tokenizer_dir='onnx-model', max_wait_ms=50,
+                                max_new_tokens=max_new_tokens, cache_file=os.path.join(work_dir, 'guides.sqlite'))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        try:
+            with ThreadPoolExecutor(clients) as pool:
+                results = list(pool.map(lambda p: stream_guide(url + '/generate', p), paintings))
+            # Same painting with different whitespace: served from the guide cache
+            respaced = {**paintings[0], 'title': '  ' + paintings[0]['title'].replace(' ', '  ')}
+            cached_deltas, cached = stream_guide(url + '/generate', respaced)
+            with urllib.request.urlopen(url + '/metrics') as response:
+                metrics = json.load(response)
+        finally:
+            server.shutdown()
+            batcher.stop()
+
+        reference = OnnxGenerator(work_dir)
+        for painting, (deltas, final) in zip(paintings, results):
+            expected = generate_guide(reference, tokenizer, painting, max_new_tokens=max_new_tokens,
+                                      repetition_penalty=1.1)
+            assert ''.join(deltas).strip() == final['guide'] == expected, (final['guide'], expected)
+            assert final['ttft_ms'] <= final['latency_ms']
+        assert cached['stop'] == 'cache' and cached['guide'] == results[0][1]['guide']
+
+    print(f"{clients} streamed guides match unbatched greedy decoding; repeat served from the guide cache")
+    print(json.dumps(metrics, indent=2))
+    return metrics
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-batching audio-guide inference server")
+    parser.add_argument('--model-dir', default='onnx-model')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--max-batch-size', type=int, default=8)
+    parser.add_argument('--max-wait-ms', type=float, default=10.0)
+    parser.add_argument('--max-new-tokens', type=int, default=100)
+    parser.add_argument('--temperature', type=float, default=0.0)
+    parser.add_argument('--cache', default=None, help="guide cache file, e.g. processed-data/guide-cache.sqlite")
+    parser.add_argument('--check', action='store_true', help="serve a tiny random model and test it with local clients")
+    args = parser.parse_args()
+
+    if args.check:
+        check_tiny_server()
+    else:
+        server, batcher = serve(args.model_dir, args.host, args.port, max_batch_size=args.max_batch_size,
+                                max_wait_ms=args.max_wait_ms, max_new_tokens=args.max_new_tokens,
+                                temperature=args.temperature, cache_file=args.cache)
+        print(f"Serving audio guides on http://{args.host}:{args.port} (POST /generate, GET /metrics)")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            batcher.stop()
@@ -0,0 +1,182 @@
+import json
+import os
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from storage import write_records
+
+
+class HarvestCheckpoint:
+    """Append-only JSONL shards of raw Met objects plus a manifest of completed and failed objectIDs.
+
+    Shards are the source of truth: each fetched object is appended (and flushed)
+    before the manifest is updated, and reopening a checkpoint re-reads any shard
+    bytes the manifest has not seen yet. A crash therefore loses at most the
+    object being written.
+    """
+
+    def __init__(self, directory: str = 'raw-data/harvest', shard_size: int = 1000, save_every: int = 50):
+        self.directory = directory
+        self.shard_size = shard_size
+        self.save_every = save_every
+        self.manifest_file = os.path.join(directory, 'manifest.json')
+        self._unsaved = 0
+        os.makedirs(directory, exist_ok=True)
+
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, 'r') as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {
+                'object_ids': [],     # full search result, in search order
+                'searched_at': None,  # YYYY-MM-DD of the last search, used by refresh
+                'completed': {},      # objectID -> {shard, offset, metadataDate} or {filtered, metadataDate}
+                'failed': {},         # objectID -> last error message
+                'shards': {},         # shard name -> {lines, bytes} already reflected in `completed`
+            }
+        self._recover_shards()
+
+    @property
+    def object_ids(self) -> List[int]:
+        return self.manifest['object_ids']
+
+    def set_object_ids(self, object_ids: List[int], searched_at: Optional[str] = None):
+        self.manifest['object_ids'] = list(object_ids)
+        self.manifest['searched_at'] = searched_at
+        self.save()
+
+    def missing(self, object_ids: List[int]) -> List[int]:
+        """IDs not fetched yet (failed fetches are retried)"""
+        completed = self.manifest['completed']
+        return [obj_id for obj_id in object_ids if str(obj_id) not in completed]
+
+    def metadata_date(self, obj_id: int) -> Optional[str]:
+        entry = self.manifest['completed'].get(str(obj_id))
+        return entry.get('metadataDate') if entry else None
+
+    def record(self, obj_id: int, raw_data: Dict, keep: bool = True) -> bool:
+        """Checkpoint a fetched object; returns False when it is unchanged since the last fetch"""
+        key = str(obj_id)
+        self.manifest['failed'].pop(key, None)
+        previous = self.manifest['completed'].get(key)
+        metadata_date = raw_data.get('metadataDate')
+        if previous and previous.get('metadataDate') == metadata_date and metadata_date is not None:
+            return False
+
+        if keep:
+            shard, offset = self._append(raw_data)
+            entry = {'shard': shard, 'offset': offset, 'metadataDate': metadata_date}
+        else:
+            entry = {'filtered': True, 'metadataDate': metadata_date}
+        self.manifest['completed'][key] = entry
+        self._mark_dirty()
+        return True
+
+    def record_failure(self, obj_id: int, error: Exception):
+        self.manifest['failed'][str(obj_id)] = str(error)
+        self._mark_dirty()
+
+    def iter_objects(self, object_ids: Optional[List[int]] = None) -> Iterator[Dict]:
+        """Yield the latest stored version of each kept object, in `object_ids` order"""
+        completed = self.manifest['completed']
+        handles = {}
+        try:
+            for obj_id in (self.object_ids if object_ids is None else object_ids):
+                entry = completed.get(str(obj_id))
+                if not entry or 'shard' not in entry:
+                    continue
+                handle = handles.get(entry['shard'])
+                if handle is None:
+                    handle = handles[entry['shard']] = open(os.path.join(self.directory, entry['shard']), 'rb')
+                handle.seek(entry['offset'])
+                yield json.loads(handle.readline())
+        finally:
+            for handle in handles.values():
+                handle.close()
+
+    def export(self, raw_file: str, object_ids: Optional[List[int]] = None) -> int:
+        """Stream the kept objects into a derived raw file (.json, .jsonl or .parquet)"""
+        return write_records(raw_file, self.iter_objects(object_ids))
+
+    def import_objects(self, raw_paintings: Iterable[Dict]):
+        """Seed the checkpoint from a monolithic raw file written before checkpointing existed"""
+        known = set(self.object_ids)
+        for raw in raw_paintings:
+            self.record(raw['objectID'], raw)
+            if raw['objectID'] not in known:
+                known.add(raw['objectID'])
+                self.manifest['object_ids'].append(raw['objectID'])
+        self.save()
+
+    def save(self):
+        tmp_file = self.manifest_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_file, self.manifest_file)
+        self._unsaved = 0
+
+    def summary(self) -> Dict[str, int]:
+        completed = self.manifest['completed'].values()
+        filtered = sum(1 for entry in completed if entry.get('filtered'))
+        return {
+            'kept': len(self.manifest['completed']) - filtered,
+            'filtered': filtered,
+            'failed': len(self.manifest['failed']),
+            'shards': len(self.manifest['shards']),
+        }
+
+    def _mark_dirty(self):
+        self._unsaved += 1
+        if self._unsaved >= self.save_every:
+            self.save()
+
+    def _current_shard(self) -> str:
+        shards = self.manifest['shards']
+        if shards:
+            name = sorted(shards)[-1]
+            if shards[name]['lines'] < self.shard_size:
+                return name
+        name = f"shard-{len(shards):05d}.jsonl"
+        shards[name] = {'lines': 0, 'bytes': 0}
+        return name
+
+    def _append(self, raw_data: Dict):
+        name = self._current_shard()
+        line = (json.dumps(raw_data, ensure_ascii=False) + '\n').encode('utf-8')
+        state = self.manifest['shards'][name]
+        with open(os.path.join(self.directory, name), 'ab') as f:
+            f.write(line)
+        offset = state['bytes']
+        state['bytes'] += len(line)
+        state['lines'] += 1
+        return name, offset
+
+    def _recover_shards(self):
+        """Register objects appended after the last manifest save and drop a torn final line"""
+        shards = self.manifest['shards']
+        recovered = 0
+        for name in sorted(f for f in os.listdir(self.directory) if f.startswith('shard-') and f.endswith('.jsonl')):
+            state = shards.setdefault(name, {'lines': 0, 'bytes': 0})
+            path = os.path.join(self.directory, name)
+            if os.path.getsize(path) == state['bytes']:
+                continue
+            with open(path, 'rb+') as f:
+                f.seek(state['bytes'])
+                offset = state['bytes']
+                for line in f:
+                    try:
+                        raw_data = json.loads(line)
+                    except ValueError:
+                        break
+                    if not line.endswith(b'\n'):
+                        break
+                    self.manifest['completed'][str(raw_data['objectID'])] = {
+                        'shard': name, 'offset': offset, 'metadataDate': raw_data.get('metadataDate')
+                    }
+                    offset += len(line)
+                    state['lines'] += 1
+                    recovered += 1
+                f.truncate(offset)
+                state['bytes'] = offset
+        if recovered:
+            print(f"Recovered {recovered} objects written after the last checkpoint save")
+            self.save()
@@ -0,0 +1,167 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Mapping, Optional
+
+from instrumentation import BYTES_BUCKETS, count, observe, set_buckets
+
+set_buckets('http_response_bytes', BYTES_BUCKETS)
+
+
+class ResponseCache:
+    """On-disk HTTP response cache keyed by URL, with conditional revalidation and LRU eviction.
+
+    Bodies are stored with their ETag/Last-Modified validators in a single
+    SQLite file. Entries younger than `max_age` seconds are served without a
+    request; older ones are revalidated with If-None-Match/If-Modified-Since,
+    so unchanged objects come back as 304s with no body. When the stored
+    bodies exceed `max_bytes`, least recently used entries are evicted.
+    """
+
+    def __init__(self, path: str = 'raw-data/http-cache.sqlite', max_bytes: int = 512 * 1024 ** 2,
+                 max_age: float = 0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.stats = {'hits': 0, 'misses': 0, 'revalidated': 0, 'updated': 0, 'evicted': 0}
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('''CREATE TABLE IF NOT EXISTS responses (
+            url TEXT PRIMARY KEY,
+            body BLOB NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            size INTEGER NOT NULL,
+            stored REAL NOT NULL,
+            accessed REAL NOT NULL
+        )''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self._db.commit()
+        self._size = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def lookup(self, url: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._db.execute(
+                'SELECT body, etag, last_modified, stored FROM responses WHERE url = ?', (url,)
+            ).fetchone()
+        if row is None:
+            self.stats['misses'] += 1
+            count('http_cache_total', result='miss')
+            return None
+        body, etag, last_modified, stored = row
+        return {'body': body, 'etag': etag, 'last_modified': last_modified,
+                'fresh': time.time() - stored < self.max_age}
+
+    def request_headers(self, entry: Optional[Dict]) -> Dict[str, str]:
+        """Conditional request headers for revalidating a cached entry"""
+        headers = {}
+        if entry:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def hit(self, url: str, revalidated: bool = False):
+        """Mark a cached entry as used; `revalidated` when the server answered 304"""
+        now = time.time()
+        count('http_cache_total', result='revalidated' if revalidated else 'hit')
+        with self._lock:
+            if revalidated:
+                self.stats['revalidated'] += 1
+                self._db.execute('UPDATE responses SET accessed = ?, stored = ? WHERE url = ?', (now, now, url))
+            else:
+                self.stats['hits'] += 1
+                self._db.execute('UPDATE responses SET accessed = ? WHERE url = ?', (now, url))
+            self._db.commit()
+
+    def store(self, url: str, body: bytes, headers: Mapping[str, str], replaced: bool = False):
+        """Store a 200 response body together with its validators"""
+        now = time.time()
+        with self._lock:
+            if replaced:
+                self.stats['updated'] += 1
+            old = self._db.execute('SELECT size FROM responses WHERE url = ?', (url,)).fetchone()
+            self._db.execute(
+                'INSERT OR REPLACE INTO responses (url, body, etag, last_modified, size, stored, accessed) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (url, body, headers.get('ETag'), headers.get('Last-Modified'), len(body), now, now)
+            )
+            self._size += len(body) - (old[0] if old else 0)
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        while self._size > self.max_bytes:
+            rows = self._db.execute('SELECT url, size FROM responses ORDER BY accessed LIMIT 64').fetchall()
+            if not rows:
+                break
+            for url, size in rows:
+                self._db.execute('DELETE FROM responses WHERE url = ?', (url,))
+                self._size -= size
+                self.stats['evicted'] += 1
+                if self._size <= self.max_bytes:
+                    break
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    @property
+    def size_bytes(self) -> int:
+        return self._size
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def record_response(seconds: float, status: int, size: int):
+    """Request latency, status and body size metrics for one HTTP response"""
+    observe('http_request_seconds', seconds)
+    count('http_requests_total', status=status)
+    if size:
+        observe('http_response_bytes', size)
+        count('http_response_bytes_total', size)
+
+
+def _timed_get(session, url: str, **kwargs):
+    start = time.perf_counter()
+    response = session.get(url, **kwargs)
+    record_response(time.perf_counter() - start, response.status_code, len(response.content))
+    return response
+
+
+def cached_get_json(url: str, cache: Optional[ResponseCache] = None, session=None,
+                    params: Optional[Dict] = None, timeout: float = 60) -> Dict:
+    """requests-based GET of a JSON document through the response cache.
+
+    Error statuses (404, 429, 5xx) raise requests.HTTPError, as in
+    data_collection.fetch_json_async, so callers record a failed fetch that a
+    rerun retries instead of an error body passed off as the object.
+    """
+    import requests
+
+    session = session or requests
+    if cache is None:
+        response = _timed_get(session, url, params=params, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+
+    entry = cache.lookup(url)
+    if entry and entry['fresh']:
+        cache.hit(url)
+        return json.loads(entry['body'])
+
+    response = _timed_get(session, url, params=params, headers=cache.request_headers(entry), timeout=timeout)
+    if response.status_code == 304 and entry:
+        cache.hit(url, revalidated=True)
+        return json.loads(entry['body'])
+    response.raise_for_status()
+    if response.status_code == 200:
+        cache.store(url, response.content, response.headers, replaced=entry is not None)
+    return response.json()
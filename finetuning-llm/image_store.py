@@ -0,0 +1,425 @@
+"""Prefetch painting images and serve fixed-size thumbnails from a compact local store.
+
+`format_paintings` keeps only the `primary_image` / `primary_image_small` CDN
+URLs. `prefetch_images` downloads each painting's image concurrently over one
+pooled aiohttp session behind the harvester's token bucket, resizes it in a
+process pool with Pillow to every size in THUMBNAIL_SIZES, and appends the
+JPEG bytes to an `ImageStore`:
+
+- `pack-<n>.bin`: thumbnail bytes back to back (a new pack starts past `pack_bytes`)
+- `index.jsonl`: one line per stored image, written after its bytes:
+  {met_id, url, sha256, etag, last_modified, width, height,
+   sizes: {name: [pack, offset, length, width, height]}}; failures are
+  recorded as {met_id, url, error} and retried on the next run
+
+The last line for a met_id wins. On open, a torn final index line and any
+pack bytes past the last indexed image are dropped, so an interrupted run
+resumes with at most one image lost. Images already stored from the same URL
+are skipped; with `refresh`, they are revalidated with conditional requests
+and only re-resized when the downloaded bytes hash differently.
+"""
+
+import asyncio
+import hashlib
+import io
+import json
+import os
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Mapping, Optional, Tuple
+
+from instrumentation import BYTES_BUCKETS, count, observe, set_buckets, span
+
+STORE_DIR = 'processed-data/images'
+# Name -> longest side in pixels
+THUMBNAIL_SIZES = {'thumb': 200, 'medium': 600}
+JPEG_QUALITY = 85
+
+set_buckets('image_bytes', BYTES_BUCKETS)
+
+
+class ImageStore:
+    """Append-only pack files of thumbnails with a JSONL offset index keyed by met_id"""
+
+    def __init__(self, directory: str = STORE_DIR, pack_bytes: int = 1 << 30):
+        self.directory = directory
+        self.pack_bytes = pack_bytes
+        self.index_file = os.path.join(directory, 'index.jsonl')
+        self.entries: Dict[int, Dict] = {}
+        self.failed: Dict[int, Dict] = {}
+        self._lock = threading.Lock()
+        self._packs: Dict[str, object] = {}
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+        self._index = open(self.index_file, 'a', encoding='utf-8')
+        self._pack_name = self._current_pack()
+        self._pack = open(os.path.join(directory, self._pack_name), 'ab')
+
+    def _recover(self):
+        """Load the index, dropping a torn last line and pack bytes written after the last indexed image"""
+        ends: Dict[str, int] = {}
+        good = 0
+        if os.path.exists(self.index_file):
+            with open(self.index_file, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break
+                    good += len(line)
+                    self._apply(entry)
+                    for pack, offset, length, _, _ in entry.get('sizes', {}).values():
+                        ends[pack] = max(ends.get(pack, 0), offset + length)
+            if good < os.path.getsize(self.index_file):
+                os.truncate(self.index_file, good)
+        for name in self._pack_names():
+            path = os.path.join(self.directory, name)
+            if os.path.getsize(path) > ends.get(name, 0):
+                os.truncate(path, ends.get(name, 0))
+
+    def _apply(self, entry: Dict):
+        met_id = entry['met_id']
+        if 'error' in entry:
+            self.failed[met_id] = entry
+        else:
+            self.failed.pop(met_id, None)
+            self.entries[met_id] = entry
+
+    def _pack_names(self) -> List[str]:
+        return sorted(name for name in os.listdir(self.directory) if name.startswith('pack-') and name.endswith('.bin'))
+
+    def _current_pack(self) -> str:
+        names = self._pack_names()
+        return names[-1] if names else 'pack-00000.bin'
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, met_id: int) -> bool:
+        return met_id in self.entries
+
+    def add(self, met_id: int, url: str, digest: str, thumbnails: Dict[str, Tuple[bytes, int, int]],
+            width: int, height: int, etag: Optional[str] = None, last_modified: Optional[str] = None) -> Dict:
+        """Append `thumbnails` ({size: (jpeg bytes, width, height)}) and index them under `met_id`"""
+        with self._lock:
+            if self._pack.tell() >= self.pack_bytes:
+                self._pack.close()
+                self._pack_name = f"pack-{int(self._pack_name[5:10]) + 1:05d}.bin"
+                self._pack = open(os.path.join(self.directory, self._pack_name), 'ab')
+            sizes = {}
+            for name, (data, thumb_width, thumb_height) in thumbnails.items():
+                sizes[name] = [self._pack_name, self._pack.tell(), len(data), thumb_width, thumb_height]
+                self._pack.write(data)
+            # The bytes must be on disk before the index line that points at them
+            self._pack.flush()
+            entry = {'met_id': met_id, 'url': url, 'sha256': digest, 'etag': etag, 'last_modified': last_modified,
+                     'width': width, 'height': height, 'sizes': sizes}
+            self._write_entry(entry)
+            return entry
+
+    def update_validators(self, met_id: int, etag: Optional[str], last_modified: Optional[str]):
+        """Record new ETag/Last-Modified for an image whose bytes did not change"""
+        with self._lock:
+            self._write_entry({**self.entries[met_id], 'etag': etag, 'last_modified': last_modified})
+
+    def add_failure(self, met_id: int, url: str, error: Exception):
+        with self._lock:
+            self._write_entry({'met_id': met_id, 'url': url, 'error': str(error) or type(error).__name__})
+
+    def _write_entry(self, entry: Dict):
+        self._index.write(json.dumps(entry) + '\n')
+        self._index.flush()
+        self._apply(entry)
+
+    def get(self, met_id: int, size: str = 'thumb') -> Optional[bytes]:
+        """JPEG bytes of one thumbnail size, or None when the image is not stored"""
+        entry = self.entries.get(met_id)
+        if entry is None or size not in entry['sizes']:
+            return None
+        pack, offset, length, _, _ = entry['sizes'][size]
+        if pack == self._pack_name:
+            self._pack.flush()
+        handle = self._packs.get(pack)
+        if handle is None:
+            handle = self._packs[pack] = open(os.path.join(self.directory, pack), 'rb')
+        return os.pread(handle.fileno(), length, offset)
+
+    def compact(self):
+        """Rewrite the store keeping only the latest bytes of every image"""
+        self.close()
+        tmp_dir = self.directory.rstrip('/') + '.compact'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        old = ImageStore(self.directory, self.pack_bytes)
+        new = ImageStore(tmp_dir, self.pack_bytes)
+        for met_id, entry in old.entries.items():
+            thumbnails = {name: (old.get(met_id, name), w, h) for name, (_, _, _, w, h) in entry['sizes'].items()}
+            new.add(met_id, entry['url'], entry['sha256'], thumbnails, entry['width'], entry['height'],
+                    entry['etag'], entry['last_modified'])
+        for met_id, failure in old.failed.items():
+            new._write_entry(failure)
+        old.close()
+        new.close()
+        shutil.rmtree(self.directory)
+        os.replace(tmp_dir, self.directory)
+        self.__init__(self.directory, self.pack_bytes)
+
+    def close(self):
+        self._index.close()
+        self._pack.close()
+        for handle in self._packs.values():
+            handle.close()
+        self._packs.clear()
+
+
+def make_thumbnails(data: bytes, sizes: Dict[str, int] = THUMBNAIL_SIZES,
+                    quality: int = JPEG_QUALITY) -> Tuple[Dict[str, Tuple[bytes, int, int]], int, int]:
+    """Worker: decode an image and encode a JPEG per size; returns ({size: (bytes, w, h)}, width, height)"""
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as image:
+        width, height = image.size
+        # JPEG decoders can scale by 1/2..1/8 while decoding; ask for no less than the largest size
+        largest = max(sizes.values())
+        image.draft('RGB', (largest, largest))
+        image = image.convert('RGB')
+        thumbnails = {}
+        # Largest first, each resized from the previous one
+        for name, side in sorted(sizes.items(), key=lambda item: -item[1]):
+            image.thumbnail((side, side), Image.Resampling.LANCZOS)
+            out = io.BytesIO()
+            image.save(out, 'JPEG', quality=quality, optimize=True)
+            thumbnails[name] = (out.getvalue(), image.width, image.height)
+    return thumbnails, width, height
+
+
+def image_url(painting: Dict) -> str:
+    """Full-size image URL, falling back to the small web image"""
+    return painting.get('primary_image') or painting.get('primary_image_small') or ''
+
+
+async def fetch_image(session, url: str, limiter, headers: Optional[Dict] = None,
+                      max_retries: int = 5) -> Tuple[int, bytes, Mapping]:
+    """GET image bytes through the rate limiter, retrying 429/5xx and connection errors.
+
+    Returns (status, body, headers). The headers stay aiohttp's
+    case-insensitive proxy, since servers spell the validator `ETag` or `Etag`.
+    """
+    import aiohttp
+
+    from data_collection import RETRY_STATUSES, backoff_delay
+
+    for attempt in range(max_retries + 1):
+        await limiter.acquire()
+        if attempt:
+            count('image_retries_total')
+        try:
+            async with session.get(url, headers=headers) as response:
+                if response.status == 304:
+                    return 304, b'', response.headers
+                if response.status not in RETRY_STATUSES:
+                    response.raise_for_status()
+                    body = await response.read()
+                    observe('image_bytes', len(body))
+                    return response.status, body, response.headers
+                if attempt == max_retries:
+                    response.raise_for_status()
+                delay = backoff_delay(attempt, retry_after=response.headers.get('Retry-After'))
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if attempt == max_retries:
+                raise
+            delay = backoff_delay(attempt)
+        await asyncio.sleep(delay)
+
+
+async def _prefetch(store: ImageStore, todo: List[Tuple[int, str, Optional[Dict]]], sizes: Dict[str, int],
+                    concurrency: int, rate_limit: float, processes: Optional[int], max_retries: int,
+                    stats: Dict) -> Dict:
+    import aiohttp
+
+    from data_collection import TokenBucket
+
+    limiter = TokenBucket(rate_limit)
+    loop = asyncio.get_running_loop()
+    pending = iter(todo)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=120)
+
+    with ProcessPoolExecutor(max_workers=processes or os.cpu_count() or 1) as pool:
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            async def worker():
+                # One image per worker in flight, so at most `concurrency` bodies are held in memory
+                for met_id, url, previous in pending:
+                    headers = {}
+                    if previous:
+                        if previous.get('etag'):
+                            headers['If-None-Match'] = previous['etag']
+                        if previous.get('last_modified'):
+                            headers['If-Modified-Since'] = previous['last_modified']
+                    try:
+                        status, body, response_headers = await fetch_image(session, url, limiter, headers,
+                                                                            max_retries)
+                        if status == 304:
+                            stats['unchanged'] += 1
+                            continue
+                        stats['downloaded'] += 1
+                        stats['bytes'] += len(body)
+                        digest = hashlib.sha256(body).hexdigest()
+                        etag, last_modified = response_headers.get('ETag'), response_headers.get('Last-Modified')
+                        if previous and previous['sha256'] == digest:
+                            store.update_validators(met_id, etag, last_modified)
+                            stats['unchanged'] += 1
+                            continue
+                        thumbnails, width, height = await loop.run_in_executor(pool, make_thumbnails, body, sizes)
+                        store.add(met_id, url, digest, thumbnails, width, height, etag, last_modified)
+                        stats['stored'] += 1
+                        if stats['stored'] % 100 == 0:
+                            print(f"Stored {stats['stored']} images...")
+                    except Exception as e:
+                        stats['failed'] += 1
+                        count('image_errors_total', error=type(e).__name__)
+                        print(f"Error fetching image for {met_id} ({url}): {e}")
+                        store.add_failure(met_id, url, e)
+
+            await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    return stats
+
+
+def prefetch_images(paintings: Iterable[Dict], store_dir: str = STORE_DIR,
+                    sizes: Dict[str, int] = THUMBNAIL_SIZES, concurrency: int = 16,
+                    rate_limit: Optional[float] = None, processes: Optional[int] = None,
+                    refresh: bool = False, max_retries: int = 5) -> Dict:
+    """Download and resize the image of every painting not stored yet; returns run stats.
+
+    `paintings` need `met_id` and `primary_image` (or `primary_image_small`).
+    Images already stored from the same URL are skipped unless `refresh`,
+    which revalidates them with conditional requests. `rate_limit` defaults
+    to the Met API's 80 requests per second.
+    """
+    from data_collection import MET_RATE_LIMIT
+
+    store = ImageStore(store_dir)
+    todo = []
+    stats = {'requested': 0, 'skipped': 0, 'downloaded': 0, 'unchanged': 0, 'stored': 0, 'failed': 0, 'bytes': 0}
+    for painting in paintings:
+        url = image_url(painting)
+        if not url:
+            continue
+        met_id = int(painting['met_id'])
+        previous = store.entries.get(met_id)
+        if previous and previous['url'] == url and set(previous['sizes']) == set(sizes):
+            if not refresh:
+                stats['skipped'] += 1
+                continue
+        else:
+            previous = None
+        todo.append((met_id, url, previous))
+    stats['requested'] = len(todo)
+    print(f"Fetching {len(todo)} images ({stats['skipped']} already stored) into {store_dir}")
+
+    try:
+        with span('images') as s:
+            if todo:
+                asyncio.run(_prefetch(store, todo, sizes, concurrency, rate_limit or MET_RATE_LIMIT,
+                                      processes, max_retries, stats))
+            s.add(stats['stored'])
+    finally:
+        store.close()
+    count('image_bytes_total', stats['bytes'])
+    print(f"Images: {stats['stored']} stored, {stats['unchanged']} unchanged, {stats['skipped']} skipped, "
+          f"{stats['failed']} failed ({stats['bytes'] / 2 ** 20:.1f} MB downloaded)")
+    return stats
+
+
+def painting_images(raw_paintings: Iterable[Dict]) -> Iterator[Dict]:
+    """met_id and image URLs of raw Met objects"""
+    for raw in raw_paintings:
+        yield {'met_id': raw['objectID'], 'primary_image': raw.get('primaryImage', ''),
+               'primary_image_small': raw.get('primaryImageSmall', '')}
+
+
+class StubImageServer:
+    """Local image host for tests: serves `images` ({path: bytes}) with ETags and 304s.
+
+    `fail_first` answers that many requests with 503 first; `requests` counts
+    GETs per path and `not_modified` the 304s.
+    """
+
+    def __init__(self, images: Dict[str, bytes], host: str = '127.0.0.1', fail_first: int = 0):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        self.images = images
+        self.fail_first = fail_first
+        self.requests: Dict[str, int] = {}
+        self.not_modified = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                with stub._lock:
+                    stub.requests[self.path] = stub.requests.get(self.path, 0) + 1
+                    failing = stub.fail_first > 0
+                    stub.fail_first -= failing
+                body = stub.images.get(self.path)
+                if failing or body is None:
+                    self.send_response(503 if failing else 404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                etag = '"' + hashlib.md5(body).hexdigest() + '"'
+                if self.headers.get('If-None-Match') == etag:
+                    stub.not_modified += 1
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from storage import iter_records
+
+    parser = argparse.ArgumentParser(description="Prefetch painting images into the local thumbnail store")
+    parser.add_argument('--raw-file', default='raw-data/met_paintings_complete_raw.json')
+    parser.add_argument('--store-dir', default=STORE_DIR)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--refresh', action='store_true', help="revalidate stored images with conditional requests")
+    parser.add_argument('--compact', action='store_true', help="drop superseded thumbnail bytes afterwards")
+    args = parser.parse_args()
+
+    prefetch_images(painting_images(iter_records(args.raw_file, columns=['objectID', 'primaryImage',
+                                                                         'primaryImageSmall'])),
+                    args.store_dir, concurrency=args.concurrency, processes=args.processes, refresh=args.refresh)
+    if args.compact:
+        store = ImageStore(args.store_dir)
+        store.compact()
+        store.close()
@@ -0,0 +1,440 @@
+"""Lightweight timing spans, counters and histograms for the pipeline and inference.
+
+Instrumentation is off by default, and then every call is a flag check that
+returns at once (`span` hands back a shared no-op context manager). Enable it
+with `enable(events_file)` or by setting `PAINTINGS_METRICS=<events file>`
+before a script starts, which also covers spawned worker processes:
+
+- `span(name, **labels)` times a block into the `<name>_seconds` histogram;
+  `s.add(items)` counts the records it handled into `<name>_items_total` and
+  the span event reports items/sec. With `memory=True` each span event also
+  carries the tracemalloc peak inside the span and the process RSS / peak RSS.
+- `@timed(name)` wraps every call of a function in `span(name)`.
+- `count(name, value, **labels)` adds to a counter, `observe(name, value,
+  **labels)` records into a histogram.
+
+Every span is appended to the events file as one JSON line when it ends, and
+each process appends a snapshot of its counters and histograms at exit.
+`prometheus_text()` renders the live registry in the Prometheus text format;
+`python instrumentation.py prometheus EVENTS_FILE` merges the last snapshot
+of every process in an events file into one exposition.
+"""
+
+import atexit
+import bisect
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Callable, Dict, Iterable, Optional, Sequence, Tuple
+
+ENV_VAR = 'PAINTINGS_METRICS'
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+BYTES_BUCKETS = tuple(4 ** i * 256 for i in range(10))  # 256 B .. 64 MiB
+COUNT_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+_enabled = False
+_memory = False
+_events = None
+_lock = threading.Lock()
+_local = threading.local()
+_counters: Dict[Tuple, float] = {}
+_histograms: Dict[Tuple, Dict] = {}
+_buckets: Dict[str, Sequence[float]] = {}
+
+
+def peak_rss_kb() -> int:
+    """Peak RSS of this process in KiB (VmHWM; ru_maxrss where /proc is missing)"""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    # ru_maxrss survives exec, so it can include the parent's peak
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def reset_peak_rss() -> bool:
+    """Reset VmHWM to the current RSS (Linux); False where unsupported"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def rss_kb() -> int:
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError):
+        return peak_rss_kb()
+
+
+def memory_kb(pid='self') -> Dict[str, int]:
+    """Rss, Pss and shared/private resident KiB of a process from /proc/<pid>/smaps_rollup; {} where missing.
+
+    Pss charges each shared page to the processes mapping it in equal parts,
+    so summing it over processes counts memory-mapped weights once.
+    """
+    fields = {'Rss': 'rss', 'Pss': 'pss', 'Shared_Clean': 'shared_clean', 'Shared_Dirty': 'shared_dirty',
+              'Private_Clean': 'private_clean', 'Private_Dirty': 'private_dirty'}
+    usage = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup', 'r') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name in fields:
+                    usage[fields[name]] = int(value.split()[0])
+    except (OSError, ValueError):
+        return {}
+    return usage
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def enable(events_file: Optional[str] = None, memory: bool = False):
+    """Start recording; span events (and an exit snapshot) are appended to `events_file` when given"""
+    global _enabled, _memory, _events
+    with _lock:
+        if _events is not None:
+            _events.close()
+        _events = None
+        if events_file:
+            os.makedirs(os.path.dirname(events_file) or '.', exist_ok=True)
+            _events = open(events_file, 'a', buffering=1, encoding='utf-8')
+        _memory = memory
+        _enabled = True
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    """Stop recording and close the events file (recorded metrics are kept)"""
+    global _enabled, _events
+    with _lock:
+        _enabled = False
+        if _events is not None:
+            _events.close()
+            _events = None
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def set_buckets(name: str, buckets: Sequence[float]):
+    """Histogram bucket bounds for `name` (default SECONDS_BUCKETS)"""
+    _buckets[name] = tuple(sorted(buckets))
+
+
+def _key(name: str, labels: Dict) -> Tuple:
+    return (name,) + tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _emit(event: Dict):
+    if _events is not None:
+        line = json.dumps(event, ensure_ascii=False) + '\n'
+        with _lock:
+            if _events is not None:
+                _events.write(line)
+
+
+def count(name: str, value: float = 1, **labels):
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name: str, value: float, **labels):
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            bounds = _buckets.get(name, SECONDS_BUCKETS)
+            histogram = _histograms[key] = {'bounds': bounds, 'counts': [0] * (len(bounds) + 1),
+                                            'sum': 0.0, 'count': 0}
+        histogram['counts'][bisect.bisect_left(histogram['bounds'], value)] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, items: int = 1):
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+class Span:
+    """Times a block into `<name>_seconds`; see `span`"""
+
+    def __init__(self, name: str, labels: Dict):
+        self.name = name
+        self.labels = labels
+        self.items = 0
+        self.alloc_peak = 0
+
+    def add(self, items: int = 1):
+        self.items += items
+
+    def __enter__(self):
+        stack = _local.__dict__.setdefault('spans', [])
+        if _memory and tracemalloc.is_tracing():
+            # Fold the peak so far into the enclosing span before restarting the peak window
+            if stack:
+                stack[-1].alloc_peak = max(stack[-1].alloc_peak, tracemalloc.get_traced_memory()[1])
+            self.alloc_start = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        stack.append(self)
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        stack = _local.spans
+        stack.pop()
+        observe(f"{self.name}_seconds", seconds, **self.labels)
+        event = {'type': 'span', 'name': self.name, 'labels': self.labels, 'start': round(self.wall_start, 6),
+                 'seconds': round(seconds, 6), 'pid': os.getpid()}
+        if exc_type is not None:
+            event['error'] = exc_type.__name__
+            count(f"{self.name}_errors_total", **self.labels)
+        if self.items:
+            count(f"{self.name}_items_total", self.items, **self.labels)
+            event['items'] = self.items
+            event['items_per_s'] = round(self.items / seconds, 2) if seconds > 0 else None
+        if _memory:
+            if tracemalloc.is_tracing():
+                self.alloc_peak = max(self.alloc_peak, tracemalloc.get_traced_memory()[1])
+                event['alloc_peak_bytes'] = max(0, self.alloc_peak - self.alloc_start)
+                if stack:
+                    stack[-1].alloc_peak = max(stack[-1].alloc_peak, self.alloc_peak)
+            event['rss_kb'] = rss_kb()
+            event['peak_rss_kb'] = peak_rss_kb()
+        _emit(event)
+        return False
+
+
+def span(name: str, **labels):
+    """Context manager timing a block: `with span('format') as s: ...; s.add(records)`"""
+    if not _enabled:
+        return _NOOP
+    return Span(name, labels)
+
+
+def timed(name: str, **labels) -> Callable:
+    """Decorator running every call of a function inside `span(name, **labels)`"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with Span(name, labels):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def snapshot() -> Dict:
+    """Counters and histograms recorded so far in this process"""
+    with _lock:
+        return {
+            'counters': [{'name': key[0], 'labels': dict(key[1:]), 'value': value}
+                         for key, value in _counters.items()],
+            'histograms': [{'name': key[0], 'labels': dict(key[1:]), 'bounds': list(h['bounds']),
+                            'counts': list(h['counts']), 'sum': h['sum'], 'count': h['count']}
+                           for key, h in _histograms.items()],
+        }
+
+
+def _labels_text(labels: Dict, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = sorted(labels.items()) + ([extra] if extra else [])
+    if not items:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in items)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + '}'
+
+
+def prometheus_text(metrics: Optional[Dict] = None, prefix: str = 'paintings_') -> str:
+    """Prometheus text exposition of a `snapshot()` (the live registry by default)"""
+    metrics = metrics or snapshot()
+    lines = []
+    typed = set()
+    for counter in sorted(metrics['counters'], key=lambda c: c['name']):
+        name = prefix + counter['name']
+        if name not in typed:
+            lines.append(f"# TYPE {name} counter")
+            typed.add(name)
+        lines.append(f"{name}{_labels_text(counter['labels'])} {counter['value']:g}")
+    for histogram in sorted(metrics['histograms'], key=lambda h: h['name']):
+        name = prefix + histogram['name']
+        if name not in typed:
+            lines.append(f"# TYPE {name} histogram")
+            typed.add(name)
+        cumulative = 0
+        for bound, bucket in zip(list(histogram['bounds']) + ['+Inf'], histogram['counts']):
+            cumulative += bucket
+            le = bound if bound == '+Inf' else f"{bound:g}"
+            lines.append(f"{name}_bucket{_labels_text(histogram['labels'], ('le', le))} {cumulative}")
+        lines.append(f"{name}_sum{_labels_text(histogram['labels'])} {histogram['sum']:.6g}")
+        lines.append(f"{name}_count{_labels_text(histogram['labels'])} {histogram['count']}")
+    return '\n'.join(lines) + '\n'
+
+
+def merge_snapshots(snapshots: Iterable[Dict]) -> Dict:
+    """Sum counters and histogram buckets with the same name and labels"""
+    counters, histograms = {}, {}
+    for metrics in snapshots:
+        for counter in metrics['counters']:
+            key = _key(counter['name'], counter['labels'])
+            counters[key] = counters.get(key, 0) + counter['value']
+        for histogram in metrics['histograms']:
+            key = _key(histogram['name'], histogram['labels'])
+            merged = histograms.setdefault(key, {'bounds': histogram['bounds'],
+                                                 'counts': [0] * len(histogram['counts']),
+                                                 'sum': 0.0, 'count': 0})
+            if merged['bounds'] != histogram['bounds']:
+                raise ValueError(f"Histogram {histogram['name']} has different buckets across snapshots")
+            merged['counts'] = [a + b for a, b in zip(merged['counts'], histogram['counts'])]
+            merged['sum'] += histogram['sum']
+            merged['count'] += histogram['count']
+    return {
+        'counters': [{'name': key[0], 'labels': dict(key[1:]), 'value': value} for key, value in counters.items()],
+        'histograms': [{'name': key[0], 'labels': dict(key[1:]), **h} for key, h in histograms.items()],
+    }
+
+
+def load_events(events_file: str) -> Tuple[list, Dict]:
+    """Span events and the merged exit snapshots (the last one per process) of an events file"""
+    spans, snapshots = [], {}
+    with open(events_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            if event['type'] == 'span':
+                spans.append(event)
+            elif event['type'] == 'metrics':
+                snapshots[event['pid']] = event['metrics']
+    return spans, merge_snapshots(snapshots.values())
+
+
+def flush():
+    """Append this process's counters and histograms to the events file"""
+    if _events is not None and (_counters or _histograms):
+        _emit({'type': 'metrics', 'pid': os.getpid(), 'time': round(time.time(), 3), 'metrics': snapshot()})
+
+
+atexit.register(flush)
+
+if os.environ.get(ENV_VAR):
+    enable(os.environ[ENV_VAR], memory=os.environ.get(f"{ENV_VAR}_MEMORY", '') not in ('', '0'))
+
+
+def summarize(events_file: str) -> Dict[str, Dict]:
+    """Per-span totals from an events file: calls, seconds, items and items/sec"""
+    spans, _ = load_events(events_file)
+    totals = {}
+    for event in spans:
+        total = totals.setdefault(event['name'], {'calls': 0, 'seconds': 0.0, 'items': 0})
+        total['calls'] += 1
+        total['seconds'] += event['seconds']
+        total['items'] += event.get('items', 0)
+    for total in totals.values():
+        total['seconds'] = round(total['seconds'], 4)
+        total['items_per_s'] = round(total['items'] / total['seconds'], 1) if total['items'] and total['seconds'] else None
+    print(f"{'span':<28}{'calls':>8}{'seconds':>12}{'items':>10}{'items/s':>12}")
+    for name, total in sorted(totals.items(), key=lambda item: -item[1]['seconds']):
+        print(f"{name:<28}{total['calls']:>8}{total['seconds']:>12.3f}{total['items']:>10}"
+              f"{total['items_per_s'] or '-':>12}")
+    return totals
+
+
+def check_instrumentation():
+    """Disabled overhead, then a recorded run of the cleaner and template generation exported both ways"""
+    import tempfile
+
+    from clean_unicode import restore_from_backup_and_clean
+    from generate_audio_scripts import create_bulk_training_data
+    from storage import write_records
+
+    assert not _enabled
+    calls = 200_000
+    start = time.perf_counter()
+    for _ in range(calls):
+        with span('noop') as s:
+            s.add()
+        count('noop_total')
+    disabled_ns = (time.perf_counter() - start) / calls * 1e9
+    assert not _counters and not _histograms
+    print(f"Disabled: {disabled_ns:.0f} ns per span + counter")
+
+    from benchmarks import synthetic_raw_paintings
+
+    with tempfile.TemporaryDirectory() as tmp:
+        events_file = os.path.join(tmp, 'metrics.jsonl')
+        raw_file = os.path.join(tmp, 'raw.jsonl')
+        formatted_file = os.path.join(tmp, 'formatted.jsonl')
+        write_records(raw_file, synthetic_raw_paintings(2000))
+
+        enable(events_file, memory=True)
+        with span('check') as outer:
+            restore_from_backup_and_clean(raw_file, formatted_file)
+            create_bulk_training_data(formatted_file, os.path.join(tmp, 'bulk.jsonl'))
+            outer.add(1)
+        flush()
+        disable()
+
+        spans, metrics = load_events(events_file)
+        names = {event['name'] for event in spans}
+        assert {'check', 'clean', 'templates'} <= names, names
+        clean = next(event for event in spans if event['name'] == 'clean')
+        assert clean['items'] == 2000 and clean['alloc_peak_bytes'] > 0 and clean['peak_rss_kb'] > 0
+        outer_event = next(event for event in spans if event['name'] == 'check')
+        assert outer_event['alloc_peak_bytes'] >= clean['alloc_peak_bytes']
+        text = prometheus_text(metrics)
+        assert 'paintings_clean_items_total 2000' in text and 'paintings_clean_seconds_bucket{le="+Inf"} 1' in text
+        print(text)
+        summarize(events_file)
+    reset()
+    print("Check passed: spans, counters and histograms export as JSON lines and Prometheus text")
+
+
+if __name__ == "__main__":
+    # Pipeline modules import `instrumentation`; go through it so they share one registry
+    import instrumentation
+
+    if "--check" in sys.argv:
+        instrumentation.check_instrumentation()
+        sys.exit(0)
+    if len(sys.argv) == 3 and sys.argv[1] == 'prometheus':
+        sys.stdout.write(instrumentation.prometheus_text(instrumentation.load_events(sys.argv[2])[1]))
+    elif len(sys.argv) == 3 and sys.argv[1] == 'summary':
+        instrumentation.summarize(sys.argv[2])
+    else:
+        print("usage: python instrumentation.py (prometheus|summary) EVENTS_FILE | --check")
+        sys.exit(2)
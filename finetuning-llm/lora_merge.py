@@ -0,0 +1,274 @@
+"""Tensor-by-tensor LoRA merge over safetensors shards.
+
+`export_model.merge_lora` materialises the whole base model, wraps it in
+PEFT and re-saves it. This merge instead walks the base checkpoint one
+tensor at a time: each tensor is read with a plain seek + read (no mmap, so
+pages do not stay resident), LoRA-targeted weights get
+`W + scaling * B @ A` exactly as `peft`'s `merge_and_unload` computes it,
+and the result is written straight into an output shard whose header was
+laid out up front from the base shapes. Only one base tensor (with its
+float32 delta) is in memory at a time, so peak memory is a small multiple
+of the largest tensor (the embeddings / lm_head), not of the model.
+
+The output keeps the base shard layout and index, plus config and tokenizer
+files, so `AutoModelForCausalLM.from_pretrained(merged_dir)` loads it as usual.
+"""
+
+import json
+import os
+import re
+import shutil
+import struct
+import time
+from typing import Dict, Optional, Tuple
+
+import torch
+
+SAFETENSORS_DTYPES = {
+    'F64': torch.float64, 'F32': torch.float32, 'F16': torch.float16, 'BF16': torch.bfloat16,
+    'I64': torch.int64, 'I32': torch.int32, 'I16': torch.int16, 'I8': torch.int8, 'U8': torch.uint8,
+    'BOOL': torch.bool,
+}
+DTYPE_NAMES = {dtype: name for name, dtype in SAFETENSORS_DTYPES.items()}
+COPIED_FILES = ['config.json', 'generation_config.json', 'tokenizer.json', 'tokenizer.model',
+                'tokenizer_config.json', 'special_tokens_map.json']
+
+
+def rss_bytes() -> int:
+    """Current resident set size, or the peak so far when psutil is missing"""
+    try:
+        import psutil
+
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def read_header(path: str) -> Tuple[Dict, int]:
+    """(tensor header without `__metadata__`, byte offset where tensor data starts)"""
+    with open(path, 'rb') as f:
+        size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(size))
+    header.pop('__metadata__', None)
+    return header, 8 + size
+
+
+def read_tensor(f, info: Dict, data_start: int) -> torch.Tensor:
+    start, end = info['data_offsets']
+    f.seek(data_start + start)
+    buffer = bytearray(end - start)
+    f.readinto(buffer)
+    dtype = SAFETENSORS_DTYPES[info['dtype']]
+    if not buffer:
+        return torch.empty(info['shape'], dtype=dtype)
+    return torch.frombuffer(buffer, dtype=dtype).reshape(info['shape'])
+
+
+def write_header(f, tensors: Dict[str, Tuple[torch.dtype, list]], metadata: Optional[Dict] = None) -> Dict:
+    """Write a safetensors header for tensors written afterwards in this order; returns their offsets"""
+    header, offset = {}, 0
+    for name, (dtype, shape) in tensors.items():
+        nbytes = torch.Size(shape).numel() * torch.empty((), dtype=dtype).element_size()
+        header[name] = {'dtype': DTYPE_NAMES[dtype], 'shape': list(shape), 'data_offsets': [offset, offset + nbytes]}
+        offset += nbytes
+    payload = dict(header)
+    if metadata:
+        payload['__metadata__'] = metadata
+    encoded = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    encoded += b' ' * (-len(encoded) % 8)
+    f.write(struct.pack('<Q', len(encoded)))
+    f.write(encoded)
+    return header
+
+
+def resolve_checkpoint(name_or_dir: str, patterns=('*.safetensors', '*.safetensors.index.json')) -> str:
+    """Local directory for a checkpoint, downloading only the matching files from the Hub"""
+    if os.path.isdir(name_or_dir):
+        return name_or_dir
+    from huggingface_hub import snapshot_download
+
+    return snapshot_download(name_or_dir, allow_patterns=list(patterns))
+
+
+def base_shards(base_dir: str) -> Dict[str, list]:
+    """Shard file -> tensor names, from the index when the checkpoint is sharded"""
+    index_file = os.path.join(base_dir, 'model.safetensors.index.json')
+    if os.path.exists(index_file):
+        with open(index_file, 'r') as f:
+            weight_map = json.load(f)['weight_map']
+        shards: Dict[str, list] = {}
+        for name, shard in weight_map.items():
+            shards.setdefault(shard, []).append(name)
+        return shards
+    return {'model.safetensors': list(read_header(os.path.join(base_dir, 'model.safetensors'))[0])}
+
+
+def load_adapter(adapter_dir: str) -> Tuple[Dict, Dict[str, torch.Tensor]]:
+    """(adapter_config, LoRA tensors keyed by base weight name -> (A, B))"""
+    with open(os.path.join(adapter_dir, 'adapter_config.json'), 'r') as f:
+        config = json.load(f)
+    if config.get('use_dora'):
+        raise ValueError("DoRA adapters need the magnitude vectors; merge them with merge_lora(streaming=False)")
+    if config.get('modules_to_save'):
+        raise ValueError("Adapters with modules_to_save are not supported by the streaming merge")
+
+    from safetensors.torch import load_file
+
+    pairs: Dict[str, Dict[str, torch.Tensor]] = {}
+    # The adapter is small (a few hundred MB for rank 16 on 7B), so it is loaded whole
+    for key, tensor in load_file(os.path.join(adapter_dir, 'adapter_model.safetensors')).items():
+        match = re.match(r'base_model\.model\.(.+)\.lora_([AB])(?:\.[^.]+)?\.weight$', key)
+        if match is None:
+            raise ValueError(f"Unexpected adapter tensor {key}")
+        pairs.setdefault(match.group(1) + '.weight', {})[match.group(2)] = tensor
+    return config, {name: (pair['A'], pair['B']) for name, pair in pairs.items()}
+
+
+def lora_scaling(config: Dict, module: str, rank: int) -> float:
+    """alpha / r (alpha / sqrt(r) with rsLoRA), honouring rank_pattern / alpha_pattern like peft"""
+    alpha = config['lora_alpha']
+    for pattern, value in (config.get('alpha_pattern') or {}).items():
+        if re.match(rf'(.*\.)?{pattern}$', module):
+            alpha = value
+            break
+    return alpha / (rank ** 0.5) if config.get('use_rslora') else alpha / rank
+
+
+def merged_weight(weight: torch.Tensor, lora_a: torch.Tensor, lora_b: torch.Tensor, scaling: float,
+                  fan_in_fan_out: bool = False) -> torch.Tensor:
+    """peft's LoRA merge with its default float32 adapter weights: the sum is taken in float32, then cast back"""
+    delta = lora_b.float() @ lora_a.float()
+    if fan_in_fan_out:
+        delta = delta.T
+    # In place, so a float32 weight never needs a second full-size copy
+    return weight.float().add_(delta, alpha=scaling).to(weight.dtype)
+
+
+def stream_merge_lora(base_name: str, adapter_dir: str, merged_dir: str = './fp16-merged-model',
+                      dtype: Optional[torch.dtype] = torch.float16) -> Dict:
+    """Merge a LoRA adapter into a safetensors base one tensor at a time; returns a memory report.
+
+    Floating-point tensors are cast to `dtype` (None keeps the base dtype)
+    before the delta is added, matching a base loaded with that
+    `torch_dtype`. The report gives the starting and peak RSS (sampled after
+    every tensor), the largest tensor and the number of merged weights.
+    """
+    start_time = time.perf_counter()
+    baseline = peak = rss_bytes()
+    base_dir = resolve_checkpoint(base_name, patterns=('model*.safetensors', '*.safetensors.index.json', '*.json',
+                                                       'tokenizer.model'))
+    config, lora = load_adapter(adapter_dir)
+    fan_in_fan_out = config.get('fan_in_fan_out', False)
+    os.makedirs(merged_dir, exist_ok=True)
+    print(f"Streaming LoRA merge of {adapter_dir} ({len(lora)} adapted weights) into {base_dir}")
+
+    def out_dtype(source: torch.dtype) -> torch.dtype:
+        return dtype if dtype is not None and source.is_floating_point else source
+
+    merged, largest, total_size = 0, 0, 0
+    weight_map: Dict[str, str] = {}
+    for shard, names in base_shards(base_dir).items():
+        header, data_start = read_header(os.path.join(base_dir, shard))
+        layout = {name: (out_dtype(SAFETENSORS_DTYPES[header[name]['dtype']]), header[name]['shape'])
+                  for name in names}
+        with open(os.path.join(base_dir, shard), 'rb') as source, \
+                open(os.path.join(merged_dir, shard), 'wb') as target:
+            out_header = write_header(target, layout, metadata={'format': 'pt'})
+            for name in names:
+                tensor = read_tensor(source, header[name], data_start).to(layout[name][0])
+                if name in lora:
+                    lora_a, lora_b = lora.pop(name)
+                    module = name[:-len('.weight')]
+                    tensor = merged_weight(tensor, lora_a, lora_b,
+                                           lora_scaling(config, module, lora_a.shape[0]), fan_in_fan_out)
+                    merged += 1
+                # Tensors are written back to back in header order
+                if tensor.numel():
+                    target.write(memoryview(tensor.contiguous().view(-1).view(torch.uint8).numpy()))
+                largest = max(largest, out_header[name]['data_offsets'][1] - out_header[name]['data_offsets'][0])
+                weight_map[name] = shard
+                del tensor
+                peak = max(peak, rss_bytes())
+        total_size += sum(info['data_offsets'][1] - info['data_offsets'][0] for info in out_header.values())
+        print(f"  wrote {shard} ({len(names)} tensors)")
+
+    if lora:
+        raise ValueError(f"Adapter weights without a base tensor: {sorted(lora)[:5]}")
+    if os.path.exists(os.path.join(base_dir, 'model.safetensors.index.json')):
+        with open(os.path.join(merged_dir, 'model.safetensors.index.json'), 'w') as f:
+            json.dump({'metadata': {'total_size': total_size}, 'weight_map': weight_map}, f, indent=2)
+
+    for name in COPIED_FILES:
+        if os.path.exists(os.path.join(base_dir, name)):
+            shutil.copy(os.path.join(base_dir, name), os.path.join(merged_dir, name))
+    if dtype is not None and os.path.exists(os.path.join(merged_dir, 'config.json')):
+        with open(os.path.join(merged_dir, 'config.json'), 'r') as f:
+            model_config = json.load(f)
+        model_config['torch_dtype'] = str(dtype).replace('torch.', '')
+        with open(os.path.join(merged_dir, 'config.json'), 'w') as f:
+            json.dump(model_config, f, indent=2)
+
+    report = {
+        'merged_weights': merged,
+        'tensors': len(weight_map),
+        'largest_tensor_mb': round(largest / 2 ** 20, 1),
+        'model_mb': round(total_size / 2 ** 20, 1),
+        'baseline_rss_mb': round(baseline / 2 ** 20, 1),
+        'peak_rss_mb': round(peak / 2 ** 20, 1),
+        'peak_over_baseline_mb': round((peak - baseline) / 2 ** 20, 1),
+        'seconds': round(time.perf_counter() - start_time, 1),
+    }
+    print(f"Merged {merged} LoRA weights into {merged_dir}: peak RSS {report['peak_rss_mb']} MB "
+          f"(+{report['peak_over_baseline_mb']} MB over start), largest tensor {report['largest_tensor_mb']} MB, "
+          f"model {report['model_mb']} MB")
+    return report
+
+
+def check_tiny_merge(work_dir: Optional[str] = None, rank: int = 4, atol: float = 0.0):
+    """Streaming merge of a random LoRA into a sharded tiny Mistral vs peft's merge_and_unload.
+
+    Runs in float32 and in float16 (the export dtype); every tensor must match.
+    """
+    import tempfile
+
+    from peft import LoraConfig, PeftModel, get_peft_model
+    from transformers import AutoModelForCausalLM
+
+    from export_model import tiny_mistral
+
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp:
+        base_dir, adapter_dir = os.path.join(tmp, 'base'), os.path.join(tmp, 'adapter')
+        base = tiny_mistral()
+        # Small shards so the merge crosses shard boundaries like the 7B checkpoint does
+        base.save_pretrained(base_dir, max_shard_size='1MB', safe_serialization=True)
+        lora_config = LoraConfig(r=rank, lora_alpha=32, lora_dropout=0.1, init_lora_weights=False,
+                                 target_modules=['q_proj', 'k_proj', 'v_proj', 'o_proj',
+                                                 'gate_proj', 'up_proj', 'down_proj'],
+                                 rank_pattern={'down_proj': 2 * rank}, alpha_pattern={'o_proj': 8})
+        get_peft_model(base, lora_config).save_pretrained(adapter_dir)
+
+        for dtype in (torch.float32, torch.float16):
+            merged_dir = os.path.join(tmp, f'merged-{dtype}'.replace('torch.', ''))
+            report = stream_merge_lora(base_dir, adapter_dir, merged_dir, dtype=dtype)
+            reference_base = AutoModelForCausalLM.from_pretrained(base_dir, torch_dtype=dtype)
+            reference = PeftModel.from_pretrained(reference_base, adapter_dir).merge_and_unload().state_dict()
+            streamed = AutoModelForCausalLM.from_pretrained(merged_dir, torch_dtype=dtype).state_dict()
+            assert streamed.keys() == reference.keys()
+            worst = max(float((streamed[name].float() - reference[name].float()).abs().max()) for name in reference)
+            assert worst <= atol, (dtype, worst)
+            assert report['merged_weights'] == 7 * base.config.num_hidden_layers
+            print(f"{dtype}: streaming merge matches merge_and_unload (max |diff| {worst:.1e})")
+
+
+if __name__ == "__main__":
+    import sys
+
+    if "--check" in sys.argv:
+        check_tiny_merge()
+        sys.exit(0)
+
+    base = sys.argv[1] if len(sys.argv) > 1 else "mistralai/Mistral-7B-Instruct-v0.3"
+    adapter = sys.argv[2] if len(sys.argv) > 2 else "./trained-models/paintings-audio-guide-final"
+    stream_merge_lora(base, adapter)
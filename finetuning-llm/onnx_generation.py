@@ -0,0 +1,224 @@
+"""Incremental decoding over the exported ONNX model with onnxruntime.
+
+`export_model.export_with_past` writes a single graph that takes the KV cache
+as `past_key_values.{layer}.key/value` inputs and returns the updated cache
+as `present.{layer}.key/value`. Prefill feeds a zero-length cache; every
+decode step then feeds one new token per sequence plus the previous
+presents, so each token costs one position of compute instead of a re-run
+of the whole sequence. Graphs exported without a cache (input_ids,
+attention_mask -> logits) still work through the uncached path.
+
+Batches are left-padded; position ids are derived from the attention mask
+the same way `transformers` generate does.
+"""
+
+import os
+import time
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from instrumentation import observe, span
+
+ORT_DTYPES = {'tensor(float16)': np.float16, 'tensor(float)': np.float32}
+
+
+def position_ids_for(attention_mask: np.ndarray, length: int) -> np.ndarray:
+    """Positions of the last `length` columns, counting only attended tokens (left padding)"""
+    positions = np.cumsum(attention_mask, axis=1) - 1
+    return np.maximum(positions, 0)[:, -length:].astype(np.int64)
+
+
+def left_pad(sequences: Sequence[Sequence[int]], pad_token_id: int) -> Tuple[np.ndarray, np.ndarray]:
+    """(input_ids, attention_mask) for token id lists of different lengths"""
+    width = max(len(sequence) for sequence in sequences)
+    input_ids = np.full((len(sequences), width), pad_token_id, dtype=np.int64)
+    attention_mask = np.zeros((len(sequences), width), dtype=np.int64)
+    for row, sequence in enumerate(sequences):
+        if len(sequence):
+            input_ids[row, -len(sequence):] = sequence
+            attention_mask[row, -len(sequence):] = 1
+    return input_ids, attention_mask
+
+
+def apply_repetition_penalty(logits: np.ndarray, input_ids: np.ndarray, attention_mask: np.ndarray,
+                             penalty: float) -> np.ndarray:
+    """transformers' RepetitionPenaltyLogitsProcessor over the attended tokens of each row"""
+    logits = logits.copy()
+    for row in range(logits.shape[0]):
+        seen = np.unique(input_ids[row][attention_mask[row] == 1])
+        scores = logits[row, seen]
+        logits[row, seen] = np.where(scores < 0, scores * penalty, scores / penalty)
+    return logits
+
+
+def choose_tokens(logits: np.ndarray, input_ids: np.ndarray, attention_mask: np.ndarray,
+                  temperature: float = 0.0, repetition_penalty: float = 1.0,
+                  rng: Optional[np.random.Generator] = None) -> np.ndarray:
+    """Next token per row from last-position logits: argmax at temperature 0, else sampled"""
+    if repetition_penalty != 1.0:
+        logits = apply_repetition_penalty(logits, input_ids, attention_mask, repetition_penalty)
+    if temperature <= 0:
+        return logits.argmax(axis=1)
+    rng = rng or np.random.default_rng()
+    probs = np.exp((logits - logits.max(axis=1, keepdims=True)) / temperature)
+    probs /= probs.sum(axis=1, keepdims=True)
+    return np.array([rng.choice(len(p), p=p) for p in probs])
+
+
+class OnnxGenerator:
+    """Greedy or sampled generation over an onnxruntime session"""
+
+    def __init__(self, model_dir: str = 'onnx-model', model_file: str = 'model.onnx',
+                 providers: Optional[List[str]] = None, session_options=None):
+        import onnxruntime as ort
+
+        self.session = ort.InferenceSession(os.path.join(model_dir, model_file), sess_options=session_options,
+                                            providers=providers or ['CPUExecutionProvider'])
+        inputs = {node.name: node for node in self.session.get_inputs()}
+        self.past_names = [name for name in inputs if name.startswith('past_key_values.')]
+        self.present_names = [node.name for node in self.session.get_outputs() if node.name.startswith('present.')]
+        self.has_past = bool(self.past_names)
+        self.uses_position_ids = 'position_ids' in inputs
+        if self.has_past:
+            first = inputs[self.past_names[0]]
+            self.kv_heads, self.head_dim = first.shape[1], first.shape[3]
+            self.cache_dtype = ORT_DTYPES[first.type]
+
+    def empty_cache(self, batch: int) -> List[np.ndarray]:
+        return [np.zeros((batch, self.kv_heads, 0, self.head_dim), dtype=self.cache_dtype)
+                for _ in self.past_names]
+
+    def forward(self, input_ids: np.ndarray, attention_mask: np.ndarray,
+                past: Optional[List[np.ndarray]] = None) -> Tuple[np.ndarray, Optional[List[np.ndarray]]]:
+        """Logits for `input_ids` (the new tokens when `past` is given) and the updated cache.
+
+        `attention_mask` always covers past + new tokens.
+        """
+        feed = {'input_ids': input_ids, 'attention_mask': attention_mask}
+        if self.uses_position_ids:
+            feed['position_ids'] = position_ids_for(attention_mask, input_ids.shape[1])
+        if not self.has_past:
+            return self.session.run(['logits'], feed)[0], None
+        if past is None:
+            past = self.empty_cache(input_ids.shape[0])
+        feed.update(zip(self.past_names, past))
+        outputs = self.session.run(['logits', *self.present_names], feed)
+        return outputs[0], outputs[1:]
+
+    def generate(self, prompts: Sequence[Sequence[int]],
+                 max_new_tokens: int = 100,
+                 eos_token_id: Union[int, Sequence[int]] = 2,
+                 pad_token_id: Optional[int] = None,
+                 temperature: float = 0.0,
+                 repetition_penalty: float = 1.0,
+                 seed: Optional[int] = None,
+                 use_cache: bool = True,
+                 output_scores: bool = False,
+                 stop_sequences: Sequence[Sequence[int]] = ()):
+        """Generate continuations for a batch of token id prompts.
+
+        `temperature` 0 decodes greedily. A row finishes at EOS or once its
+        output ends with one of `stop_sequences` (kept in the output). Returns
+        the new token ids of each prompt (EOS excluded), plus the per-step
+        last-position logits when `output_scores` is set. `use_cache=False`
+        re-runs the full sequence every step, as graphs without a cache must.
+        """
+        eos_ids = {eos_token_id} if isinstance(eos_token_id, int) else set(eos_token_id)
+        pad_token_id = min(eos_ids) if pad_token_id is None else pad_token_id
+        rng = np.random.default_rng(seed)
+        use_cache = use_cache and self.has_past
+
+        input_ids, attention_mask = left_pad(prompts, pad_token_id)
+        generated: List[List[int]] = [[] for _ in prompts]
+        finished = np.zeros(len(prompts), dtype=bool)
+        scores = []
+        past = None
+        step_ids = input_ids
+        start = time.perf_counter()
+        with span('generate', batch=len(prompts)) as s:
+            for step in range(max_new_tokens):
+                logits, present = self.forward(step_ids if use_cache else input_ids, attention_mask, past)
+                if step == 0:
+                    observe('generate_ttft_seconds', time.perf_counter() - start)
+                next_logits = logits[:, -1].astype(np.float32)
+                if output_scores:
+                    scores.append(next_logits)
+                next_tokens = choose_tokens(next_logits, input_ids, attention_mask, temperature, repetition_penalty, rng)
+                next_tokens = np.where(finished, pad_token_id, next_tokens)
+                for row, token in enumerate(next_tokens):
+                    if finished[row]:
+                        continue
+                    if int(token) in eos_ids:
+                        finished[row] = True
+                        continue
+                    generated[row].append(int(token))
+                    if any(stop and generated[row][-len(stop):] == list(stop) for stop in stop_sequences):
+                        finished[row] = True
+                if finished.all():
+                    break
+
+                step_ids = next_tokens[:, None].astype(np.int64)
+                input_ids = np.concatenate([input_ids, step_ids], axis=1)
+                attention_mask = np.concatenate([attention_mask, np.ones((len(prompts), 1), dtype=np.int64)], axis=1)
+                past = present if use_cache else None
+            s.add(sum(len(tokens) for tokens in generated))
+
+        return (generated, scores) if output_scores else generated
+
+
+def guide_prompt(title: str, artist: str, date: str, medium: str, dimensions: str = "Not specified") -> str:
+    """The prompt format the model was fine-tuned on"""
+    return f"Title: {title}\nArtist: {artist}\nDate: {date}\nMedium: {medium}\nDimensions: {dimensions}\n\nAudio guide:"
+
+
+def painting_prompt(painting: Dict) -> str:
+    # Empty dimensions get the default too: guide_cache keys them that way
+    return guide_prompt(painting['title'], painting['artist'], painting['date'], painting['medium'],
+                        painting.get('dimensions') or 'Not specified')
+
+
+def trim_guide(text: str) -> str:
+    """Strip a decoded completion and cut it at the `<END>` marker"""
+    completion = text.strip()
+    if "<END>" in completion:
+        completion = completion.split("<END>")[0].strip()
+    return completion
+
+
+def end_marker_ids(tokenizer, marker: str = "<END>") -> List[int]:
+    """Token ids that always end the `<END>` marker.
+
+    The marker's first token merges with the preceding text ('▁<' after a
+    space, '.<' after a full stop), so only the tokens after it are stable.
+    """
+    return tokenizer.encode(marker, add_special_tokens=False).ids[1:]
+
+
+def generate_guides(generator: OnnxGenerator, tokenizer, paintings: Sequence[Dict], **kwargs) -> List[str]:
+    """Guides for a batch of painting dicts in one left-padded generate call, each stopping at `<END>`"""
+    kwargs.setdefault('eos_token_id', tokenizer.token_to_id('</s>'))
+    kwargs.setdefault('stop_sequences', [end_marker_ids(tokenizer)])
+    prompts = [tokenizer.encode(painting_prompt(painting)).ids for painting in paintings]
+    outputs = generator.generate(prompts, **kwargs)
+    return [trim_guide(tokenizer.decode(tokens, skip_special_tokens=True)) for tokens in outputs]
+
+
+def generate_guide(generator: OnnxGenerator, tokenizer, painting: Dict, **kwargs) -> str:
+    """ONNX counterpart of `test_model` in test_inference.ipynb for one painting dict"""
+    return generate_guides(generator, tokenizer, [painting], **kwargs)[0]
+
+
+if __name__ == "__main__":
+    import sys
+
+    from token_cache import load_tokenizer
+
+    model_dir = sys.argv[1] if len(sys.argv) > 1 else 'onnx-model'
+    generator = OnnxGenerator(model_dir)
+    tokenizer = load_tokenizer(model_dir)
+    painting = {'title': 'Girl with a Pearl Earring', 'artist': 'Johannes Vermeer', 'date': 'c. 1665',
+                'medium': 'Oil on canvas', 'dimensions': '17.5 × 15.6 in (44.5 × 39.4 cm)'}
+    start = time.perf_counter()
+    print(generate_guide(generator, tokenizer, painting, temperature=0.7, repetition_penalty=1.1))
+    print(f"Generated in {time.perf_counter() - start:.2f}s (KV cache: {generator.has_past})")
@@ -0,0 +1,524 @@
+"""Incremental runner for the data pipeline: only stale stages recompute.
+
+The hand-run chain (harvest -> format and clean -> template generation ->
+dedup -> notebook split -> tokenization -> export) is modelled as stages
+that declare their input and output files. Every stage gets a fingerprint
+over its input file contents, the source of the modules it runs and its
+parameters; a stage whose fingerprint and outputs match the last recorded
+run (in `processed-data/pipeline/state.json`) is skipped. Since downstream
+fingerprints hash content rather than timestamps, a stage that reruns but
+writes identical bytes leaves everything after it skipped.
+
+Stages whose inputs are ready run concurrently in a spawned process pool
+(seed scripts alongside formatting, the train and val tokenizations side by
+side). Formatting and template generation are also incremental per
+painting: each keeps a memo of its output per met_id and the hash of the
+fields it reads, so a change to one painting recomputes only that
+painting's records, and the rest are copied from the memo.
+
+`met_paintings_formatted.json` used to be written by both
+`data_collection.format_paintings` and
+`clean_unicode.restore_from_backup_and_clean`, whichever ran last winning.
+Here the cleaned formatter is its single producer, and two stages may not
+declare the same output.
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import chain
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence
+
+import numpy as np
+
+from storage import iter_records, write_records
+from token_cache import TOKENIZER_FILES, file_sha256
+
+STATE_FILE = 'processed-data/pipeline/state.json'
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class Stage:
+    """A pipeline step: `run(stage)` reads `inputs`, writes `outputs` and returns a summary dict.
+
+    `inputs` and `outputs` map a role to a file path, `params` must be
+    JSON-serialisable and `modules` lists the source files whose code the
+    step depends on. With `memo_dir`, `run` may keep per-record memos there.
+    """
+
+    def __init__(self, name: str, run: Callable, inputs: Dict[str, str], outputs: Dict[str, str],
+                 params: Optional[Dict] = None, modules: Sequence[str] = ()):
+        self.name = name
+        self.run = run
+        self.inputs = inputs
+        self.outputs = outputs
+        self.params = params or {}
+        self.modules = list(modules)
+        self.memo_dir = None
+
+    def code_fingerprint(self) -> str:
+        """Hash of the stage's parameters and module sources; per-record memos are only valid under it"""
+        digest = hashlib.sha256(json.dumps({'stage': self.name, 'params': self.params},
+                                           sort_keys=True, default=str).encode())
+        for module in sorted(set(self.modules + ['pipeline.py'])):
+            digest.update(module.encode())
+            digest.update(file_sha256(os.path.join(SOURCE_DIR, module)).encode())
+        return digest.hexdigest()
+
+    def __repr__(self):
+        return f"Stage({self.name!r})"
+
+
+class FileHasher:
+    """sha256 of files, reusing the recorded hash while a file's size and mtime are unchanged"""
+
+    def __init__(self, known: Optional[Dict[str, List]] = None):
+        self.known = known or {}
+
+    def __call__(self, path: str) -> str:
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        entry = self.known.get(key)
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+        sha = file_sha256(path)
+        self.known[key] = [stat.st_size, stat.st_mtime_ns, sha]
+        return sha
+
+
+def stage_fingerprint(stage: Stage, file_hash: Callable[[str], str]) -> str:
+    digest = hashlib.sha256(stage.code_fingerprint().encode())
+    for role, path in sorted(stage.inputs.items()):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Stage {stage.name!r} needs {path} ({role}), which does not exist")
+        digest.update(f"{role}={file_hash(path)}".encode())
+    return digest.hexdigest()
+
+
+def record_hash(record: Dict, fields: Sequence[str]) -> str:
+    payload = json.dumps({field: record.get(field) for field in fields}, sort_keys=True,
+                         ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def incremental_records(stage: Stage, records: Iterable[Dict], key_field: str, fields: Sequence[str],
+                        compute: Callable[[Dict], List[Dict]], stats: Dict) -> Iterator[Dict]:
+    """Outputs of `compute(record)` for every record, reusing the stage memo for unchanged records.
+
+    A record is unchanged when its `fields` hash matches the memo entry for
+    its `key_field`. The memo is discarded whenever the stage's code or
+    parameters change, and rewritten after the last record with only the
+    keys seen in this run.
+    """
+    memo_file = os.path.join(stage.memo_dir, f"{stage.name}.jsonl")
+    fingerprint = stage.code_fingerprint()
+    memo = {}
+    if os.path.exists(memo_file):
+        entries = iter_records(memo_file)
+        if next(entries, {}).get('fingerprint') == fingerprint:
+            memo = {entry['key']: entry for entry in entries}
+
+    stats.update(records=0, recomputed=0)
+    new_memo = [{'fingerprint': fingerprint}]
+    for record in records:
+        key = str(record.get(key_field))
+        digest = record_hash(record, fields)
+        entry = memo.get(key)
+        if entry is None or entry['hash'] != digest:
+            entry = {'key': key, 'hash': digest, 'outputs': compute(record)}
+            stats['recomputed'] += 1
+        stats['records'] += 1
+        new_memo.append(entry)
+        yield from entry['outputs']
+
+    os.makedirs(stage.memo_dir, exist_ok=True)
+    tmp_file = os.path.join(stage.memo_dir, f"{stage.name}.tmp.jsonl")
+    write_records(tmp_file, new_memo, ensure_ascii=False)
+    os.replace(tmp_file, memo_file)
+
+
+# Stage bodies: module level so spawned workers can unpickle them
+
+def run_harvest(stage: Stage) -> Dict:
+    from data_collection import get_met_paintings_raw
+
+    # The checkpoint shards and response cache live next to the raw file, under the stages' raw_dir
+    raw_dir = os.path.dirname(stage.outputs['raw'])
+    raw_paintings = get_met_paintings_raw(stage.params['limit'], use_async=stage.params['use_async'],
+                                          raw_file=stage.outputs['raw'],
+                                          checkpoint_dir=os.path.join(raw_dir, 'harvest'),
+                                          cache_file=os.path.join(raw_dir, 'http-cache.sqlite'))
+    return {'paintings': len(raw_paintings)}
+
+
+def run_seeds(stage: Stage) -> Dict:
+    from generate_audio_scripts import create_seed_scripts
+
+    seeds = create_seed_scripts()
+    with open(stage.outputs['seeds'], 'w') as f:
+        json.dump(seeds, f, indent=2)
+    return {'seeds': len(seeds)}
+
+
+def run_format(stage: Stage) -> Dict:
+    """Format and clean raw paintings (clean_unicode.restore_from_backup_and_clean), per painting"""
+    from clean_unicode import CLEAN_FIELDS, iter_cleaned_paintings
+
+    stats = {}
+    raw_paintings = iter_records(stage.inputs['raw'], columns=CLEAN_FIELDS)
+    formatted = incremental_records(stage, raw_paintings, 'objectID', CLEAN_FIELDS,
+                                    lambda raw: list(iter_cleaned_paintings([raw])), stats)
+    write_records(stage.outputs['formatted'], formatted, ensure_ascii=False)
+    return stats
+
+
+def run_search_index(stage: Stage) -> Dict:
+    from search_index import build_search_index
+
+    manifest = build_search_index(iter_records(stage.inputs['formatted']),
+                                  os.path.dirname(stage.outputs['manifest']))
+    return {'paintings': manifest['count'], 'terms': manifest['terms']}
+
+
+def run_images(stage: Stage) -> Dict:
+    """Prefetch and resize painting images; the store itself skips images it already holds"""
+    from image_store import painting_images, prefetch_images
+
+    raw_paintings = iter_records(stage.inputs['raw'], columns=['objectID', 'primaryImage', 'primaryImageSmall'])
+    stats = prefetch_images(painting_images(raw_paintings), os.path.dirname(stage.outputs['index']),
+                            concurrency=stage.params['concurrency'])
+    return {key: stats[key] for key in ('stored', 'skipped', 'failed')}
+
+
+def run_templates(stage: Stage) -> Dict:
+    """Seed examples then template variations (generate_audio_scripts.create_bulk_training_data), per painting"""
+    from generate_audio_scripts import (TRAINING_FIELDS, compile_template, create_script_templates,
+                                        painting_training_examples, seed_training_examples)
+
+    renderers = [compile_template(template) for template in create_script_templates()]
+    seed, variants = stage.params['seed'], stage.params['variants']
+    stats = {}
+    paintings = iter_records(stage.inputs['formatted'], columns=TRAINING_FIELDS)
+    variations = incremental_records(
+        stage, paintings, 'met_id', TRAINING_FIELDS,
+        lambda painting: list(painting_training_examples([painting], renderers, seed, variants)), stats)
+    stats['examples'] = write_records(stage.outputs['bulk'], chain(seed_training_examples(), variations),
+                                      ensure_ascii=False)
+    return stats
+
+
+def run_dedup(stage: Stage) -> Dict:
+    from dedup import deduplicate_training_file
+
+    return deduplicate_training_file(stage.inputs['bulk'], stage.outputs['dedup'], **stage.params)
+
+
+def split_indices(count: int, test_size: float = 0.1, random_state: int = 42):
+    """Train and validation indices exactly as sklearn's train_test_split (used by finetune.ipynb) picks them"""
+    n_test = int(np.ceil(test_size * count))
+    permutation = np.random.RandomState(random_state).permutation(count)
+    return permutation[n_test:], permutation[:n_test]
+
+
+def split_training_file(input_file: str, train_file: str, val_file: str, test_size: float = 0.1,
+                        random_state: int = 42) -> Dict:
+    """Write the notebook's train/val split of `input_file`"""
+    examples = list(iter_records(input_file))
+    train, val = split_indices(len(examples), test_size, random_state)
+    write_records(train_file, (examples[i] for i in train), ensure_ascii=False)
+    write_records(val_file, (examples[i] for i in val), ensure_ascii=False)
+    return {'train': len(train), 'val': len(val)}
+
+
+def run_split(stage: Stage) -> Dict:
+    return split_training_file(stage.inputs['dedup'], stage.outputs['train'], stage.outputs['val'], **stage.params)
+
+
+def run_tokenize(stage: Stage) -> Dict:
+    """Build the token cache for one split and point `<split>.json` at it"""
+    from token_cache import build_token_cache
+
+    cache_dir = os.path.dirname(stage.outputs['pointer'])
+    path = build_token_cache(stage.inputs['data'], stage.params['tokenizer_dir'], cache_dir,
+                             stage.params['max_length'])
+    with open(os.path.join(path, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    with open(stage.outputs['pointer'], 'w') as f:
+        json.dump({'cache_dir': path, **meta}, f, indent=2)
+    return {'examples': meta['examples'], 'tokens': meta['tokens']}
+
+
+def run_export(stage: Stage) -> Dict:
+    from export_model import export_to_onnx, merge_lora, quantize_onnx
+
+    merged_dir = merge_lora(stage.params['base_model'], stage.params['adapter_dir'], streaming=True)
+    onnx_dir = export_to_onnx(merged_dir, os.path.dirname(stage.outputs['onnx']))
+    quantize_onnx(onnx_dir, os.path.dirname(stage.outputs['onnx_int8']))
+    return {'onnx_dir': onnx_dir}
+
+
+def default_stages(raw_dir: str = 'raw-data', processed_dir: str = 'processed-data',
+                   tokenizer_dir: str = 'onnx-model', harvest_limit: Optional[int] = None,
+                   export: bool = False, images: bool = False, adapter_dir: str = './trained-models/paintings-audio-guide-final',
+                   base_model: str = 'mistralai/Mistral-7B-Instruct-v0.3') -> List[Stage]:
+    """The repo pipeline. Harvesting and image prefetch (network) and export (needs trained adapters) are opt-in."""
+    raw_file = os.path.join(raw_dir, 'met_paintings_complete_raw.json')
+    formatted_file = os.path.join(raw_dir, 'met_paintings_formatted.json')
+    bulk_file = os.path.join(raw_dir, 'training_examples_bulk.json')
+    dedup_file = os.path.join(raw_dir, 'training_examples_dedup.json')
+    train_file = os.path.join(processed_dir, 'train_data.json')
+    val_file = os.path.join(processed_dir, 'val_data.json')
+
+    stages = []
+    if harvest_limit:
+        stages.append(Stage('harvest', run_harvest, {}, {'raw': raw_file},
+                            {'limit': harvest_limit, 'use_async': True},
+                            ['data_collection.py', 'harvest_checkpoint.py', 'http_cache.py', 'storage.py']))
+    stages += [
+        Stage('seeds', run_seeds, {}, {'seeds': os.path.join(raw_dir, 'seed_scripts.json')},
+              modules=['generate_audio_scripts.py']),
+        Stage('format', run_format, {'raw': raw_file}, {'formatted': formatted_file},
+              modules=['clean_unicode.py', 'storage.py']),
+        Stage('search_index', run_search_index, {'formatted': formatted_file},
+              {'manifest': os.path.join(processed_dir, 'search-index', 'manifest.json')},
+              modules=['search_index.py', 'storage.py']),
+        Stage('templates', run_templates, {'formatted': formatted_file}, {'bulk': bulk_file},
+              {'seed': 0, 'variants': 2}, ['generate_audio_scripts.py', 'storage.py']),
+        Stage('dedup', run_dedup, {'bulk': bulk_file}, {'dedup': dedup_file},
+              {'threshold': 0.8, 'num_perm': 128, 'shingle_size': 5},
+              ['dedup.py', 'generate_audio_scripts.py', 'storage.py']),
+        Stage('split', run_split, {'dedup': dedup_file}, {'train': train_file, 'val': val_file},
+              {'test_size': 0.1, 'random_state': 42}, ['storage.py']),
+    ]
+    if images:
+        stages.append(Stage('images', run_images, {'raw': raw_file},
+                            {'index': os.path.join(processed_dir, 'images', 'index.jsonl')}, {'concurrency': 16},
+                            ['image_store.py', 'storage.py']))
+    tokenizer_files = {name: os.path.join(tokenizer_dir, name) for name in TOKENIZER_FILES
+                       if os.path.exists(os.path.join(tokenizer_dir, name))}
+    for split, data_file in (('train', train_file), ('val', val_file)):
+        stages.append(Stage(f"tokenize_{split}", run_tokenize, {'data': data_file, **tokenizer_files},
+                            {'pointer': os.path.join(processed_dir, 'token-cache', f"{split}_data.json")},
+                            {'tokenizer_dir': tokenizer_dir, 'max_length': 512},
+                            ['token_cache.py', 'storage.py']))
+    if export:
+        adapter_files = {name: os.path.join(adapter_dir, name)
+                         for name in ('adapter_config.json', 'adapter_model.safetensors')}
+        stages.append(Stage('export', run_export, adapter_files,
+                            {'onnx': 'onnx-model/model.onnx', 'onnx_int8': 'onnx-int8/model.onnx'},
+                            {'base_model': base_model, 'adapter_dir': adapter_dir},
+                            ['export_model.py', 'lora_merge.py']))
+    return stages
+
+
+def plan(stages: List[Stage], targets: Optional[Sequence[str]] = None) -> Dict[str, List[str]]:
+    """Upstream stage names of each stage needed for `targets` (all stages by default), in topological order"""
+    producers = {}
+    for stage in stages:
+        for path in stage.outputs.values():
+            path = os.path.abspath(path)
+            if path in producers:
+                raise ValueError(f"Stages {producers[path]!r} and {stage.name!r} both write {path}")
+            producers[path] = stage.name
+    by_name = {stage.name: stage for stage in stages}
+    upstream = {stage.name: sorted({producers[os.path.abspath(path)] for path in stage.inputs.values()
+                                    if os.path.abspath(path) in producers})
+                for stage in stages}
+
+    order, visiting = {}, set()
+
+    def visit(name):
+        if name in order:
+            return
+        if name in visiting:
+            raise ValueError(f"Stage {name!r} is part of a dependency cycle")
+        if name not in by_name:
+            raise KeyError(f"Unknown stage {name!r}; stages are {', '.join(by_name)}")
+        visiting.add(name)
+        for dependency in upstream[name]:
+            visit(dependency)
+        visiting.discard(name)
+        order[name] = upstream[name]
+
+    for name in targets or by_name:
+        visit(name)
+    return order
+
+
+def _load_state(state_file: str) -> Dict:
+    if os.path.exists(state_file):
+        with open(state_file, 'r') as f:
+            return json.load(f)
+    return {'stages': {}, 'files': {}}
+
+
+def _save_state(state_file: str, state: Dict):
+    os.makedirs(os.path.dirname(state_file) or '.', exist_ok=True)
+    with open(state_file + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(state_file + '.tmp', state_file)
+
+
+def _execute(stage: Stage) -> Dict:
+    start = time.perf_counter()
+    summary = stage.run(stage)
+    return {'seconds': round(time.perf_counter() - start, 3), **(summary or {})}
+
+
+def run_pipeline(stages: Optional[List[Stage]] = None, targets: Optional[Sequence[str]] = None,
+                 force: Sequence[str] = (), workers: Optional[int] = None,
+                 state_file: str = STATE_FILE) -> Dict[str, Dict]:
+    """Run the stale stages needed for `targets`; returns each stage's status and summary.
+
+    A stage is up to date when its fingerprint equals the recorded one and
+    every output still has the recorded hash, so hand-edited or deleted
+    outputs are rebuilt. Stages in `force` always run. Ready stages run in
+    parallel on up to `workers` processes. After a failure the stages that
+    do not depend on it still run; the rest are reported as blocked.
+    """
+    stages = stages if stages is not None else default_stages()
+    by_name = {stage.name: stage for stage in stages}
+    order = plan(stages, targets)
+    state = _load_state(state_file)
+    file_hash = FileHasher(state.get('files'))
+    memo_dir = os.path.join(os.path.dirname(state_file) or '.', 'memo')
+    results = {}
+    fingerprints = {}
+
+    def up_to_date(stage, fingerprint):
+        recorded = state['stages'].get(stage.name)
+        if stage.name in force or not recorded or recorded['fingerprint'] != fingerprint:
+            return False
+        return all(os.path.exists(path) and file_hash(path) == recorded['outputs'].get(role)
+                   for role, path in stage.outputs.items())
+
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers or min(len(order), os.cpu_count() or 1),
+                             mp_context=context) as pool:
+        pending = list(order)
+        running = {}
+        while pending or running:
+            for name in list(pending):
+                statuses = [results.get(dependency, {}).get('status') for dependency in order[name]]
+                if any(status in ('failed', 'blocked') for status in statuses):
+                    results[name] = {'status': 'blocked'}
+                    pending.remove(name)
+                elif all(status in ('ran', 'skipped') for status in statuses):
+                    pending.remove(name)
+                    stage = by_name[name]
+                    fingerprints[name] = stage_fingerprint(stage, file_hash)
+                    if up_to_date(stage, fingerprints[name]):
+                        results[name] = {'status': 'skipped'}
+                        print(f"[{name}] up to date")
+                        continue
+                    stage.memo_dir = memo_dir
+                    print(f"[{name}] running")
+                    running[pool.submit(_execute, stage)] = name
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                stage = by_name[name]
+                try:
+                    summary = future.result()
+                except Exception as e:
+                    results[name] = {'status': 'failed', 'error': repr(e)}
+                    print(f"[{name}] failed: {e!r}")
+                    continue
+                missing = [path for path in stage.outputs.values() if not os.path.exists(path)]
+                if missing:
+                    results[name] = {'status': 'failed', 'error': f"did not write {', '.join(missing)}"}
+                    print(f"[{name}] failed: did not write {', '.join(missing)}")
+                    continue
+                state['stages'][name] = {
+                    'fingerprint': fingerprints[name],
+                    'outputs': {role: file_hash(path) for role, path in stage.outputs.items()},
+                    'summary': summary,
+                }
+                state['files'] = file_hash.known
+                _save_state(state_file, state)
+                results[name] = {'status': 'ran', **summary}
+                print(f"[{name}] done: {json.dumps(summary)}")
+    return results
+
+
+def check_incremental():
+    """Run the pipeline on a small synthetic collection and check what reruns after edits.
+
+    A no-op rerun must skip everything; editing one painting must recompute
+    only its formatted record and template examples; changing a field the
+    formatter drops must stop at formatting. The incremental outputs must
+    equal the full restore_from_backup_and_clean + create_bulk_training_data run.
+    """
+    import tempfile
+
+    from benchmarks import synthetic_raw_paintings
+    from clean_unicode import restore_from_backup_and_clean
+    from generate_audio_scripts import create_bulk_training_data
+
+    def statuses(results):
+        return {name: result['status'] for name, result in results.items()}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        raw_dir, processed_dir = os.path.join(tmp, 'raw-data'), os.path.join(tmp, 'processed-data')
+        os.makedirs(raw_dir)
+        raw_file = os.path.join(raw_dir, 'met_paintings_complete_raw.json')
+        raw_paintings = list(synthetic_raw_paintings(300))
+        write_records(raw_file, raw_paintings, ensure_ascii=False)
+
+        tokenizer_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'onnx-model')
+        stages = default_stages(raw_dir, processed_dir, tokenizer_dir)
+        state_file = os.path.join(processed_dir, 'pipeline', 'state.json')
+        first = run_pipeline(stages, state_file=state_file)
+        assert set(statuses(first).values()) == {'ran'}, first
+        assert set(statuses(run_pipeline(stages, state_file=state_file)).values()) == {'skipped'}
+
+        raw_paintings[17]['title'] += ' (detail)'
+        write_records(raw_file, raw_paintings, ensure_ascii=False)
+        edited = run_pipeline(stages, state_file=state_file)
+        assert edited['seeds']['status'] == 'skipped'
+        assert edited['format']['recomputed'] == 1 and edited['templates']['recomputed'] == 1, edited
+
+        raw_paintings[40]['primaryImage'] = 'https://images.metmuseum.org/changed.jpg'
+        write_records(raw_file, raw_paintings, ensure_ascii=False)
+        dropped = statuses(run_pipeline(stages, state_file=state_file))
+        assert dropped['format'] == 'ran' and dropped['templates'] == 'skipped', dropped
+
+        formatted_file = os.path.join(tmp, 'formatted.json')
+        bulk_file = os.path.join(tmp, 'bulk.json')
+        restore_from_backup_and_clean(raw_file, formatted_file)
+        create_bulk_training_data(formatted_file, bulk_file)
+        assert file_sha256(formatted_file) == file_sha256(os.path.join(raw_dir, 'met_paintings_formatted.json'))
+        assert file_sha256(bulk_file) == file_sha256(os.path.join(raw_dir, 'training_examples_bulk.json'))
+
+        train = list(iter_records(os.path.join(processed_dir, 'train_data.json')))
+        val = list(iter_records(os.path.join(processed_dir, 'val_data.json')))
+        assert len(train) + len(val) == first['dedup']['kept']
+    print("Check passed: unchanged stages skipped, one-painting edits recomputed one record")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the stale stages of the data pipeline")
+    parser.add_argument('targets', nargs='*', help="stages to bring up to date (default: all)")
+    parser.add_argument('--force', nargs='+', default=[], metavar='STAGE', help="rerun these stages regardless")
+    parser.add_argument('--workers', type=int, help="stages run in parallel (default: CPU count)")
+    parser.add_argument('--harvest', type=int, metavar='LIMIT', help="include the Met API harvest stage")
+    parser.add_argument('--images', action='store_true', help="include the image prefetch + thumbnail stage")
+    parser.add_argument('--export', action='store_true', help="include the LoRA merge + ONNX export stage")
+    parser.add_argument('--check', action='store_true', help="check incremental reruns on a synthetic collection")
+    args = parser.parse_args()
+
+    if args.check:
+        check_incremental()
+        sys.exit(0)
+
+    results = run_pipeline(default_stages(harvest_limit=args.harvest, images=args.images, export=args.export),
+                           args.targets or None, args.force, args.workers)
+    sys.exit(1 if any(result['status'] in ('failed', 'blocked') for result in results.values()) else 0)
@@ -0,0 +1,291 @@
+"""Offline bulk pre-generation of audio guides for the whole collection.
+
+Paintings from `met_paintings_formatted.json` are tokenized once, sorted by
+prompt length and cut into batches inside length buckets, so each batch
+pads to a near-uniform shape. Batches are spread over a process pool of
+onnxruntime sessions sized to the physical cores, each with its own
+intra-op thread count. Finished guides are appended to a JSONL file as
+batches complete; rerunning the job skips every painting already in it, so
+an interrupted run resumes where it stopped. Outputs live under a directory
+named after the model fingerprint and decoding parameters, so a new model
+never mixes with an old run.
+"""
+
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Set
+
+import numpy as np
+
+from guide_cache import DEFAULT_PARAMS, PROMPT_FIELDS, model_fingerprint
+from storage import iter_records
+
+_worker: Dict = {}
+
+
+def physical_cores() -> int:
+    try:
+        import psutil
+
+        return psutil.cpu_count(logical=False) or os.cpu_count() or 1
+    except ImportError:
+        return os.cpu_count() or 1
+
+
+def plan_batches(lengths: List[int], batch_size: int = 8, bucket_width: int = 16) -> List[List[int]]:
+    """Indices grouped into batches of similar prompt length, longest bucket first.
+
+    Batches never cross a `bucket_width`-token bucket, so padding within a
+    batch stays below one bucket.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: (-lengths[i], i))
+    batches: List[List[int]] = []
+    current: List[int] = []
+    for i in order:
+        if current and (len(current) >= batch_size or lengths[i] // bucket_width != lengths[current[0]] // bucket_width):
+            batches.append(current)
+            current = []
+        current.append(i)
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _init_worker(model_dir: str, tokenizer_dir: str, intra_op_threads: int, core_queue=None):
+    import onnxruntime as ort
+
+    from cold_start import open_generator
+    from token_cache import load_tokenizer
+
+    _worker['tokenizer'] = load_tokenizer(tokenizer_dir)
+    if core_queue is not None:
+        from shared_weights import open_worker_generator
+
+        _worker['generator'] = open_worker_generator(model_dir, core_queue.get(), shared=True)
+        return
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = intra_op_threads
+    options.inter_op_num_threads = 1
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    _worker['generator'], _ = open_generator(model_dir, session_options=options, warm_up_shapes=None)
+
+
+def _generate_batch(paintings: List[Dict], params: Dict) -> Dict:
+    """Worker: guides for one batch plus its wall time"""
+    from onnx_generation import generate_guides
+
+    start = time.perf_counter()
+    guides = generate_guides(_worker['generator'], _worker['tokenizer'], paintings, **params)
+    return {'guides': guides, 'seconds': time.perf_counter() - start}
+
+
+def _completed_ids(guides_file: str) -> Set:
+    """met_ids already written; a torn final line from a crash is truncated away"""
+    done = set()
+    if not os.path.exists(guides_file):
+        return done
+    with open(guides_file, 'rb+') as f:
+        offset = 0
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if not line.endswith(b'\n'):
+                break
+            done.add(record['met_id'])
+            offset += len(line)
+        f.truncate(offset)
+    return done
+
+
+def pregenerate(formatted_file: str = 'raw-data/met_paintings_formatted.json',
+                out_dir: str = 'processed-data/pregenerated',
+                model_dir: str = 'onnx-model',
+                tokenizer_dir: Optional[str] = None,
+                workers: Optional[int] = None,
+                threads_per_worker: Optional[int] = None,
+                batch_size: int = 8,
+                bucket_width: int = 16,
+                params: Optional[Dict] = None,
+                cache_file: Optional[str] = None,
+                limit: Optional[int] = None,
+                shared_weights: bool = False) -> Dict:
+    """Generate a guide for every painting not yet in this model's output; returns a throughput report.
+
+    By default the pool has one worker per 4 physical cores (at least one),
+    and the cores are split evenly between workers as intra-op threads.
+    Workers are spawned rather than forked, so they start with fresh
+    onnxruntime and tokenizers thread pools. With `cache_file`, guides are
+    also stored in the guide cache for guide_server. With `shared_weights`,
+    workers are pinned to disjoint cores and map one copy of the weights
+    (shared_weights.py) instead of each loading its own.
+    """
+    from token_cache import load_tokenizer
+    from onnx_generation import painting_prompt
+
+    tokenizer_dir = tokenizer_dir or model_dir
+    params = params or DEFAULT_PARAMS
+    cores = physical_cores()
+    workers = workers or max(1, cores // (threads_per_worker or 4))
+    threads_per_worker = threads_per_worker or max(1, cores // workers)
+
+    version = model_fingerprint(model_dir)
+    run_key = json.dumps({'model': version, 'params': params}, sort_keys=True)
+    run_dir = os.path.join(out_dir, hashlib.sha256(run_key.encode()).hexdigest()[:16])
+    os.makedirs(run_dir, exist_ok=True)
+    guides_file = os.path.join(run_dir, 'guides.jsonl')
+    manifest_file = os.path.join(run_dir, 'manifest.json')
+
+    done = _completed_ids(guides_file)
+    paintings = []
+    for seen, painting in enumerate(iter_records(formatted_file, columns=['met_id'] + PROMPT_FIELDS)):
+        if limit is not None and seen >= limit:
+            break
+        if painting['met_id'] not in done:
+            paintings.append(painting)
+    print(f"Pre-generating {len(paintings)} guides ({len(done)} already done) "
+          f"on {workers} worker(s) x {threads_per_worker} thread(s)")
+
+    tokenizer = load_tokenizer(tokenizer_dir)
+    lengths = [len(encoding.ids) for encoding in
+               tokenizer.encode_batch([painting_prompt(painting) for painting in paintings])]
+    batches = plan_batches(lengths, batch_size, bucket_width)
+
+    context = multiprocessing.get_context('spawn')
+    core_queue = None
+    if shared_weights:
+        from shared_weights import core_sets, shared_model_dir
+
+        shared_model_dir(model_dir)
+        core_queue = context.Queue()
+        for cores in core_sets(workers, threads_per_worker):
+            core_queue.put(cores)
+
+    cache = None
+    if cache_file:
+        from guide_cache import GuideCache
+        cache = GuideCache(cache_file, version)
+
+    latencies: List[float] = []
+    start = time.perf_counter()
+    with open(guides_file, 'a', encoding='utf-8') as out, \
+            ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                                initargs=(model_dir, tokenizer_dir, threads_per_worker, core_queue)) as pool:
+        in_flight = deque()
+
+        def collect(future, batch):
+            result = future.result()
+            batch_paintings = [paintings[i] for i in batch]
+            for painting, guide in zip(batch_paintings, result['guides']):
+                out.write(json.dumps({'met_id': painting['met_id'], 'title': painting['title'],
+                                      'artist': painting['artist'], 'guide': guide}, ensure_ascii=False) + '\n')
+            out.flush()
+            if cache is not None:
+                cache.put_many(zip(batch_paintings, result['guides']), params)
+            # Every guide in a batch waits for the whole batch
+            latencies.extend([result['seconds']] * len(batch))
+
+        for batch in batches:
+            in_flight.append((pool.submit(_generate_batch, [paintings[i] for i in batch], params), batch))
+            if len(in_flight) >= 2 * workers:
+                collect(*in_flight.popleft())
+        while in_flight:
+            collect(*in_flight.popleft())
+    elapsed = time.perf_counter() - start
+
+    report = {
+        'run_dir': run_dir,
+        'model_version': version,
+        'params': params,
+        'generated': len(latencies),
+        'total_done': len(done) + len(latencies),
+        'batches': len(batches),
+        'workers': workers,
+        'threads_per_worker': threads_per_worker,
+        'shared_weights': shared_weights,
+        'seconds': round(elapsed, 2),
+        'guides_per_sec': round(len(latencies) / elapsed, 3) if elapsed and latencies else 0.0,
+        'latency_p50_s': round(float(np.percentile(latencies, 50)), 3) if latencies else None,
+        'latency_p99_s': round(float(np.percentile(latencies, 99)), 3) if latencies else None,
+    }
+    with open(manifest_file, 'w') as f:
+        json.dump({**report, 'formatted_file': formatted_file, 'guides_file': guides_file}, f, indent=2)
+    print(f"Generated {report['generated']} guides in {report['seconds']}s: {report['guides_per_sec']} guides/s, "
+          f"p50 {report['latency_p50_s']}s, p99 {report['latency_p99_s']}s per guide")
+    print(f"Saved to {guides_file}")
+    return report
+
+
+def check_tiny_model(paintings: int = 12, max_new_tokens: int = 24):
+    """Pre-generate with a tiny random Mistral over two workers, interrupt, resume and compare with generate_guides.
+
+    The interrupted run leaves a torn last line behind; the resumed run must
+    drop it and generate exactly the missing guides.
+    """
+    import tempfile
+
+    import torch
+
+    from export_model import export_with_past, tiny_mistral
+    from onnx_generation import OnnxGenerator, generate_guides
+    from token_cache import load_tokenizer
+
+    params = {'max_new_tokens': max_new_tokens, 'temperature': 0.0, 'repetition_penalty': 1.1}
+    with tempfile.TemporaryDirectory() as work_dir:
+        model_dir = os.path.join(work_dir, 'model')
+        os.makedirs(model_dir)
+        export_with_past(tiny_mistral(), os.path.join(model_dir, 'model.onnx'), torch.tensor([[1, 2, 3]]))
+        options = dict(out_dir=os.path.join(work_dir, 'out'), model_dir=model_dir, tokenizer_dir='onnx-model',
+                       workers=2, threads_per_worker=1, batch_size=4, params=params)
+
+        first = pregenerate(limit=paintings // 2, **options)
+        with open(os.path.join(first['run_dir'], 'guides.jsonl'), 'a') as f:
+            f.write('{"met_id": 1, "gui')
+        second = pregenerate(limit=paintings, **options)
+        assert first['generated'] == paintings // 2
+        assert second['generated'] == paintings - paintings // 2 and second['total_done'] == paintings
+
+        with open(os.path.join(second['run_dir'], 'guides.jsonl'), 'r', encoding='utf-8') as f:
+            records = [json.loads(line) for line in f]
+        expected_paintings = list(iter_records('raw-data/met_paintings_formatted.json'))[:paintings]
+        assert [r['met_id'] for r in sorted(records, key=lambda r: r['met_id'])] == \
+            sorted(p['met_id'] for p in expected_paintings)
+
+        generator = OnnxGenerator(model_dir)
+        tokenizer = load_tokenizer('onnx-model')
+        guides = {r['met_id']: r['guide'] for r in records}
+        for painting in expected_paintings:
+            expected = generate_guides(generator, tokenizer, [painting], **params)[0]
+            assert guides[painting['met_id']] == expected, (guides[painting['met_id']], expected)
+    print(f"Check passed: {paintings} guides, resumed after an interrupted run, identical to unbatched generation")
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    if "--check" in sys.argv:
+        check_tiny_model()
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="Pre-generate audio guides for the whole collection")
+    parser.add_argument('--formatted-file', default='raw-data/met_paintings_formatted.json')
+    parser.add_argument('--model-dir', default='onnx-model')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--threads-per-worker', type=int, default=None)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--limit', type=int, default=None)
+    parser.add_argument('--cache', default=None, help="also store guides in this guide cache file")
+    parser.add_argument('--shared-weights', action='store_true',
+                        help="pin workers to disjoint cores and share one memory-mapped copy of the weights")
+    args = parser.parse_args()
+
+    pregenerate(args.formatted_file, model_dir=args.model_dir, workers=args.workers,
+                threads_per_worker=args.threads_per_worker, batch_size=args.batch_size,
+                cache_file=args.cache, limit=args.limit, shared_weights=args.shared_weights)
@@ -0,0 +1,232 @@
+"""Prompt-lookup speculative decoding for audio-guide generation.
+
+Guides repeat long spans of their prompt (title, artist, date, medium, the
+full dimensions string). Each step looks up the most recent n-gram of the
+sequence earlier in the sequence, proposes the tokens that followed it as a
+draft, and checks the whole draft in one forward pass over the KV cache.
+Draft tokens are kept only while they equal the greedy choice at their
+position, and the first mismatch is replaced by that greedy choice, so the
+output is token-for-token the greedy output; rejected positions are cropped
+from the cache.
+
+Works over the ONNX graph from `export_model.export_with_past`
+(`OnnxBackend`) or a transformers model (`TorchBackend`), one sequence at
+a time.
+"""
+
+import time
+from typing import Dict, List, Sequence, Tuple, Union
+
+import numpy as np
+
+from instrumentation import count, observe, span
+
+
+def find_draft(tokens: Sequence[int], num_draft_tokens: int = 10, max_ngram: int = 3,
+               min_ngram: int = 1) -> List[int]:
+    """Tokens that followed the first earlier occurrence of the sequence's last n-gram (longest n first)"""
+    if num_draft_tokens <= 0:
+        return []
+    tokens = np.asarray(tokens)
+    for n in range(min(max_ngram, len(tokens) - 1), min_ngram - 1, -1):
+        windows = np.lib.stride_tricks.sliding_window_view(tokens[:-1], n)
+        matches = np.flatnonzero((windows == tokens[-n:]).all(axis=1))
+        for start in matches:
+            draft = tokens[start + n:start + n + num_draft_tokens]
+            if len(draft):
+                return draft.tolist()
+    return []
+
+
+def greedy_token(logits: np.ndarray, context: Sequence[int], repetition_penalty: float = 1.0) -> int:
+    """Argmax after transformers' repetition penalty over `context`"""
+    if repetition_penalty != 1.0:
+        logits = logits.astype(np.float32)
+        seen = np.unique(np.asarray(context))
+        scores = logits[seen]
+        logits[seen] = np.where(scores < 0, scores * repetition_penalty, scores / repetition_penalty)
+    return int(logits.argmax())
+
+
+class OnnxBackend:
+    """Single-sequence KV-cache stepping over an `onnx_generation.OnnxGenerator`"""
+
+    def __init__(self, generator):
+        if not generator.has_past:
+            raise ValueError("Prompt lookup needs an ONNX graph exported with the KV cache (export_with_past)")
+        self.generator = generator
+        self.past = None
+        self.length = 0
+
+    def extend(self, tokens: List[int]) -> np.ndarray:
+        """Feed `tokens` after the cached ones; returns their logits (len(tokens), vocab)"""
+        attention_mask = np.ones((1, self.length + len(tokens)), dtype=np.int64)
+        logits, self.past = self.generator.forward(np.array([tokens], dtype=np.int64), attention_mask, self.past)
+        self.length += len(tokens)
+        return logits[0]
+
+    def crop(self, length: int):
+        self.past = [tensor[:, :, :length] for tensor in self.past]
+        self.length = length
+
+
+class TorchBackend:
+    """Single-sequence KV-cache stepping over a transformers causal LM (PEFT models included)"""
+
+    def __init__(self, model):
+        from transformers.cache_utils import DynamicCache
+
+        self.model = model
+        self.cache = DynamicCache()
+        self.length = 0
+
+    def extend(self, tokens: List[int]) -> np.ndarray:
+        import torch
+
+        device = next(self.model.parameters()).device
+        with torch.no_grad():
+            outputs = self.model(input_ids=torch.tensor([tokens], device=device),
+                                 past_key_values=self.cache, use_cache=True)
+        self.cache = outputs.past_key_values
+        self.length += len(tokens)
+        return outputs.logits[0].float().cpu().numpy()
+
+    def crop(self, length: int):
+        self.cache.crop(length)
+        self.length = length
+
+
+def prompt_lookup_generate(backend, prompt_ids: Sequence[int],
+                           max_new_tokens: int = 100,
+                           eos_token_id: Union[int, Sequence[int]] = 2,
+                           num_draft_tokens: int = 10,
+                           max_ngram: int = 3,
+                           repetition_penalty: float = 1.0) -> Tuple[List[int], Dict]:
+    """Greedy generation with prompt-lookup drafts; returns (new token ids without EOS, stats).
+
+    `num_draft_tokens=0` is plain incremental greedy decoding (one token per
+    forward pass). Stats: forward passes (`steps`), drafted/accepted draft
+    tokens, the accepted count of every verification pass and tokens per step.
+    """
+    eos_ids = {eos_token_id} if isinstance(eos_token_id, int) else set(eos_token_id)
+    prompt_ids = list(prompt_ids)
+    stats = {'steps': 1, 'drafted': 0, 'accepted': 0, 'accepted_per_step': []}
+
+    start = time.perf_counter()
+    with span('generate', mode='prompt_lookup') as s:
+        logits = backend.extend(prompt_ids)
+        generated = [greedy_token(logits[-1], prompt_ids, repetition_penalty)]
+        observe('generate_ttft_seconds', time.perf_counter() - start)
+
+        while len(generated) < max_new_tokens and generated[-1] not in eos_ids:
+            committed = prompt_ids + generated
+            room = max_new_tokens - len(generated)
+            draft = find_draft(committed, min(num_draft_tokens, room - 1), max_ngram)
+
+            # The last generated token is not in the cache yet; verify it plus the draft in one pass
+            cached = backend.length
+            logits = backend.extend([generated[-1]] + draft)
+            new_tokens = []
+            for position in range(len(draft) + 1):
+                token = greedy_token(logits[position], committed + draft[:position], repetition_penalty)
+                new_tokens.append(token)
+                if position == len(draft) or token != draft[position] or token in eos_ids:
+                    break
+            accepted = len(new_tokens) - 1
+            backend.crop(cached + 1 + accepted)
+
+            stats['steps'] += 1
+            stats['drafted'] += len(draft)
+            stats['accepted'] += accepted
+            stats['accepted_per_step'].append(accepted)
+            generated.extend(new_tokens)
+        s.add(len(generated))
+    count('prompt_lookup_drafted_total', stats['drafted'])
+    count('prompt_lookup_accepted_total', stats['accepted'])
+
+    for i, token in enumerate(generated):
+        if token in eos_ids:
+            generated = generated[:i]
+            break
+    generated = generated[:max_new_tokens]
+    stats['tokens'] = len(generated)
+    stats['tokens_per_step'] = len(generated) / stats['steps']
+    return generated, stats
+
+
+def compare_with_greedy(backend_factory, prompt_ids: Sequence[int], **kwargs) -> Dict:
+    """Run plain greedy and prompt-lookup decoding on fresh backends; report both and whether outputs match"""
+    greedy, greedy_stats = prompt_lookup_generate(backend_factory(), prompt_ids, num_draft_tokens=0,
+                                                  **{k: v for k, v in kwargs.items() if k != 'num_draft_tokens'})
+    lookup, lookup_stats = prompt_lookup_generate(backend_factory(), prompt_ids, **kwargs)
+    return {
+        'identical': greedy == lookup,
+        'tokens': len(lookup),
+        'greedy_steps': greedy_stats['steps'],
+        'lookup_steps': lookup_stats['steps'],
+        'tokens_per_step': lookup_stats['tokens_per_step'],
+        'acceptance_rate': lookup_stats['accepted'] / max(lookup_stats['drafted'], 1),
+    }
+
+
+def check_tiny_model(max_new_tokens: int = 64):
+    """Exactness check on tiny random Mistrals: torch and ONNX prompt lookup vs plain greedy.
+
+    A random model rarely copies its prompt, so this checks exactness rather
+    than speed; runs without a repetition penalty usually fall into loops,
+    which exercises accepted drafts.
+    """
+    import os
+    import tempfile
+
+    import torch
+
+    from export_model import export_with_past, tiny_mistral
+    from onnx_generation import OnnxGenerator, guide_prompt
+    from token_cache import load_tokenizer
+
+    tokenizer = load_tokenizer()
+    prompt_ids = tokenizer.encode(guide_prompt('Dutch Girl in White', 'Robert Henri', '1907', 'Oil on canvas',
+                                               '24 x 20 in. (61 x 50.8 cm)')).ids
+    for seed in range(3):
+        model = tiny_mistral(seed=seed)
+        for penalty in (1.0, 1.1):
+            settings = {'max_new_tokens': max_new_tokens, 'eos_token_id': -1, 'repetition_penalty': penalty}
+            with torch.no_grad():
+                reference = model.generate(torch.tensor([prompt_ids]), do_sample=False, eos_token_id=None,
+                                           pad_token_id=2, max_new_tokens=max_new_tokens,
+                                           repetition_penalty=penalty)[0, len(prompt_ids):].tolist()
+            tokens, stats = prompt_lookup_generate(TorchBackend(model), prompt_ids, **settings)
+            assert tokens == reference, f"torch prompt lookup differs from model.generate (seed {seed})"
+
+            with tempfile.TemporaryDirectory() as work_dir:
+                export_with_past(model, os.path.join(work_dir, 'model.onnx'), torch.tensor([prompt_ids]))
+                generator = OnnxGenerator(work_dir)
+                onnx_tokens, _ = prompt_lookup_generate(OnnxBackend(generator), prompt_ids, **settings)
+                assert onnx_tokens == reference, f"ONNX prompt lookup differs from model.generate (seed {seed})"
+            print(f"seed {seed}, repetition_penalty {penalty}: identical to greedy, "
+                  f"{stats['accepted']} draft tokens accepted, {stats['tokens_per_step']:.2f} tokens/step")
+
+
+if __name__ == "__main__":
+    import sys
+
+    if "--check" in sys.argv:
+        check_tiny_model()
+        sys.exit(0)
+
+    from itertools import islice
+
+    from onnx_generation import OnnxGenerator
+    from storage import iter_records
+    from token_cache import load_tokenizer
+
+    # Per-guide speedup of the exported model on validation prompts
+    generator = OnnxGenerator('onnx-model')
+    tokenizer = load_tokenizer('onnx-model')
+    for example in islice(iter_records('processed-data/val_data.json'), 10):
+        report = compare_with_greedy(lambda: OnnxBackend(generator), tokenizer.encode(example['prompt']).ids,
+                                     eos_token_id=tokenizer.token_to_id('</s>'), repetition_penalty=1.1)
+        print(f"{example['prompt'].splitlines()[0][:40]:<40} {report['tokens']:>4} tokens, "
+              f"{report['greedy_steps']:>4} -> {report['lookup_steps']:>4} passes, "
+              f"{report['tokens_per_step']:.2f} tokens/step, identical: {report['identical']}")
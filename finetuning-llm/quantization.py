@@ -0,0 +1,315 @@
+"""Quantization modes for the exported ONNX model, and a harness to compare them.
+
+- dynamic INT8 (`export_model.quantize_onnx`'s original mode): weights are
+  stored as INT8 and activation scales are recomputed on every call.
+- static INT8: activation ranges are calibrated once on prompts streamed
+  from `processed-data/val_data.json` (prefill plus a few decode steps over
+  the KV cache), and the graph gets fixed QuantizeLinear/DequantizeLinear
+  pairs around each weight MatMul.
+- 4-bit weight-only: MatMul weights become block-wise INT4 `MatMulNBits`
+  nodes; activations stay in float.
+
+Both new modes quantize only MatMuls whose weight is an initializer (the
+projection layers and lm_head); the attention score MatMuls between two
+activations are left in float. `nodes_to_include` / `nodes_to_exclude`
+take node names or fnmatch patterns (e.g. `'*lm_head*'`).
+
+`compare_variants` reports tokens/sec, on-disk size, session load time and
+perplexity on the validation completions for any set of model directories.
+"""
+
+import fnmatch
+import os
+import time
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+
+from storage import iter_records
+
+MODEL_SUFFIXES = ('.onnx', '.data', '.onnx_data')
+
+
+def model_size_mb(model_dir: str) -> float:
+    """Size of the ONNX graph and external weight files in `model_dir`"""
+    return sum(os.path.getsize(os.path.join(model_dir, name)) for name in os.listdir(model_dir)
+               if name.endswith(MODEL_SUFFIXES)) / 2 ** 20
+
+
+def weight_matmuls(model) -> List[str]:
+    """Names of MatMul nodes whose second input is an initializer"""
+    initializers = {tensor.name for tensor in model.graph.initializer}
+    return [node.name for node in model.graph.node if node.op_type == 'MatMul' and node.input[1] in initializers]
+
+
+def select_nodes(candidates: Sequence[str], nodes_to_include: Optional[Sequence[str]] = None,
+                 nodes_to_exclude: Optional[Sequence[str]] = None) -> List[str]:
+    """Candidates matching any include pattern (all when None) and no exclude pattern"""
+    def matches(name, patterns):
+        return any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+
+    return [name for name in candidates
+            if (nodes_to_include is None or matches(name, nodes_to_include))
+            and not matches(name, nodes_to_exclude or ())]
+
+
+def _load_graph(onnx_dir: str, model_file: str = 'model.onnx'):
+    import onnx
+
+    model_path = os.path.join(onnx_dir, model_file)
+    model = onnx.load(model_path, load_external_data=False)
+    # Graphs over 2 GB (the 7B model) keep their weights in external data
+    external = any(tensor.data_location == onnx.TensorProto.EXTERNAL for tensor in model.graph.initializer)
+    return model_path, model, external
+
+
+class ValPromptReader:
+    """onnxruntime CalibrationDataReader streaming validation prompts through prefill and a few greedy decode steps.
+
+    Decode-step feeds carry the KV cache produced by the float model, so the
+    calibrated ranges cover both single-token and full-prompt activations.
+    """
+
+    def __init__(self, onnx_dir: str, val_file: str = 'processed-data/val_data.json',
+                 tokenizer_dir: str = 'onnx-model', num_prompts: int = 64, decode_steps: int = 4):
+        from onnx_generation import OnnxGenerator
+        from token_cache import load_tokenizer
+
+        self.generator = OnnxGenerator(onnx_dir)
+        self.tokenizer = load_tokenizer(tokenizer_dir)
+        self.val_file = val_file
+        self.num_prompts = num_prompts
+        self.decode_steps = decode_steps
+        self.calls = 0
+        self._feeds = self._iter_feeds()
+
+    def _feed(self, input_ids: np.ndarray, attention_mask: np.ndarray, past: Optional[List[np.ndarray]]) -> Dict:
+        from onnx_generation import position_ids_for
+
+        feed = {'input_ids': input_ids, 'attention_mask': attention_mask}
+        if self.generator.uses_position_ids:
+            feed['position_ids'] = position_ids_for(attention_mask, input_ids.shape[1])
+        if self.generator.has_past:
+            feed.update(zip(self.generator.past_names, past or self.generator.empty_cache(input_ids.shape[0])))
+        return feed
+
+    def _iter_feeds(self) -> Iterator[Dict]:
+        for i, example in enumerate(iter_records(self.val_file, columns=['prompt'])):
+            if i >= self.num_prompts:
+                break
+            input_ids = np.array([self.tokenizer.encode(example['prompt']).ids], dtype=np.int64)
+            attention_mask = np.ones_like(input_ids)
+            past = None
+            for step in range(self.decode_steps + 1 if self.generator.has_past else 1):
+                yield self._feed(input_ids, attention_mask, past)
+                logits, past = self.generator.forward(input_ids, attention_mask, past)
+                input_ids = logits[:, -1:].argmax(axis=-1).astype(np.int64)
+                attention_mask = np.ones((1, attention_mask.shape[1] + 1), dtype=np.int64)
+
+    def get_next(self) -> Optional[Dict]:
+        self.calls += 1
+        return next(self._feeds, None)
+
+    def rewind(self):
+        self._feeds = self._iter_feeds()
+
+
+def quantize_static_int8(onnx_dir: str, quant_dir: str = './onnx-int8-static',
+                         val_file: str = 'processed-data/val_data.json',
+                         tokenizer_dir: str = 'onnx-model',
+                         num_prompts: int = 64,
+                         decode_steps: int = 4,
+                         per_channel: bool = True,
+                         nodes_to_include: Optional[Sequence[str]] = None,
+                         nodes_to_exclude: Optional[Sequence[str]] = None) -> str:
+    """Static INT8 (QDQ, uint8 activations / int8 weights) calibrated with MinMax on validation prompts.
+
+    Calibration needs a float32 graph (`export_to_onnx(..., dtype=torch.float32)`).
+    """
+    from onnxruntime.quantization import CalibrationMethod, QuantFormat, QuantType, quantize_static
+
+    model_path, model, external = _load_graph(onnx_dir)
+    if any(value.type.tensor_type.elem_type != 1 for value in model.graph.input if value.name.startswith('past')):
+        raise ValueError("Static calibration needs a float32 graph; export with export_to_onnx(..., dtype=torch.float32)")
+    nodes = select_nodes(weight_matmuls(model), nodes_to_include, nodes_to_exclude)
+    del model
+
+    os.makedirs(quant_dir, exist_ok=True)
+    output_path = os.path.join(quant_dir, 'model.onnx')
+    reader = ValPromptReader(onnx_dir, val_file, tokenizer_dir, num_prompts, decode_steps)
+    print(f"Calibrating static INT8 for {len(nodes)} MatMuls on {num_prompts} prompts from {val_file}")
+    quantize_static(
+        model_input=model_path,
+        model_output=output_path,
+        calibration_data_reader=reader,
+        quant_format=QuantFormat.QDQ,
+        op_types_to_quantize=['MatMul'],
+        nodes_to_quantize=nodes,
+        per_channel=per_channel,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+        calibrate_method=CalibrationMethod.MinMax,
+        use_external_data_format=external,
+        extra_options={'WeightSymmetric': True, 'ActivationSymmetric': False},
+    )
+    print(f"Static INT8 model written to {quant_dir}")
+    return quant_dir
+
+
+def quantize_int4(onnx_dir: str, quant_dir: str = './onnx-int4',
+                  block_size: int = 32,
+                  is_symmetric: bool = True,
+                  accuracy_level: Optional[int] = 4,
+                  nodes_to_include: Optional[Sequence[str]] = None,
+                  nodes_to_exclude: Optional[Sequence[str]] = None) -> str:
+    """Block-wise 4-bit weight-only quantization into MatMulNBits nodes.
+
+    `accuracy_level=4` lets the CPU kernel compute with int8 activations,
+    which is the fast path; 0 keeps float activations.
+    """
+    from onnxruntime.quantization.matmul_nbits_quantizer import MatMulNBitsQuantizer
+
+    model_path, model, external = _load_graph(onnx_dir)
+    nodes = select_nodes(weight_matmuls(model), nodes_to_include, nodes_to_exclude)
+    excluded = [name for name in weight_matmuls(model) if name not in nodes]
+    del model
+
+    import onnx
+
+    quantizer = MatMulNBitsQuantizer(onnx.load(model_path), block_size=block_size, is_symmetric=is_symmetric,
+                                     accuracy_level=accuracy_level, nodes_to_include=nodes,
+                                     nodes_to_exclude=excluded)
+    print(f"Quantizing {len(nodes)} MatMuls to 4 bits (block size {block_size}, {len(excluded)} excluded)")
+    quantizer.process()
+    os.makedirs(quant_dir, exist_ok=True)
+    quantizer.model.save_model_to_file(os.path.join(quant_dir, 'model.onnx'), use_external_data_format=external)
+    print(f"4-bit model written to {quant_dir}")
+    return quant_dir
+
+
+def perplexity(generator, dataset, limit: Optional[int] = None) -> float:
+    """exp of the mean completion-token NLL over a TokenizedDataset (prompt tokens masked as in training)"""
+    total_nll, total_tokens = 0.0, 0
+    for i in range(len(dataset) if limit is None else min(limit, len(dataset))):
+        item = dataset[i]
+        input_ids = np.asarray(item['input_ids'], dtype=np.int64)[None, :]
+        logits, _ = generator.forward(input_ids, np.ones_like(input_ids))
+        logits = logits[0, :-1].astype(np.float64)
+        labels = item['labels'][1:]
+        keep = labels >= 0
+        logits, labels = logits[keep], labels[keep]
+        log_norm = np.log(np.exp(logits - logits.max(axis=1, keepdims=True)).sum(axis=1)) + logits.max(axis=1)
+        total_nll += float((log_norm - logits[np.arange(len(labels)), labels]).sum())
+        total_tokens += int(keep.sum())
+    return float(np.exp(total_nll / max(total_tokens, 1)))
+
+
+def compare_variants(variants: Dict[str, str],
+                     val_file: str = 'processed-data/val_data.json',
+                     tokenizer_dir: str = 'onnx-model',
+                     num_prompts: int = 8,
+                     batch_size: int = 4,
+                     max_new_tokens: int = 64,
+                     perplexity_examples: Optional[int] = 64) -> Dict[str, Dict]:
+    """tokens/sec, size, load time and validation perplexity for each {name: model_dir}.
+
+    Throughput decodes `num_prompts` validation prompts greedily in batches
+    for exactly `max_new_tokens` tokens each, so every variant does the same work.
+    """
+    from onnx_generation import OnnxGenerator
+    from token_cache import load_token_cache, load_tokenizer
+
+    tokenizer = load_tokenizer(tokenizer_dir)
+    prompts = [tokenizer.encode(example['prompt']).ids
+               for _, example in zip(range(num_prompts), iter_records(val_file, columns=['prompt']))]
+    dataset = load_token_cache(val_file, tokenizer_dir)
+
+    results = {}
+    for name, model_dir in variants.items():
+        start = time.perf_counter()
+        generator = OnnxGenerator(model_dir)
+        load_seconds = time.perf_counter() - start
+
+        generator.generate(prompts[:1], max_new_tokens=2, eos_token_id=-1, pad_token_id=0)
+        start = time.perf_counter()
+        tokens = 0
+        for i in range(0, len(prompts), batch_size):
+            outputs = generator.generate(prompts[i:i + batch_size], max_new_tokens=max_new_tokens,
+                                         eos_token_id=-1, pad_token_id=0)
+            tokens += sum(len(output) for output in outputs)
+        decode_seconds = time.perf_counter() - start
+
+        results[name] = {
+            'size_mb': round(model_size_mb(model_dir), 2),
+            'load_s': round(load_seconds, 3),
+            'tokens_per_sec': round(tokens / decode_seconds, 1),
+            'perplexity': round(perplexity(generator, dataset, perplexity_examples), 3),
+        }
+        del generator
+
+    print(f"{'variant':<16}{'size MB':>10}{'load s':>9}{'tok/s':>9}{'ppl':>10}")
+    for name, result in results.items():
+        print(f"{name:<16}{result['size_mb']:>10}{result['load_s']:>9}{result['tokens_per_sec']:>9}"
+              f"{result['perplexity']:>10}")
+    return results
+
+
+def check_tiny_model(work_dir: Optional[str] = None):
+    """Export a tiny float32 Mistral, build every quantized variant and compare them on validation data"""
+    import tempfile
+
+    import torch
+
+    from export_model import export_with_past, quantize_onnx, tiny_mistral
+
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp:
+        model = tiny_mistral()
+        float_dir = os.path.join(tmp, 'float32')
+        os.makedirs(float_dir)
+        export_with_past(model, os.path.join(float_dir, 'model.onnx'), torch.tensor([[1, 2, 3]]))
+
+        variants = {
+            'float32': float_dir,
+            'int8-dynamic': quantize_onnx(float_dir, os.path.join(tmp, 'int8-dynamic')),
+            'int8-static': quantize_onnx(float_dir, os.path.join(tmp, 'int8-static'), mode='static',
+                                         num_prompts=8, decode_steps=2),
+            'int4': quantize_onnx(float_dir, os.path.join(tmp, 'int4'), mode='int4'),
+            'int4-no-head': quantize_onnx(float_dir, os.path.join(tmp, 'int4-no-head'), mode='int4',
+                                          nodes_to_exclude=['*lm_head*']),
+        }
+        results = compare_variants(variants, num_prompts=4, max_new_tokens=16, perplexity_examples=8)
+
+        import onnx
+
+        ops = {name: {node.op_type for node in onnx.load(os.path.join(path, 'model.onnx')).graph.node}
+               for name, path in variants.items()}
+        assert 'QuantizeLinear' in ops['int8-static'] and 'MatMulNBits' in ops['int4']
+        head = [node for node in onnx.load(os.path.join(variants['int4-no-head'], 'model.onnx')).graph.node
+                if 'lm_head' in node.name]
+        assert head and all(node.op_type == 'MatMul' for node in head), [node.op_type for node in head]
+        # A random model's perplexity is near the vocabulary size; quantization must not blow it up
+        for name, result in results.items():
+            assert result['perplexity'] < 2 * results['float32']['perplexity'], (name, result)
+        print("Check passed: every quantized variant loads, decodes and keeps perplexity close to float32")
+        return results
+
+
+if __name__ == "__main__":
+    import sys
+
+    if "--check" in sys.argv:
+        check_tiny_model()
+        sys.exit(0)
+
+    from export_model import quantize_onnx
+
+    # python quantization.py [ONNX_DIR] [--static]; static calibration needs a float32 export
+    source = next((arg for arg in sys.argv[1:] if not arg.startswith('--')), 'onnx-model')
+    variants = {
+        'source': source,
+        'int8-dynamic': quantize_onnx(source, './onnx-int8'),
+        'int4': quantize_onnx(source, './onnx-int4', mode='int4'),
+    }
+    if '--static' in sys.argv:
+        variants['int8-static'] = quantize_onnx(source, './onnx-int8-static', mode='static')
+    compare_variants(variants)
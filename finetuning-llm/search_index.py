@@ -0,0 +1,520 @@
+"""Prebuilt search index over the formatted paintings, for the GraphQL server and Python callers.
+
+`paintingService.getPaintings` used to lowercase and substring-scan the title
+and artist of every painting per request, and `getPaintingById` was a linear
+find. The formatting stages (`format_paintings`, `restore_from_backup_and_clean`)
+now also write this artifact, so a query touches only the postings of its
+terms. The index directory holds:
+
+- `manifest.json`: version, record count, indexed fields and sort orders
+- `records.jsonl` + `offsets.bin` (uint64): the formatted paintings, one per
+  line, and the byte offset of each, so a record is one seek and one read
+- `ids.bin` + `id_docs.bin` (uint32): met_ids sorted, and the record number
+  of each, for binary-search lookup by id
+- `terms.txt`, `postings.bin` and `postings_offsets.bin` (uint64): the sorted
+  term dictionary and its posting lists. Terms are `<field>:<trigram>` over
+  the normalised text (substring search) and `<field>=<word>` (whole-word
+  search). A posting list is the record numbers, delta-encoded as uint32 and
+  raw-deflated when that is smaller (first byte 1, else 0 and raw deltas)
+- `text.txt`: the normalised fields of each record, tab-separated, used to
+  confirm trigram candidates and to scan queries shorter than a trigram
+- `order-<key>.bin` (uint32): record numbers sorted by title, artist, year
+  and met_id, so a sorted page of an unfiltered listing is a slice
+
+All binary files are little-endian. Text is normalised by NFKD-decomposing,
+dropping combining marks, lowercasing and collapsing whitespace, so "Dürer"
+matches "durer"; trigrams are over code points.
+"""
+
+import bisect
+import json
+import os
+import re
+import shutil
+import sys
+import time
+import unicodedata
+import zlib
+from array import array
+from itertools import accumulate, chain
+from operator import sub
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence
+
+from instrumentation import span
+
+INDEX_VERSION = 1
+INDEX_DIR = 'processed-data/search-index'
+INDEX_FIELDS = ('title', 'artist', 'medium', 'culture')
+SORT_KEYS = ('title', 'artist', 'year', 'met_id')
+_YEAR = re.compile(r'\d{3,4}')
+_WORD = re.compile(r'\w+')
+_LITTLE = sys.byteorder == 'little'
+
+
+def normalize(text) -> str:
+    """Accent-stripped, lowercased text with whitespace runs collapsed to one space.
+
+    Kept to what JavaScript reproduces (`normalize('NFKD')`, dropping `\\p{M}`,
+    `toLowerCase()`), so the server normalises queries the same way.
+    """
+    if not text:
+        return ''
+    text = str(text)
+    if not text.isascii():
+        text = ''.join(c for c in unicodedata.normalize('NFKD', text) if not unicodedata.category(c).startswith('M'))
+    return ' '.join(text.lower().split())
+
+
+def trigrams(text: str) -> set:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def painting_year(date) -> Optional[int]:
+    """First 3-4 digit number of a free-text date ("ca. 1665-70" -> 1665)"""
+    match = _YEAR.search(date or '')
+    return int(match.group()) if match else None
+
+
+def _uint_array(typecode: str, values=()) -> array:
+    return array(typecode, values)
+
+
+def _write_array(path: str, values: array):
+    if not _LITTLE:
+        values = array(values.typecode, values)
+        values.byteswap()
+    with open(path, 'wb') as f:
+        values.tofile(f)
+
+
+def _read_array(path: str, typecode: str) -> array:
+    values = array(typecode)
+    with open(path, 'rb') as f:
+        values.frombytes(f.read())
+    if not _LITTLE:
+        values.byteswap()
+    return values
+
+
+def encode_postings(docs: array) -> bytes:
+    """Delta-encode ascending record numbers, raw-deflating them when that is smaller"""
+    deltas = array('I', map(sub, docs, chain((0,), docs)))
+    if not _LITTLE:
+        deltas.byteswap()
+    raw = deltas.tobytes()
+    if len(raw) > 32:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        packed = compressor.compress(raw) + compressor.flush()
+        if len(packed) < len(raw):
+            return b'\x01' + packed
+    return b'\x00' + raw
+
+
+def decode_postings(blob: bytes) -> List[int]:
+    raw = zlib.decompress(blob[1:], -15) if blob[0] == 1 else blob[1:]
+    deltas = array('I')
+    deltas.frombytes(raw)
+    if not _LITTLE:
+        deltas.byteswap()
+    return list(accumulate(deltas))
+
+
+class SearchIndexBuilder:
+    """Accumulates formatted paintings with `add` and writes the index directory on `finish`"""
+
+    def __init__(self, index_dir: str = INDEX_DIR, fields: Sequence[str] = INDEX_FIELDS):
+        self.index_dir = index_dir
+        self.fields = tuple(fields)
+        self.tmp_dir = index_dir + '.tmp'
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        os.makedirs(self.tmp_dir)
+        self._records = open(os.path.join(self.tmp_dir, 'records.jsonl'), 'wb')
+        self._text = open(os.path.join(self.tmp_dir, 'text.txt'), 'w', encoding='utf-8')
+        self.offsets = _uint_array('Q', [0])
+        self.postings: Dict[str, array] = {}
+        self.met_ids = _uint_array('I')
+        self.sort_values = {key: [] for key in SORT_KEYS}
+
+    def add(self, painting: Dict):
+        doc = len(self.offsets) - 1
+        line = json.dumps(painting, ensure_ascii=False).encode('utf-8') + b'\n'
+        self._records.write(line)
+        self.offsets.append(self.offsets[-1] + len(line))
+
+        texts = [normalize(painting.get(field)) for field in self.fields]
+        # Tabs never survive normalisation, so they separate the fields unambiguously
+        self._text.write('\t'.join(texts) + '\n')
+        terms = set()
+        for field, text in zip(self.fields, texts):
+            terms.update(f"{field}:{gram}" for gram in trigrams(text))
+            terms.update(f"{field}={word}" for word in _WORD.findall(text))
+        postings = self.postings
+        for term in terms:
+            docs = postings.get(term)
+            if docs is None:
+                docs = postings[term] = _uint_array('I')
+            docs.append(doc)
+
+        self.met_ids.append(int(painting.get('met_id') or 0))
+        self.sort_values['title'].append(normalize(painting.get('title')))
+        self.sort_values['artist'].append(normalize(painting.get('artist')))
+        year = painting_year(painting.get('date'))
+        # Undated paintings sort last
+        self.sort_values['year'].append(year if year is not None else sys.maxsize)
+        self.sort_values['met_id'].append(self.met_ids[-1])
+
+    def finish(self) -> Dict:
+        """Write postings, id table and sort orders, then move the index into place"""
+        self._records.close()
+        self._text.close()
+        count = len(self.met_ids)
+        tmp = self.tmp_dir
+        _write_array(os.path.join(tmp, 'offsets.bin'), self.offsets)
+
+        by_id = sorted(range(count), key=self.met_ids.__getitem__)
+        _write_array(os.path.join(tmp, 'ids.bin'), _uint_array('I', (self.met_ids[doc] for doc in by_id)))
+        _write_array(os.path.join(tmp, 'id_docs.bin'), _uint_array('I', by_id))
+
+        terms = sorted(self.postings)
+        posting_offsets = _uint_array('Q', [0])
+        with open(os.path.join(tmp, 'postings.bin'), 'wb') as f:
+            for term in terms:
+                blob = encode_postings(self.postings[term])
+                f.write(blob)
+                posting_offsets.append(posting_offsets[-1] + len(blob))
+        _write_array(os.path.join(tmp, 'postings_offsets.bin'), posting_offsets)
+        with open(os.path.join(tmp, 'terms.txt'), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(terms))
+
+        for key, values in self.sort_values.items():
+            order = sorted(range(count), key=values.__getitem__)
+            _write_array(os.path.join(tmp, f"order-{key}.bin"), _uint_array('I', order))
+
+        manifest = {
+            'version': INDEX_VERSION,
+            'count': count,
+            'fields': list(self.fields),
+            'sort_keys': list(SORT_KEYS),
+            'terms': len(terms),
+            'postings_bytes': posting_offsets[-1],
+            'built_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+        with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+        shutil.rmtree(self.index_dir, ignore_errors=True)
+        os.replace(tmp, self.index_dir)
+        self.postings.clear()
+        return manifest
+
+    def tee(self, paintings: Iterable[Dict]) -> Iterator[Dict]:
+        """Pass paintings through unchanged, adding each to the index"""
+        for painting in paintings:
+            self.add(painting)
+            yield painting
+
+
+def build_search_index(paintings: Iterable[Dict], index_dir: str = INDEX_DIR,
+                       fields: Sequence[str] = INDEX_FIELDS) -> Dict:
+    """Index formatted paintings into `index_dir`; returns the manifest"""
+    builder = SearchIndexBuilder(index_dir, fields)
+    with span('search_index') as s:
+        for painting in paintings:
+            builder.add(painting)
+        s.add(len(builder.met_ids))
+        manifest = builder.finish()
+    print(f"Indexed {manifest['count']} paintings ({manifest['terms']:,} terms, "
+          f"{manifest['postings_bytes'] / 2 ** 20:.1f} MB of postings) into {index_dir}")
+    return manifest
+
+
+class SearchIndex:
+    """Read side of the index: lookup by met_id, substring/word search and sorted pages"""
+
+    def __init__(self, index_dir: str = INDEX_DIR):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, 'manifest.json'), 'r') as f:
+            self.manifest = json.load(f)
+        if self.manifest['version'] != INDEX_VERSION:
+            raise ValueError(f"{index_dir} is index version {self.manifest['version']}, expected {INDEX_VERSION}")
+        self.fields = self.manifest['fields']
+        self.offsets = _read_array(self._path('offsets.bin'), 'Q')
+        self.ids = _read_array(self._path('ids.bin'), 'I')
+        self.id_docs = _read_array(self._path('id_docs.bin'), 'I')
+        with open(self._path('terms.txt'), 'r', encoding='utf-8') as f:
+            self.terms = f.read().split('\n')
+        self.posting_offsets = _read_array(self._path('postings_offsets.bin'), 'Q')
+        with open(self._path('postings.bin'), 'rb') as f:
+            self.postings = f.read()
+        self._records = open(self._path('records.jsonl'), 'rb')
+        self._texts: Optional[List[List[str]]] = None
+        self._orders: Dict[str, array] = {}
+        self._ranks: Dict[str, array] = {}
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.index_dir, name)
+
+    def __len__(self) -> int:
+        return self.manifest['count']
+
+    def record(self, doc: int) -> Dict:
+        self._records.seek(self.offsets[doc])
+        return json.loads(self._records.read(self.offsets[doc + 1] - self.offsets[doc]))
+
+    def get(self, met_id: int) -> Optional[Dict]:
+        """The painting with `met_id`, or None"""
+        i = bisect.bisect_left(self.ids, int(met_id))
+        if i < len(self.ids) and self.ids[i] == int(met_id):
+            return self.record(self.id_docs[i])
+        return None
+
+    def posting(self, term: str) -> List[int]:
+        i = bisect.bisect_left(self.terms, term)
+        if i == len(self.terms) or self.terms[i] != term:
+            return []
+        return decode_postings(self.postings[self.posting_offsets[i]:self.posting_offsets[i + 1]])
+
+    def texts(self) -> List[List[str]]:
+        """Normalised indexed fields of every record (loaded on first use)"""
+        if self._texts is None:
+            with open(self._path('text.txt'), 'r', encoding='utf-8') as f:
+                self._texts = [line.rstrip('\n').split('\t') for line in f]
+        return self._texts
+
+    def order(self, key: str) -> array:
+        if key not in self._orders:
+            if key not in self.manifest['sort_keys']:
+                raise ValueError(f"Unknown sort key {key!r}; expected one of {self.manifest['sort_keys']}")
+            self._orders[key] = _read_array(self._path(f"order-{key}.bin"), 'I')
+        return self._orders[key]
+
+    def rank(self, key: str) -> array:
+        """Position of every record in the `key` order"""
+        if key not in self._ranks:
+            order = self.order(key)
+            rank = _uint_array('I', bytes(4 * len(order)))
+            for position, doc in enumerate(order):
+                rank[doc] = position
+            self._ranks[key] = rank
+        return self._ranks[key]
+
+    def _field_positions(self, fields: Sequence[str]) -> List[int]:
+        unknown = set(fields) - set(self.fields)
+        if unknown:
+            raise ValueError(f"Fields {sorted(unknown)} are not indexed; indexed fields are {self.fields}")
+        return [self.fields.index(field) for field in fields]
+
+    def _intersect(self, terms: Iterable[str]) -> set:
+        postings = sorted((self.posting(term) for term in terms), key=len)
+        matches = set(postings[0])
+        for docs in postings[1:]:
+            if not matches:
+                break
+            matches.intersection_update(docs)
+        return matches
+
+    def match_substring(self, query: str, fields: Sequence[str]) -> List[int]:
+        """Records where the normalised query occurs inside any of `fields`, in record order"""
+        positions = self._field_positions(fields)
+        if len(query) < 3:
+            texts = self.texts()
+            return [doc for doc, row in enumerate(texts) if any(query in row[p] for p in positions)]
+        grams = trigrams(query)
+        candidates = set()
+        for field in fields:
+            candidates |= self._intersect(f"{field}:{gram}" for gram in grams)
+        if len(query) > 3:
+            # Every trigram present does not mean they are adjacent; confirm on the text
+            texts = self.texts()
+            candidates = {doc for doc in candidates if any(query in texts[doc][p] for p in positions)}
+        return sorted(candidates)
+
+    def match_words(self, query: str, fields: Sequence[str]) -> List[int]:
+        """Records where every query word is a whole word of one of `fields`"""
+        self._field_positions(fields)
+        matches = None
+        for word in set(_WORD.findall(query)):
+            docs = set()
+            for field in fields:
+                docs.update(self.posting(f"{field}={word}"))
+            matches = docs if matches is None else matches & docs
+            if not matches:
+                return []
+        return sorted(matches or ())
+
+    def search(self, query: Optional[str] = None, fields: Sequence[str] = ('title', 'artist'),
+               mode: str = 'substring', sort: Optional[str] = None, offset: int = 0, limit: int = 10) -> Dict:
+        """One page of matching paintings: {'paintings', 'total', 'has_more'}.
+
+        `mode` 'substring' matches like the server's original filter (the
+        query anywhere in a field); 'words' requires each query word as a
+        whole word. Results are in record order unless `sort` names one of
+        SORT_KEYS. An empty query pages through the whole collection.
+        """
+        query = normalize(query)
+        if not query:
+            if sort:
+                docs = self.order(sort)[offset:offset + limit]
+            else:
+                docs = range(offset, min(offset + limit, len(self)))
+            total = len(self)
+        else:
+            if mode == 'substring':
+                matches = self.match_substring(query, fields)
+            elif mode == 'words':
+                matches = self.match_words(query, fields)
+            else:
+                raise ValueError(f"Unknown search mode {mode!r}; expected 'substring' or 'words'")
+            if sort:
+                matches.sort(key=self.rank(sort).__getitem__)
+            docs = matches[offset:offset + limit]
+            total = len(matches)
+        return {'paintings': [self.record(doc) for doc in docs], 'total': total,
+                'has_more': offset + limit < total}
+
+    def close(self):
+        self._records.close()
+
+
+def linear_search(paintings: Sequence[Dict], query: Optional[str], offset: int = 0, limit: int = 10) -> Dict:
+    """The server's original filter (lowercased substring of title or artist), for comparison"""
+    matches = paintings
+    if query:
+        query = query.lower()
+        matches = [painting for painting in paintings
+                   if query in painting['title'].lower() or query in painting['artist'].lower()]
+    return {'paintings': matches[offset:offset + limit], 'total': len(matches),
+            'has_more': offset + limit < len(matches)}
+
+
+def _bench_queries(paintings: Sequence[Dict], count: int, seed: int = 0) -> List[str]:
+    """Title and artist words and fragments of random paintings, plus misses and short queries"""
+    import random
+
+    rng = random.Random(seed)
+    queries = ['xqz', 'an', 'e']
+    while len(queries) < count:
+        text = rng.choice(paintings)[rng.choice(('title', 'artist'))] or 'painting'
+        words = text.split()
+        choice = rng.random()
+        if choice < 0.4:
+            queries.append(rng.choice(words))
+        elif choice < 0.7:
+            start = rng.randrange(max(1, len(text) - 6))
+            queries.append(text[start:start + rng.randint(4, 8)])
+        else:
+            queries.append(' '.join(words[:2]))
+    return queries
+
+
+def benchmark_search(size: int = 100_000, queries: int = 200, seed: int = 0) -> Dict:
+    """Per-query latency of the index and of the linear scan over `size` synthetic paintings"""
+    import statistics
+    import tempfile
+
+    from benchmarks import synthetic_raw_paintings
+    from clean_unicode import iter_cleaned_paintings
+
+    paintings = list(iter_cleaned_paintings(synthetic_raw_paintings(size, seed=seed)))
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        manifest = build_search_index(paintings, os.path.join(tmp, 'index'))
+        build_s = time.perf_counter() - start
+        start = time.perf_counter()
+        index = SearchIndex(os.path.join(tmp, 'index'))
+        index.texts()
+        load_s = time.perf_counter() - start
+        index_bytes = sum(os.path.getsize(os.path.join(tmp, 'index', name))
+                          for name in os.listdir(os.path.join(tmp, 'index')))
+
+        results = {'size': size, 'build_s': round(build_s, 2), 'load_s': round(load_s, 3),
+                   'index_mb': round(index_bytes / 2 ** 20, 1), 'terms': manifest['terms']}
+        for name, run in (('index', lambda q: index.search(q)), ('linear', lambda q: linear_search(paintings, q))):
+            timings = []
+            for query in _bench_queries(paintings, queries, seed):
+                start = time.perf_counter()
+                run(query)
+                timings.append((time.perf_counter() - start) * 1000)
+            timings.sort()
+            results[name] = {'p50_ms': round(statistics.median(timings), 3),
+                             'p95_ms': round(timings[int(0.95 * (len(timings) - 1))], 3),
+                             'mean_ms': round(statistics.fmean(timings), 3)}
+        lookups = [painting['met_id'] for painting in paintings[::max(1, size // 1000)]]
+        start = time.perf_counter()
+        for met_id in lookups:
+            index.get(met_id)
+        results['get_us'] = round((time.perf_counter() - start) / len(lookups) * 1e6, 1)
+        index.close()
+
+    print(f"{size} paintings: index built in {results['build_s']}s, {results['index_mb']} MB, "
+          f"loaded in {results['load_s']}s; get by id {results['get_us']} us")
+    for name in ('index', 'linear'):
+        print(f"- {name:<7} p50 {results[name]['p50_ms']:>8.3f} ms  p95 {results[name]['p95_ms']:>8.3f} ms  "
+              f"mean {results[name]['mean_ms']:>8.3f} ms")
+    print(f"Speedup (mean): {results['linear']['mean_ms'] / results['index']['mean_ms']:.1f}x")
+    return results
+
+
+def check_search_index(size: int = 3000):
+    """Index results, pages and id lookups match the linear scan on a synthetic collection"""
+    import tempfile
+
+    from benchmarks import synthetic_raw_paintings
+    from clean_unicode import restore_from_backup_and_clean
+    from storage import iter_records, write_records
+
+    with tempfile.TemporaryDirectory() as tmp:
+        raw_file = os.path.join(tmp, 'raw.jsonl')
+        formatted_file = os.path.join(tmp, 'formatted.jsonl')
+        index_dir = os.path.join(tmp, 'index')
+        write_records(raw_file, synthetic_raw_paintings(size))
+        restore_from_backup_and_clean(raw_file, formatted_file, index_dir=index_dir)
+        paintings = list(iter_records(formatted_file))
+        index = SearchIndex(index_dir)
+        assert len(index) == len(paintings)
+
+        def normalized_search(query):
+            query = normalize(query)
+            return [doc for doc, painting in enumerate(paintings)
+                    if query in normalize(painting['title']) or query in normalize(painting['artist'])]
+
+        queries = _bench_queries(paintings, 300)
+        for query in queries:
+            expected = normalized_search(query)
+            page = index.search(query, offset=2, limit=5)
+            assert page['total'] == len(expected), (query, page['total'], len(expected))
+            assert page['paintings'] == [paintings[doc] for doc in expected[2:7]], query
+            # Accent folding only widens the server's lowercase filter
+            assert page['total'] >= linear_search(paintings, query)['total'], query
+
+        words = index.search('oil canvas', fields=('medium',), mode='words', limit=len(paintings))
+        assert words['paintings'] and all({'oil', 'canvas'} <= set(_WORD.findall(normalize(p['medium'])))
+                                          for p in words['paintings'])
+
+        by_title = index.search(sort='title', limit=50)['paintings']
+        assert [normalize(p['title']) for p in by_title] == sorted(normalize(p['title']) for p in paintings)[:50]
+        dated = index.search('the', sort='year', limit=len(paintings))['paintings']
+        years = [painting_year(p['date']) for p in dated]
+        known = [year for year in years if year is not None]
+        assert known == sorted(known) and years[:len(known)] == known
+
+        for painting in paintings[::97]:
+            assert index.get(painting['met_id']) == painting
+        assert index.get(1) is None
+        index.close()
+    print(f"Check passed: {len(queries)} queries and id lookups agree with a linear scan over {size} paintings")
+
+
+if __name__ == "__main__":
+    if "--check" in sys.argv:
+        check_search_index()
+        sys.exit(0)
+    if "--benchmark" in sys.argv:
+        args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+        benchmark_search(int(args[0]) if args else 100_000)
+        sys.exit(0)
+
+    from storage import iter_records
+
+    formatted_file = sys.argv[1] if len(sys.argv) > 1 else 'raw-data/met_paintings_formatted.json'
+    build_search_index(iter_records(formatted_file), sys.argv[2] if len(sys.argv) > 2 else INDEX_DIR)
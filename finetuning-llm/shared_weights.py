@@ -0,0 +1,381 @@
+"""Multi-process inference over one memory-mapped copy of the model weights.
+
+Every onnxruntime session normally owns its weights: initializers are read
+into private buffers and MatMul weights are prepacked into private copies
+again, so each extra worker process costs a full model of RAM. Here
+`shared_model_dir` builds (once, next to cold_start's optimized-graph cache)
+the optimized graph with its initializers laid out page-aligned by
+`export_model.layout_external_data`. Workers load it with graph
+optimizations and weight prepacking disabled, so onnxruntime maps the
+external data file instead of copying it and every worker reads the same
+page-cache pages.
+
+The saving costs throughput. Without prepacking, MLAS multiplies straight
+from the row-major weights instead of its packed panel layout, and
+onnxruntime's Python API has no prepacked-weight container to share across
+processes (keeping prepacking on gives every worker its private packed
+copy, which removes the saving entirely). On the tiny check model, shared
+workers have used about 4% less Pss at 0.6-0.9x the tokens/sec of
+independent sessions. The Pss saving grows with the weights, about one
+model's worth per extra worker, so the shared mode pays off when RAM rather
+than cores caps the worker count. `compare_worker_modes` measures both
+sides on the real model before choosing.
+
+`SharedWeightsPool` starts N spawned workers, each pinned (process affinity
+plus onnxruntime intra-op thread affinities) to its own disjoint set of
+cores, all taking batches from one shared task queue. `compare_worker_modes`
+runs the same batches through shared workers and through N independent
+sessions (what pregenerate.py starts) and reports the summed proportional
+set size (Pss: shared pages count once across processes) next to aggregate
+tokens/sec.
+"""
+
+import multiprocessing
+import os
+import queue
+import shutil
+import sys
+import time
+from typing import Dict, List, Optional, Sequence
+
+from instrumentation import memory_kb
+from pregenerate import physical_cores
+
+
+def shared_model_dir(model_dir: str = 'onnx-model', model_file: str = 'model.onnx') -> str:
+    """The optimized graph with page-aligned external weights, built once beside the optimized-graph cache"""
+    from cold_start import build_optimized_graph, optimized_cache_dir
+    from export_model import layout_external_data
+
+    cache_dir = optimized_cache_dir(model_dir, model_file)
+    shared_dir = f"{cache_dir}-mmap"
+    if os.path.exists(os.path.join(shared_dir, model_file)):
+        return shared_dir
+    if not os.path.exists(os.path.join(cache_dir, model_file)):
+        build_optimized_graph(model_dir, model_file)
+    tmp_dir = f"{shared_dir}.tmp-{os.getpid()}"
+    shutil.copytree(cache_dir, tmp_dir)
+    layout_external_data(os.path.join(tmp_dir, model_file))
+    try:
+        os.rename(tmp_dir, shared_dir)
+    except OSError:
+        # Another process finished the same layout first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return shared_dir
+
+
+def _parse_cpu_list(text: str) -> List[int]:
+    """CPU ids of a sysfs list such as '0-3,8,10-11'"""
+    cpus = []
+    for part in text.strip().split(','):
+        if part:
+            first, _, last = part.partition('-')
+            cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def physical_core_cpus() -> List[List[int]]:
+    """The CPUs this process may run on, grouped by physical core (hyperthread siblings together).
+
+    Siblings are read from /sys/devices/system/cpu/cpu*/topology/thread_siblings_list,
+    since their numbering differs between machines (0/1 adjacent on some,
+    0/N on others). Without sysfs every CPU counts as its own core.
+    """
+    allowed = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else range(os.cpu_count() or 1)
+    cores: Dict[tuple, List[int]] = {}
+    for cpu in allowed:
+        try:
+            with open(f'/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list', 'r') as f:
+                siblings = tuple(_parse_cpu_list(f.read()))
+        except (OSError, ValueError):
+            siblings = (cpu,)
+        cores.setdefault(siblings, []).append(cpu)
+    return sorted(cores.values())
+
+
+def core_sets(workers: int, threads_per_worker: Optional[int] = None) -> List[List[int]]:
+    """Per worker, one CPU on each of its own physical cores (one intra-op thread per core).
+
+    Workers never share a physical core, and the hyperthread siblings of
+    their cores stay idle. With too few cores the sets wrap around and overlap.
+    """
+    cores = physical_core_cpus()
+    threads = threads_per_worker or max(1, len(cores) // workers)
+    if workers * threads > len(cores):
+        print(f"Warning: {workers} worker(s) x {threads} thread(s) oversubscribe {len(cores)} physical core(s); "
+              f"core sets overlap")
+    return [[cores[(worker * threads + i) % len(cores)][0] for i in range(threads)] for worker in range(workers)]
+
+
+def worker_session_options(cores: Sequence[int], shared: bool = True):
+    """Sequential session with one intra-op thread per core in `cores`, each pinned to its core"""
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = len(cores)
+    options.inter_op_num_threads = 1
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    if len(cores) > 1:
+        # One entry per pool thread (the calling thread is the first intra-op thread); ids are 1-based
+        options.add_session_config_entry('session.intra_op_thread_affinities',
+                                         ';'.join(str(core + 1) for core in cores[1:]))
+    if shared:
+        # Optimizations already ran when the graph was cached, and prepacking would copy every MatMul weight
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+        options.add_session_config_entry('session.disable_prepacking', '1')
+    return options
+
+
+def open_worker_generator(model_dir: str, cores: Sequence[int], shared: bool = True):
+    """OnnxGenerator for one worker pinned to `cores`: the shared mmap layout, or a private optimized session"""
+    if hasattr(os, 'sched_setaffinity'):
+        # onnxruntime's threads are created afterwards and inherit the mask
+        os.sched_setaffinity(0, cores)
+    options = worker_session_options(cores, shared)
+    if shared:
+        from onnx_generation import OnnxGenerator
+
+        return OnnxGenerator(shared_model_dir(model_dir), session_options=options)
+    from cold_start import open_generator
+
+    generator, _ = open_generator(model_dir, session_options=options, warm_up_shapes=None)
+    return generator
+
+
+def _worker_main(index: int, config: Dict, tasks, results):
+    """Worker process: open a pinned generator, then run batches from the shared queue until None"""
+    try:
+        generator = open_worker_generator(config['model_dir'], config['cores'][index], config['shared'])
+    except Exception as e:
+        results.put(('failed', index, repr(e)))
+        return
+    results.put(('ready', index, os.getpid()))
+    for task_id, prompts, max_new_tokens in iter(tasks.get, None):
+        start = time.perf_counter()
+        try:
+            tokens = generator.generate(prompts, max_new_tokens=max_new_tokens, eos_token_id=config['eos_token_id'],
+                                        pad_token_id=config['pad_token_id'])
+        except Exception as e:
+            results.put(('error', task_id, index, repr(e)))
+            continue
+        results.put(('done', task_id, index, tokens, time.perf_counter() - start))
+
+
+class SharedWeightsPool:
+    """Spawned generator processes pinned to disjoint cores, fed from one task queue.
+
+    With `shared` the workers map one copy of the weights (see the module
+    docstring); without it every worker opens its own session, as
+    pregenerate.py does. The defaults mirror pregenerate: one worker per 4
+    physical cores, cores split evenly between workers.
+    """
+
+    def __init__(self, model_dir: str = 'onnx-model', workers: Optional[int] = None,
+                 threads_per_worker: Optional[int] = None, shared: bool = True,
+                 eos_token_id=2, pad_token_id: Optional[int] = None, start_timeout: float = 600):
+        cores = physical_cores()
+        workers = workers or max(1, cores // (threads_per_worker or 4))
+        self.config = {'model_dir': model_dir, 'shared': shared, 'eos_token_id': eos_token_id,
+                       'pad_token_id': pad_token_id, 'cores': core_sets(workers, threads_per_worker)}
+        self.workers = workers
+        self.start_timeout = start_timeout
+        self.pids: List[int] = []
+        self.processes = []
+        self._next_task = 0
+
+    def start(self) -> float:
+        """Start the workers and wait until every session is open; returns the seconds it took"""
+        start = time.perf_counter()
+        if self.config['shared']:
+            # Built once here rather than raced by every worker
+            shared_model_dir(self.config['model_dir'])
+        context = multiprocessing.get_context('spawn')
+        self.tasks, self.results = context.Queue(), context.Queue()
+        self.processes = [context.Process(target=_worker_main, args=(index, self.config, self.tasks, self.results),
+                                          daemon=True) for index in range(self.workers)]
+        for process in self.processes:
+            process.start()
+        pids = {}
+        while len(pids) < self.workers:
+            message = self._get(self.start_timeout)
+            if message[0] == 'failed':
+                raise RuntimeError(f"Worker {message[1]} failed to open its session: {message[2]}")
+            pids[message[1]] = message[2]
+        self.pids = [pids[index] for index in range(self.workers)]
+        return time.perf_counter() - start
+
+    def _get(self, timeout: float):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return self.results.get(timeout=1)
+            except queue.Empty:
+                dead = [index for index, process in enumerate(self.processes) if not process.is_alive()]
+                if dead:
+                    raise RuntimeError(f"Worker(s) {dead} exited unexpectedly")
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"No worker result within {timeout}s")
+
+    def run(self, batches: Sequence[Sequence[Sequence[int]]], max_new_tokens: int = 100,
+            timeout: float = 3600) -> List[Dict]:
+        """Generate every batch of token id prompts; returns, in order, {'tokens', 'worker', 'seconds'} per batch"""
+        first = self._next_task
+        for offset, prompts in enumerate(batches):
+            self.tasks.put((first + offset, [list(prompt) for prompt in prompts], max_new_tokens))
+        self._next_task += len(batches)
+        results: Dict[int, Dict] = {}
+        while len(results) < len(batches):
+            message = self._get(timeout)
+            if message[0] == 'error':
+                raise RuntimeError(f"Worker {message[2]} failed on batch {message[1] - first}: {message[3]}")
+            _, task_id, worker, tokens, seconds = message
+            results[task_id - first] = {'tokens': tokens, 'worker': worker, 'seconds': seconds}
+        return [results[index] for index in range(len(batches))]
+
+    def memory(self) -> Dict:
+        """Summed resident memory of the workers in MiB; `pss_mb` counts shared weight pages once"""
+        usages = [memory_kb(pid) for pid in self.pids]
+        if not all(usages):
+            return {}
+        totals = {key: sum(usage[key] for usage in usages) for key in usages[0]}
+        return {
+            'rss_mb': round(totals['rss'] / 1024, 1),
+            'pss_mb': round(totals['pss'] / 1024, 1),
+            'shared_mb': round((totals['shared_clean'] + totals['shared_dirty']) / 1024, 1),
+            'private_mb': round((totals['private_clean'] + totals['private_dirty']) / 1024, 1),
+        }
+
+    def close(self):
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join(timeout=30)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def synthetic_batches(count: int, batch_size: int = 4, min_length: int = 32, max_length: int = 96) -> List[List[List[int]]]:
+    """Token id prompts of varied length (ids in the ordinary-token range, as cold_start uses)"""
+    spread = max_length - min_length + 1
+    prompts = [[1] + [1000 + (i * 7 + j) % 500 for j in range(min_length + (i * 37) % spread - 1)]
+               for i in range(count)]
+    return [prompts[i:i + batch_size] for i in range(0, count, batch_size)]
+
+
+def compare_worker_modes(model_dir: str = 'onnx-model', workers: Optional[int] = None,
+                         threads_per_worker: Optional[int] = None, prompts: int = 32, batch_size: int = 4,
+                         max_new_tokens: int = 32) -> Dict:
+    """Resident memory and aggregate tokens/sec of N independent sessions vs N workers sharing mapped weights.
+
+    Both modes decode the same synthetic batches to `max_new_tokens` (no
+    EOS). Memory is read after the run, so it includes the arenas the
+    generation grew.
+    """
+    batches = synthetic_batches(prompts, batch_size)
+    report = {}
+    for mode, shared in (('independent', False), ('shared', True)):
+        pool = SharedWeightsPool(model_dir, workers, threads_per_worker, shared=shared, eos_token_id=-1,
+                                 pad_token_id=0)
+        load_s = pool.start()
+        try:
+            # One batch per worker first, so the timed run does not include first-run allocation
+            pool.run(batches[:pool.workers], max_new_tokens=2)
+            start = time.perf_counter()
+            results = pool.run(batches, max_new_tokens)
+            seconds = time.perf_counter() - start
+            memory = pool.memory()
+        finally:
+            pool.close()
+        tokens = sum(len(row) for result in results for row in result['tokens'])
+        report[mode] = {'workers': pool.workers, 'threads_per_worker': len(pool.config['cores'][0]),
+                        'load_s': round(load_s, 2), **memory, 'tokens': tokens, 'seconds': round(seconds, 3),
+                        'tokens_per_sec': round(tokens / seconds, 1),
+                        'batches_per_worker': [sum(result['worker'] == w for result in results)
+                                               for w in range(pool.workers)]}
+
+    independent, shared = report['independent'], report['shared']
+    if 'pss_mb' in independent and 'pss_mb' in shared:
+        report['pss_saving_mb'] = round(independent['pss_mb'] - shared['pss_mb'], 1)
+        report['pss_saving_pct'] = round(100 * report['pss_saving_mb'] / independent['pss_mb'], 1)
+    report['throughput_ratio'] = round(shared['tokens_per_sec'] / independent['tokens_per_sec'], 3)
+
+    columns = ['load_s', 'rss_mb', 'pss_mb', 'shared_mb', 'private_mb', 'tokens_per_sec']
+    print(f"{'mode':<14}{'workers':>9}" + ''.join(f"{column:>16}" for column in columns))
+    for mode in ('independent', 'shared'):
+        row = report[mode]
+        print(f"{mode:<14}{row['workers']:>5} x {row['threads_per_worker']:<2}" +
+              ''.join(f"{row[column]:>16}" if column in row else f"{'-':>16}" for column in columns))
+    if 'pss_saving_mb' in report:
+        print(f"Shared weights save {report['pss_saving_mb']} MB Pss ({report['pss_saving_pct']}%) "
+              f"at {report['throughput_ratio']}x the independent sessions' tokens/sec")
+    if report['throughput_ratio'] < 1:
+        print("Shared workers run without weight prepacking: fewer bytes per worker, slower MatMuls. "
+              "Prefer them when memory, not cores, limits the number of workers")
+    return report
+
+
+def check_tiny_model(workers: int = 2):
+    """Shared vs independent workers on a tiny random Mistral (CPU).
+
+    The shared layout must give the original export's logits, both pools must
+    run every batch, and the shared workers must use less Pss in total.
+    """
+    import tempfile
+
+    import numpy as np
+    import onnx
+    import torch
+
+    from export_model import export_with_past, tiny_mistral
+    from onnx_generation import OnnxGenerator
+
+    with tempfile.TemporaryDirectory() as tmp:
+        model_dir = os.path.join(tmp, 'model')
+        os.makedirs(model_dir)
+        export_with_past(tiny_mistral(), os.path.join(model_dir, 'model.onnx'), torch.tensor([[1, 2, 3]]))
+
+        data = onnx.load(os.path.join(shared_model_dir(model_dir), 'model.onnx'), load_external_data=False)
+        offsets = [int(entry.value) for tensor in data.graph.initializer for entry in tensor.external_data
+                   if entry.key == 'offset']
+        assert offsets and all(offset % 4096 == 0 for offset in offsets)
+
+        input_ids = np.array([[1, 415, 3290, 302, 264]], dtype=np.int64)
+        reference, _ = OnnxGenerator(model_dir).forward(input_ids, np.ones_like(input_ids))
+        logits, _ = open_worker_generator(model_dir, core_sets(1)[0]).forward(input_ids, np.ones_like(input_ids))
+        assert np.abs(logits - reference).max() < 1e-4
+
+        report = compare_worker_modes(model_dir, workers=workers, threads_per_worker=1, prompts=16,
+                                      max_new_tokens=16)
+        for mode in ('independent', 'shared'):
+            assert report[mode]['tokens'] == 16 * 16, report[mode]
+            assert sum(report[mode]['batches_per_worker']) == 4
+        if 'pss_saving_mb' in report:
+            assert report['pss_saving_mb'] > 0, report
+    print(f"Check passed: {workers} workers share one mapped copy of the weights and match the original logits")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    if "--check" in sys.argv:
+        check_tiny_model()
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="Compare N independent sessions with N workers sharing mapped weights")
+    parser.add_argument('--model-dir', default='onnx-model')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--threads-per-worker', type=int, default=None)
+    parser.add_argument('--prompts', type=int, default=32)
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--max-new-tokens', type=int, default=32)
+    args = parser.parse_args()
+    compare_worker_modes(args.model_dir, args.workers, args.threads_per_worker, args.prompts, args.batch_size,
+                         args.max_new_tokens)
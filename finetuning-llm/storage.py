@@ -0,0 +1,187 @@
+"""Streaming record storage shared by the data pipeline stages.
+
+The format is picked from the file extension:
+- `.jsonl`: one JSON object per line
+- `.parquet`: columnar, written and read in row-group batches; reads can
+  project a subset of columns so unused fields are never decoded
+- `.json`: the original indented array documents, written incrementally and
+  read element by element so neither direction materialises the whole list
+"""
+
+import json
+import os
+import tempfile
+from typing import Dict, Iterable, Iterator, List, Optional
+
+BATCH_SIZE = 1024
+_READ_CHUNK = 1 << 16
+# Parquet schema metadata key listing columns stored as JSON text (nested values)
+_JSON_COLUMNS_KEY = b'json_columns'
+
+
+def iter_records(path: str, columns: Optional[List[str]] = None, batch_size: int = BATCH_SIZE) -> Iterator[Dict]:
+    """Yield records from a .json/.jsonl/.parquet file, optionally keeping only `columns`"""
+    ext = os.path.splitext(path)[1]
+    if ext == '.parquet':
+        records = _iter_parquet(path, columns, batch_size)
+    elif ext == '.jsonl':
+        records = _iter_jsonl(path)
+    else:
+        records = _iter_json_array(path)
+
+    if columns is None or ext == '.parquet':
+        yield from records
+    else:
+        for record in records:
+            yield {column: record[column] for column in columns if column in record}
+
+
+def write_records(path: str, records: Iterable[Dict], ensure_ascii: bool = True,
+                  batch_size: int = BATCH_SIZE) -> int:
+    """Stream records into a .json/.jsonl/.parquet file; returns the number written"""
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    ext = os.path.splitext(path)[1]
+    if ext == '.parquet':
+        return _write_parquet(path, records, batch_size)
+    if ext == '.jsonl':
+        return _write_jsonl(path, records, ensure_ascii)
+    return _write_json_array(path, records, ensure_ascii)
+
+
+def _iter_jsonl(path: str) -> Iterator[Dict]:
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _write_jsonl(path: str, records: Iterable[Dict], ensure_ascii: bool) -> int:
+    count = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=ensure_ascii))
+            f.write('\n')
+            count += 1
+    return count
+
+
+def _iter_json_array(path: str) -> Iterator[Dict]:
+    """Incrementally decode the elements of a top-level JSON array"""
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        buffer = f.read(_READ_CHUNK).lstrip()
+        if not buffer.startswith('['):
+            raise ValueError(f"{path} does not contain a JSON array")
+        buffer = buffer[1:]
+        eof = False
+        while True:
+            buffer = buffer.lstrip().lstrip(',').lstrip()
+            if buffer.startswith(']'):
+                return
+            try:
+                record, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                chunk = f.read(_READ_CHUNK)
+                eof = not chunk
+                buffer += chunk
+                continue
+            if not eof and (end == len(buffer) or buffer[end] not in ', \t\r\n]'):
+                # A bare number cut at the chunk end ("1.5" read as "1" then ".5") decodes early;
+                # only a value followed by a delimiter is complete
+                chunk = f.read(_READ_CHUNK)
+                eof = not chunk
+                buffer += chunk
+                continue
+            yield record
+            buffer = buffer[end:]
+            if not buffer and not eof:
+                chunk = f.read(_READ_CHUNK)
+                eof = not chunk
+                buffer = chunk
+
+
+def _write_json_array(path: str, records: Iterable[Dict], ensure_ascii: bool) -> int:
+    """Write records one at a time, byte-identical to json.dump(records, f, indent=2)"""
+    count = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write('[\n  ' if count == 0 else ',\n  ')
+            f.write(json.dumps(record, indent=2, ensure_ascii=ensure_ascii).replace('\n', '\n  '))
+            count += 1
+        f.write('\n]' if count else '[]')
+    return count
+
+
+def _iter_parquet(path: str, columns: Optional[List[str]], batch_size: int) -> Iterator[Dict]:
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(path)
+    metadata = parquet_file.schema_arrow.metadata or {}
+    json_columns = set(json.loads(metadata.get(_JSON_COLUMNS_KEY, b'[]')))
+    if columns is not None:
+        columns = [column for column in columns if column in parquet_file.schema_arrow.names]
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+        decode = json_columns.intersection(batch.schema.names)
+        for record in batch.to_pylist():
+            for column in decode:
+                if record[column] is not None:
+                    record[column] = json.loads(record[column])
+            yield record
+
+
+def _write_parquet(path: str, records: Iterable[Dict], batch_size: int) -> int:
+    """Write records in row groups; nested values are stored as JSON text columns.
+
+    The schema has to fit every record, not just the first batch (raw Met
+    objects leave `tags` or `constituents` null for long runs), so a first pass
+    spools the records to a temporary JSON Lines file next to `path` while
+    collecting each column's value types, and a second pass writes the row
+    groups from the spool. A column holding dicts, lists or more than one
+    scalar type is stored as JSON text; one that is always null as strings.
+    Keys a record lacks read back as None.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    value_types: Dict[str, set] = {}
+    count = 0
+    with tempfile.TemporaryFile('w+', encoding='utf-8', dir=os.path.dirname(path) or None) as spool:
+        for record in records:
+            for key, value in record.items():
+                types = value_types.setdefault(key, set())
+                if value is not None:
+                    types.add(type(value))
+            spool.write(json.dumps(record, ensure_ascii=False) + '\n')
+            count += 1
+
+        arrow_types = {bool: pa.bool_(), int: pa.int64(), float: pa.float64(), str: pa.string()}
+        json_columns = sorted(key for key, types in value_types.items()
+                              if len(types) > 1 or not types <= arrow_types.keys())
+        fields = [pa.field(key, pa.string() if key in json_columns or not types else arrow_types[next(iter(types))])
+                  for key, types in value_types.items()]
+        schema = pa.schema(fields, metadata={_JSON_COLUMNS_KEY: json.dumps(json_columns).encode()})
+
+        spool.seek(0)
+        with pq.ParquetWriter(path, schema) as writer:
+            batch: List[Dict] = []
+            for line in spool:
+                batch.append(_encode_json_columns(json.loads(line), json_columns))
+                if len(batch) >= batch_size:
+                    writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+                    batch.clear()
+            if batch or not count:
+                writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+    return count
+
+
+def _encode_json_columns(record: Dict, json_columns: List[str]) -> Dict:
+    if not json_columns:
+        return record
+    record = dict(record)
+    for column in json_columns:
+        if record.get(column) is not None:
+            record[column] = json.dumps(record[column], ensure_ascii=False)
+    return record
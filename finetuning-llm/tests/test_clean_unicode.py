@@ -0,0 +1,42 @@
+import pytest
+
+from benchmarks import SOURCE_FILE, synthetic_raw_paintings
+from clean_unicode import (CLEAN_FIELDS, _reference_smart_clean_text, clean_records, iter_cleaned_paintings,
+                           restore_from_backup_and_clean, smart_clean_text)
+from storage import iter_records, write_records
+
+EDGE_CASES = [
+    '', None, 42, ' ', 'plain ascii', '  padded\t\ttext \n', 'en – and em — dashes',
+    'escaped \\u00e9t\\u00e9', 'bad escape \\uZZZZ', 'lone surrogate \ud800 \\u0041', 'trailing backslash \\',
+    'nbsp\u00a0and\u2003em space', 'line\u2028separator', '“curly” ‘quotes’',
+]
+
+
+@pytest.mark.parametrize('text', EDGE_CASES)
+def test_fast_path_matches_reference(text):
+    assert smart_clean_text(text) == _reference_smart_clean_text(text)
+
+
+def test_fast_path_matches_reference_on_collection():
+    fields = [field for field in CLEAN_FIELDS if field != 'objectID']
+    values = [raw.get(field, '') for raw in iter_records(SOURCE_FILE, columns=fields) for field in fields]
+    assert [smart_clean_text(value) for value in values] == [_reference_smart_clean_text(value) for value in values]
+
+
+def test_process_pool_matches_serial():
+    raw = list(synthetic_raw_paintings(2500))
+    fields = [field for field in CLEAN_FIELDS if field != 'objectID']
+    serial = list(clean_records(({**r} for r in raw), fields))
+    pooled = list(clean_records(({**r} for r in raw), fields, processes=2, batch_size=300))
+    assert pooled == serial and len(serial) == len(raw)
+
+
+@pytest.mark.parametrize('ext', ['.json', '.jsonl', '.parquet'])
+def test_restore_round_trip(tmp_path, ext):
+    raw = list(synthetic_raw_paintings(500))
+    raw_file = str(tmp_path / f"raw{ext}")
+    formatted_file = str(tmp_path / f"formatted{ext}")
+    write_records(raw_file, raw, ensure_ascii=False)
+
+    assert restore_from_backup_and_clean(raw_file, formatted_file) == len(raw)
+    assert list(iter_records(formatted_file)) == list(iter_cleaned_paintings(raw))
@@ -0,0 +1,55 @@
+"""Startup-import regression test: commands that don't need a model must not load one"""
+
+import os
+import typing
+
+import pytest
+
+import cli
+from benchmarks import synthetic_raw_paintings
+from storage import write_records
+
+IMPORT_BUDGET_S = 1.0
+COMMANDS = ['harvest', 'format', 'clean', 'images', 'generate', 'split', 'merge', 'export', 'quantize']
+SCRIPT = os.path.abspath(cli.__file__)
+
+
+@pytest.fixture(scope='module')
+def raw_file(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('raw') / 'raw.jsonl')
+    write_records(path, synthetic_raw_paintings(200))
+    return path
+
+
+def assert_light_startup(args, cwd):
+    seconds, modules = cli.import_profile(args, cwd=cwd)
+    heavy = sorted(name for name in modules if name.split('.')[0] in cli.HEAVY_MODULES)
+    slowest = ', '.join(f"{name} {us / 1000:.0f} ms" for name, us in
+                        sorted(modules.items(), key=lambda item: -item[1])[:3])
+    assert not heavy, f"{' '.join(args)} imported {heavy}"
+    assert seconds < IMPORT_BUDGET_S, f"{' '.join(args)} spent {seconds:.2f}s importing ({slowest})"
+
+
+@pytest.mark.parametrize('command', [None] + COMMANDS)
+def test_help_skips_heavy_imports(command, tmp_path):
+    assert_light_startup([SCRIPT, *([command] if command else []), '--help'], str(tmp_path))
+
+
+@pytest.mark.parametrize('command', ['format', 'clean'])
+def test_data_commands_skip_heavy_imports(command, raw_file, tmp_path):
+    formatted_file = str(tmp_path / 'formatted.jsonl')
+    assert_light_startup([SCRIPT, command, '--raw-file', raw_file, '--formatted-file', formatted_file,
+                          '--index-dir', str(tmp_path / 'index')], str(tmp_path))
+    assert os.path.getsize(formatted_file) > 0
+
+
+def test_export_model_imports_lazily(tmp_path):
+    assert_light_startup(['-c', 'import export_model'], str(tmp_path))
+
+
+def test_export_model_annotations_resolve():
+    # Lazily imported types (torch, QuantType) must not appear in annotations the module cannot resolve
+    import export_model
+
+    for function in (export_model.export_with_past, export_model.export_to_onnx, export_model.quantize_onnx):
+        typing.get_type_hints(function)
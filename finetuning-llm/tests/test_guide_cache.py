@@ -0,0 +1,50 @@
+from guide_cache import GuideCache
+
+PAINTING = {'title': 'Wheat Field  with Cypresses', 'artist': 'Vincent van Gogh', 'date': '1889'}
+
+
+def test_other_versions_survive_open(tmp_path):
+    path = str(tmp_path / 'guides.sqlite')
+    first = GuideCache(path, 'model-a')
+    first.put(PAINTING, 'guide a')
+    first.close()
+
+    for version in ('model-b', None):
+        cache = GuideCache(path, version)
+        assert len(cache) == 1 and cache.stats['invalidated'] == 0
+        assert cache.get(PAINTING) is None
+        cache.close()
+
+    again = GuideCache(path, 'model-a')
+    assert again.get({**PAINTING, 'title': 'Wheat Field with Cypresses'}) == 'guide a'
+    again.close()
+
+
+def test_prune_keeps_only_current_version(tmp_path):
+    path = str(tmp_path / 'guides.sqlite')
+    for version in ('model-a', 'model-b'):
+        cache = GuideCache(path, version)
+        cache.put(PAINTING, f"guide {version}")
+        cache.close()
+
+    pruned = GuideCache(path, 'model-b', prune=True)
+    assert len(pruned) == 1 and pruned.stats['invalidated'] == 1
+    assert pruned.get(PAINTING) == 'guide model-b'
+    pruned.close()
+
+
+def test_key_matches_prompt_for_missing_dimensions(tmp_path):
+    from onnx_generation import painting_prompt
+
+    painting = {**PAINTING, 'medium': 'Oil on canvas'}
+    variants = [painting, {**painting, 'dimensions': ''}, {**painting, 'dimensions': None},
+                {**painting, 'dimensions': 'Not specified'}, {**painting, 'dimensions': '28 7/8 x 36 3/4 in.'}]
+    cache = GuideCache(str(tmp_path / 'guides.sqlite'), 'model-a')
+    keys = [cache.key(variant) for variant in variants]
+    prompts = [painting_prompt(variant) for variant in variants]
+    cache.close()
+    # Two paintings share a cache entry exactly when they produce the same prompt
+    for i in range(len(variants)):
+        for j in range(len(variants)):
+            assert (keys[i] == keys[j]) == (prompts[i] == prompts[j])
+    assert len(set(prompts)) == 2
@@ -0,0 +1,29 @@
+import json
+
+import pytest
+
+from guide_server import parse_generate_request
+
+PAINTING = {'title': 'The Harvesters', 'artist': 'Pieter Bruegel the Elder', 'date': '1565', 'medium': 'Oil on wood'}
+
+
+def test_painting_fields_build_the_prompt():
+    body, prompt = parse_generate_request(json.dumps({**PAINTING, 'max_new_tokens': 40}).encode())
+    assert body['max_new_tokens'] == 40
+    assert prompt.startswith('Title: The Harvesters\nArtist: Pieter Bruegel the Elder')
+    assert 'Dimensions: Not specified' in prompt
+
+
+def test_raw_prompt():
+    assert parse_generate_request(b'{"prompt": "Title: x"}')[1] == 'Title: x'
+
+
+@pytest.mark.parametrize('data', [
+    b'[]', b'"text"', b'3', b'not json', b'{"title": "x"}', b'{"prompt": 5}',
+    json.dumps({**PAINTING, 'max_new_tokens': '40'}).encode(),
+    json.dumps({**PAINTING, 'max_new_tokens': 0}).encode(),
+    json.dumps({**PAINTING, 'max_new_tokens': True}).encode(),
+])
+def test_malformed_bodies_are_rejected(data):
+    with pytest.raises(ValueError):
+        parse_generate_request(data)
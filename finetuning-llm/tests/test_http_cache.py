@@ -0,0 +1,64 @@
+import json
+
+import pytest
+
+requests = pytest.importorskip('requests')
+
+from data_collection import fetch_objects_sequential, has_required_fields  # noqa: E402
+from harvest_checkpoint import HarvestCheckpoint  # noqa: E402
+from http_cache import ResponseCache, cached_get_json  # noqa: E402
+
+API = 'https://met.test/public/collection/v1'
+
+
+def make_response(status: int, body: dict, headers=None) -> 'requests.Response':
+    response = requests.Response()
+    response.status_code = status
+    response._content = json.dumps(body).encode()
+    response.headers.update(headers or {})
+    return response
+
+
+class StubSession:
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def get(self, url, **kwargs):
+        self.requests.append(url)
+        return self.responses[url]()
+
+
+@pytest.mark.parametrize('status', [404, 429, 500, 503])
+@pytest.mark.parametrize('cached', [False, True])
+def test_error_status_raises(tmp_path, status, cached):
+    url = f"{API}/objects/1"
+    session = StubSession({url: lambda: make_response(status, {'message': 'Internal Server Error'})})
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite')) if cached else None
+    with pytest.raises(requests.HTTPError):
+        cached_get_json(url, cache, session=session)
+    if cache:
+        assert len(cache) == 0
+        cache.close()
+
+
+def test_sequential_harvest_retries_error_bodies(tmp_path, monkeypatch):
+    painting = {'objectID': 2, 'title': 'Wheat Field with Cypresses', 'artistDisplayName': 'Vincent van Gogh',
+                'objectDate': '1889', 'medium': 'Oil on canvas', 'metadataDate': '2024-01-01'}
+    session = StubSession({f"{API}/objects/1": lambda: make_response(503, {'message': 'Service Unavailable'}),
+                           f"{API}/objects/2": lambda: make_response(200, painting),
+                           f"{API}/objects/3": lambda: make_response(404, {'message': 'Not a valid object'})})
+    monkeypatch.setattr(requests, 'get', session.get)
+    monkeypatch.setattr('data_collection.time.sleep', lambda seconds: None)
+
+    checkpoint = HarvestCheckpoint(str(tmp_path / 'harvest'))
+
+    def on_fetched(obj_id, raw_data, error):
+        if error is not None:
+            checkpoint.record_failure(obj_id, error)
+        else:
+            checkpoint.record(obj_id, raw_data, keep=has_required_fields(raw_data))
+
+    fetch_objects_sequential([1, 2, 3], api_base=API, on_fetched=on_fetched)
+    assert set(checkpoint.manifest['failed']) == {'1', '3'}
+    assert checkpoint.missing([1, 2, 3]) == [1, 3]
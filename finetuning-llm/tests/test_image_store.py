@@ -0,0 +1,89 @@
+import io
+import os
+
+import pytest
+
+from image_store import THUMBNAIL_SIZES, ImageStore, StubImageServer, prefetch_images
+
+Image = pytest.importorskip('PIL.Image')
+pytest.importorskip('aiohttp')
+
+COUNT = 40
+
+
+def jpeg(seed: int, size=(900, 700)) -> bytes:
+    out = io.BytesIO()
+    Image.new('RGB', size, ((seed * 37) % 256, (seed * 91) % 256, (seed * 53) % 256)).save(out, 'JPEG')
+    return out.getvalue()
+
+
+def thumbnail_size(store: ImageStore, met_id: int, size: str):
+    with Image.open(io.BytesIO(store.get(met_id, size))) as thumb:
+        assert thumb.format == 'JPEG'
+        return thumb.size
+
+
+def test_store_recovers_from_torn_writes(tmp_path):
+    store = ImageStore(str(tmp_path), pack_bytes=50)
+    for met_id in range(10):
+        store.add(met_id, f"u{met_id}", 'h', {'thumb': (b'T%d' % met_id * 5, 1, 1)}, 3, 3, '"e"')
+    store.add(4, 'u4', 'h2', {'thumb': (b'new', 1, 1)}, 3, 3)
+    store.add_failure(99, 'x', ValueError('boom'))
+    store.close()
+    with open(os.path.join(str(tmp_path), store._pack_names()[-1]), 'ab') as f:
+        f.write(b'partial thumbnail')
+    with open(os.path.join(str(tmp_path), 'index.jsonl'), 'a') as f:
+        f.write('{"met_id": 1')
+
+    reopened = ImageStore(str(tmp_path), pack_bytes=50)
+    assert len(reopened) == 10 and 99 in reopened.failed
+    assert reopened.get(4) == b'new' and reopened.get(7) == b'T7' * 5
+    reopened.compact()
+    assert len(reopened) == 10 and reopened.get(4) == b'new' and 99 in reopened.failed
+    reopened.close()
+
+
+def test_prefetch_resumes_refreshes_and_compacts(tmp_path):
+    images = {f"/images/{i}.jpg": jpeg(i) for i in range(COUNT)}
+    store_dir = str(tmp_path / 'images')
+    with StubImageServer(images, fail_first=3) as stub:
+        paintings = [{'met_id': 1000 + i, 'primary_image': f"{stub.url}/images/{i}.jpg"} for i in range(COUNT)]
+        paintings.append({'met_id': 5000, 'primary_image': f"{stub.url}/images/missing.jpg"})
+        paintings.append({'met_id': 5001, 'primary_image': ''})
+
+        # An interrupted run: only part of the collection, then a torn write at the tail
+        first = prefetch_images(paintings[:COUNT // 2], store_dir, concurrency=4, processes=2)
+        assert first['stored'] == COUNT // 2
+        with open(os.path.join(store_dir, 'pack-00000.bin'), 'ab') as f:
+            f.write(b'partial thumbnail')
+        with open(os.path.join(store_dir, 'index.jsonl'), 'a') as f:
+            f.write('{"met_id": 1')
+
+        resumed = prefetch_images(paintings, store_dir, concurrency=4, processes=2, max_retries=1)
+        assert resumed['skipped'] == COUNT // 2 and resumed['stored'] == COUNT - COUNT // 2
+        assert resumed['failed'] == 1
+        # Every image fetched once across both runs, plus the three injected 503s
+        assert sum(n for path, n in stub.requests.items() if path in images) == COUNT + 3
+
+        store = ImageStore(store_dir)
+        assert len(store) == COUNT and 5000 in store.failed
+        assert all(store.entries[p['met_id']]['etag'] for p in paintings[:COUNT])
+        for painting in paintings[:COUNT]:
+            for name, side in THUMBNAIL_SIZES.items():
+                assert max(thumbnail_size(store, painting['met_id'], name)) == side
+        store.close()
+
+        # Refresh: unchanged images come back as 304s, a changed one is re-resized
+        images['/images/3.jpg'] = jpeg(999, (500, 1000))
+        refreshed = prefetch_images(paintings[:COUNT], store_dir, refresh=True, concurrency=4, processes=2)
+        assert refreshed['stored'] == 1 and refreshed['unchanged'] == COUNT - 1
+        assert stub.not_modified == COUNT - 1
+
+    store = ImageStore(store_dir)
+    assert thumbnail_size(store, 1003, 'medium') == (300, 600)
+    size_before = sum(os.path.getsize(os.path.join(store_dir, name)) for name in store._pack_names())
+    store.compact()
+    size_after = sum(os.path.getsize(os.path.join(store_dir, name)) for name in store._pack_names())
+    assert size_after < size_before and len(store) == COUNT
+    assert thumbnail_size(store, 1003, 'thumb') == (100, 200)
+    store.close()
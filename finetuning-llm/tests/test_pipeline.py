@@ -0,0 +1,22 @@
+import os
+
+import data_collection
+from pipeline import default_stages, run_harvest
+
+
+def test_harvest_writes_under_raw_dir(tmp_path, monkeypatch):
+    calls = []
+
+    def fake_harvest(limit, **kwargs):
+        calls.append(kwargs)
+        return [{'objectID': i} for i in range(limit)]
+
+    monkeypatch.setattr(data_collection, 'get_met_paintings_raw', fake_harvest)
+    raw_dir = str(tmp_path / 'raw')
+    stage = next(stage for stage in default_stages(raw_dir, str(tmp_path / 'processed'), harvest_limit=3)
+                 if stage.name == 'harvest')
+
+    assert run_harvest(stage) == {'paintings': 3}
+    assert calls[0]['raw_file'] == stage.outputs['raw'] == os.path.join(raw_dir, 'met_paintings_complete_raw.json')
+    assert calls[0]['checkpoint_dir'] == os.path.join(raw_dir, 'harvest')
+    assert calls[0]['cache_file'] == os.path.join(raw_dir, 'http-cache.sqlite')
@@ -0,0 +1,44 @@
+import io
+from unittest import mock
+
+import pytest
+
+import shared_weights
+
+REAL_OPEN = open
+
+
+def with_topology(siblings, allowed):
+    """Patch sysfs thread_siblings_list and the affinity mask"""
+    def fake_open(path, *args, **kwargs):
+        if path.endswith('/topology/thread_siblings_list'):
+            return io.StringIO(siblings(int(path.split('/cpu')[-1].split('/')[0])) + '\n')
+        return REAL_OPEN(path, *args, **kwargs)
+    return mock.patch('builtins.open', fake_open), mock.patch('os.sched_getaffinity', return_value=set(allowed))
+
+
+@pytest.mark.parametrize('siblings', [
+    lambda cpu: f"{cpu // 2 * 2}-{cpu // 2 * 2 + 1}",  # siblings adjacent: 0/1, 2/3, ...
+    lambda cpu: f"{cpu % 4},{cpu % 4 + 4}",          # siblings offset by the core count: 0/4, 1/5, ...
+])
+def test_workers_never_share_a_physical_core(siblings):
+    patch_open, patch_affinity = with_topology(siblings, range(8))
+    with patch_open, patch_affinity:
+        cores = shared_weights.physical_core_cpus()
+        sets = shared_weights.core_sets(2)
+    assert len(cores) == 4 and all(len(core) == 2 for core in cores)
+    core_of = {cpu: i for i, core in enumerate(cores) for cpu in core}
+    used = [[core_of[cpu] for cpu in cpus] for cpus in sets]
+    assert [len(cpus) for cpus in sets] == [2, 2]
+    assert len({core for worker in used for core in worker}) == 4
+
+
+def test_affinity_mask_limits_cores():
+    patch_open, patch_affinity = with_topology(lambda cpu: f"{cpu // 2 * 2}-{cpu // 2 * 2 + 1}", [2, 3, 4, 6])
+    with patch_open, patch_affinity:
+        assert shared_weights.physical_core_cpus() == [[2, 3], [4], [6]]
+        assert shared_weights.core_sets(3) == [[2], [4], [6]]
+
+
+def test_parse_cpu_list():
+    assert shared_weights._parse_cpu_list('0-3,8,10-11\n') == [0, 1, 2, 3, 8, 10, 11]
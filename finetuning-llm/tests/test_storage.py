@@ -0,0 +1,76 @@
+import json
+
+import pytest
+
+from storage import _READ_CHUNK, iter_records, write_records
+
+RECORDS = [{'met_id': i, 'title': f"Painting {i} — “quoted”", 'tags': ['oil', {'n': i}], 'date': None}
+           for i in range(3000)]
+
+
+@pytest.mark.parametrize('ext', ['.json', '.jsonl', '.parquet'])
+def test_records_round_trip(tmp_path, ext):
+    path = str(tmp_path / f"records{ext}")
+    assert write_records(path, RECORDS, ensure_ascii=False) == len(RECORDS)
+    assert list(iter_records(path)) == RECORDS
+    assert list(iter_records(path, columns=['met_id'])) == [{'met_id': r['met_id']} for r in RECORDS]
+
+
+def test_json_array_matches_json_dump(tmp_path):
+    path = tmp_path / 'records.json'
+    write_records(str(path), RECORDS)
+    assert path.read_text(encoding='utf-8') == json.dumps(RECORDS, indent=2)
+
+
+@pytest.mark.parametrize('values', [
+    list(range(100_000)),
+    [i / 7 for i in range(20_000)],
+    [True, False, None, 12345678901234567890, -1.5e-300, 'x'] * 5000,
+])
+def test_json_array_of_scalars_round_trip(tmp_path, values):
+    # Bare scalars straddle chunk boundaries; none may be split into two values
+    path = tmp_path / 'values.json'
+    path.write_text(json.dumps(values), encoding='utf-8')
+    assert path.stat().st_size > 2 * _READ_CHUNK
+    assert list(iter_records(str(path))) == values
+
+
+def test_empty_array(tmp_path):
+    path = str(tmp_path / 'empty.json')
+    assert write_records(path, []) == 0
+    assert list(iter_records(path)) == []
+
+
+
+def test_parquet_list_column_after_first_row_group(tmp_path):
+    # Raw Met objects leave `tags` null for long runs; the first list arrives in a later row group
+    records = [{'met_id': i, 'tags': None} for i in range(1024)]
+    records.append({'met_id': 1024, 'tags': [{'term': 'Portraits'}]})
+    path = str(tmp_path / 'late.parquet')
+    assert write_records(path, records, batch_size=1024) == len(records)
+    assert list(iter_records(path)) == records
+
+
+def test_parquet_new_key_after_first_row_group(tmp_path):
+    records = [{'met_id': i} for i in range(1024)]
+    records += [{'met_id': 1024, 'constituents': [{'name': 'Rembrandt'}], 'isHighlight': True},
+                {'met_id': 1025, 'isHighlight': False}]
+    path = str(tmp_path / 'late.parquet')
+    assert write_records(path, records, batch_size=1024) == len(records)
+
+    keys = ('met_id', 'constituents', 'isHighlight')
+    assert list(iter_records(path)) == [{key: record.get(key) for key in keys} for record in records]
+    assert list(iter_records(path, columns=['isHighlight']))[-2:] == [{'isHighlight': True}, {'isHighlight': False}]
+
+
+def test_parquet_mixed_scalar_column(tmp_path):
+    records = [{'dimensions': 'oil on canvas'}, {'dimensions': 12}, {'dimensions': 1.5}, {'dimensions': None}]
+    path = str(tmp_path / 'mixed.parquet')
+    write_records(path, records)
+    assert list(iter_records(path)) == records
+
+
+def test_empty_parquet(tmp_path):
+    path = str(tmp_path / 'empty.parquet')
+    assert write_records(path, []) == 0
+    assert list(iter_records(path)) == []
@@ -0,0 +1,192 @@
+"""Tokenize the train/val splits once into flat memory-mapped token arrays.
+
+Each cache lives in `<cache_dir>/<split>-<key>/`, where the key hashes the
+tokenizer files, the data file and the tokenization parameters, so a change
+to any of them builds a fresh cache and an unchanged setup starts instantly:
+
+- `input_ids.bin`: every example's token ids back to back (uint16 when the
+  vocabulary fits, else uint32)
+- `offsets.bin`: int64, example i spans input_ids[offsets[i]:offsets[i + 1]]
+- `prompt_lengths.bin`: int32, tokens in the prompt alone (no special tokens)
+- `meta.json`: dtypes, counts and the parameters used
+
+Tokenization matches `tokenize_function` in finetune.ipynb: the full text
+(prompt + completion) with the BOS token, truncated to `max_length`, and
+the prompt without special tokens for the label mask. Padding is left to
+the collator.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from typing import Dict, Iterator, List
+
+import numpy as np
+
+from instrumentation import span
+from storage import iter_records
+
+TOKENIZER_FILES = ('tokenizer.json', 'tokenizer_config.json', 'special_tokens_map.json', 'tokenizer.model')
+CACHE_VERSION = 1
+IGNORE_INDEX = -100
+
+
+def file_sha256(path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def tokenizer_fingerprint(tokenizer_dir: str) -> str:
+    """Hash of the tokenizer files present in `tokenizer_dir`"""
+    digest = hashlib.sha256()
+    for name in TOKENIZER_FILES:
+        path = os.path.join(tokenizer_dir, name)
+        if os.path.exists(path):
+            digest.update(name.encode())
+            digest.update(file_sha256(path).encode())
+    return digest.hexdigest()
+
+
+def cache_key(data_file: str, tokenizer_dir: str, max_length: int) -> str:
+    params = json.dumps({'version': CACHE_VERSION, 'max_length': max_length})
+    digest = hashlib.sha256()
+    for part in (tokenizer_fingerprint(tokenizer_dir), file_sha256(data_file), params):
+        digest.update(part.encode())
+    return digest.hexdigest()[:16]
+
+
+def load_tokenizer(tokenizer_dir: str = 'onnx-model'):
+    """The fast tokenizer from `tokenizer_dir`/tokenizer.json (no transformers import needed)"""
+    from tokenizers import Tokenizer
+
+    return Tokenizer.from_file(os.path.join(tokenizer_dir, 'tokenizer.json'))
+
+
+def _batches(records: Iterator[Dict], size: int) -> Iterator[List[Dict]]:
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def build_token_cache(data_file: str,
+                      tokenizer_dir: str = 'onnx-model',
+                      cache_dir: str = 'processed-data/token-cache',
+                      max_length: int = 512,
+                      batch_size: int = 1024) -> str:
+    """Tokenize `data_file` into a memory-mappable cache; returns the cache directory.
+
+    An existing cache with the same key is reused as is.
+    """
+    split = os.path.splitext(os.path.basename(data_file))[0]
+    path = os.path.join(cache_dir, f"{split}-{cache_key(data_file, tokenizer_dir, max_length)}")
+    if os.path.exists(os.path.join(path, 'meta.json')):
+        return path
+
+    tokenizer = load_tokenizer(tokenizer_dir)
+    vocab_size = tokenizer.get_vocab_size(with_added_tokens=True)
+    dtype = np.uint16 if vocab_size <= np.iinfo(np.uint16).max + 1 else np.uint32
+
+    # Build in a scratch directory and rename, so a crash never leaves a partial cache
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    offsets = [0]
+    prompt_lengths = []
+    with span('tokenize', split=split) as s, open(os.path.join(tmp_path, 'input_ids.bin'), 'wb') as ids_file:
+        for batch in _batches(iter_records(data_file), batch_size):
+            texts = [example['prompt'] + example['completion'] for example in batch]
+            prompts = [example['prompt'] for example in batch]
+            full = tokenizer.encode_batch(texts, add_special_tokens=True)
+            prompt_only = tokenizer.encode_batch(prompts, add_special_tokens=False)
+            for encoding, prompt_encoding in zip(full, prompt_only):
+                ids = np.asarray(encoding.ids[:max_length], dtype=dtype)
+                ids.tofile(ids_file)
+                offsets.append(offsets[-1] + len(ids))
+                prompt_lengths.append(min(len(prompt_encoding.ids), max_length))
+            s.add(len(batch))
+
+    np.asarray(offsets, dtype=np.int64).tofile(os.path.join(tmp_path, 'offsets.bin'))
+    np.asarray(prompt_lengths, dtype=np.int32).tofile(os.path.join(tmp_path, 'prompt_lengths.bin'))
+    meta = {
+        'version': CACHE_VERSION,
+        'data_file': data_file,
+        'tokenizer_dir': tokenizer_dir,
+        'max_length': max_length,
+        'dtype': np.dtype(dtype).name,
+        'examples': len(prompt_lengths),
+        'tokens': offsets[-1],
+        'pad_token_id': tokenizer.token_to_id('</s>'),
+    }
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    print(f"Tokenized {meta['examples']} examples ({meta['tokens']:,} tokens) into {path}")
+    return path
+
+
+class TokenizedDataset:
+    """Zero-copy, map-style dataset over a token cache.
+
+    `input_ids` items are read-only views into the memory-mapped file; only
+    `labels` (the prompt-masked copy) allocates. Works anywhere a
+    `__len__`/`__getitem__` dataset is accepted (torch DataLoader, Trainer).
+    """
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.path = path
+        self.max_length = self.meta['max_length']
+        self.pad_token_id = self.meta['pad_token_id']
+        self.input_ids = np.memmap(os.path.join(path, 'input_ids.bin'), dtype=self.meta['dtype'], mode='r',
+                                   shape=(self.meta['tokens'],)) if self.meta['tokens'] else np.zeros(0, self.meta['dtype'])
+        self.offsets = np.memmap(os.path.join(path, 'offsets.bin'), dtype=np.int64, mode='r')
+        self.prompt_lengths = np.memmap(os.path.join(path, 'prompt_lengths.bin'), dtype=np.int32, mode='r') \
+            if self.meta['examples'] else np.zeros(0, np.int32)
+
+    def __len__(self) -> int:
+        return self.meta['examples']
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def tokens(self, i: int) -> np.ndarray:
+        return self.input_ids[self.offsets[i]:self.offsets[i + 1]]
+
+    def __getitem__(self, i: int) -> Dict:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        ids = self.tokens(i)
+        labels = ids.astype(np.int64)
+        labels[:self.prompt_lengths[i]] = IGNORE_INDEX
+        return {'input_ids': ids, 'labels': labels, 'prompt_length': int(self.prompt_lengths[i])}
+
+
+def load_token_cache(data_file: str,
+                     tokenizer_dir: str = 'onnx-model',
+                     cache_dir: str = 'processed-data/token-cache',
+                     max_length: int = 512) -> TokenizedDataset:
+    """Dataset view over the cache for `data_file`, tokenizing only on the first call"""
+    return TokenizedDataset(build_token_cache(data_file, tokenizer_dir, cache_dir, max_length))
+
+
+if __name__ == "__main__":
+    for split_file in ('processed-data/train_data.json', 'processed-data/val_data.json'):
+        dataset = load_token_cache(split_file)
+        lengths = dataset.lengths
+        print(f"{split_file}: {len(dataset)} examples, mean {lengths.mean():.0f} / max {lengths.max()} tokens")
@@ -1,6 +1,41 @@
 import fs from 'fs-extra';
 import path from 'path';
 import { Painting, PaintingsResponse, GetPaintingsArgs } from '../../../shared/types';
+import { IndexedPainting, SearchIndex } from './searchIndex';
+
+// Prebuilt by the Python formatting stage (finetuning-llm/search_index.py)
+const SEARCH_INDEX_DIR =
+  process.env.SEARCH_INDEX_DIR || path.join(__dirname, '../../../finetuning-llm/processed-data/search-index');
+let searchIndex: SearchIndex | null | undefined;
+
+function loadSearchIndex(): SearchIndex | null {
+  if (searchIndex === undefined) {
+    searchIndex = SearchIndex.exists(SEARCH_INDEX_DIR) ? new SearchIndex(SEARCH_INDEX_DIR) : null;
+    if (searchIndex) {
+      console.log(`Loaded search index of ${searchIndex.count} paintings from ${SEARCH_INDEX_DIR}`);
+    }
+  }
+  return searchIndex;
+}
+
+function toPainting(record: IndexedPainting): Painting {
+  const year = record.date?.match(/\d{3,4}/);
+  return {
+    id: String(record.met_id),
+    title: record.title,
+    artist: record.artist,
+    year: year ? Number(year[0]) : undefined,
+    medium: record.medium || undefined,
+    dimensions: record.dimensions || undefined,
+    department: record.department || undefined,
+    culture: record.culture || undefined,
+    period: record.period || undefined,
+    imageUrl: record.primary_image || '',
+    thumbnailUrl: record.primary_image_small || undefined,
+    objectUrl: record.object_url || undefined,
+    metId: record.met_id,
+  };
+}
 
 // Need to be replced accordingly
 let paintingsCache: Painting[] | null = null;
@@ -50,6 +85,16 @@ function generateMockPaintings(): Painting[] {
 
 export async function getPaintings(args: GetPaintingsArgs): Promise<PaintingsResponse> {
   const { limit = 10, offset = 0, search } = args;
+  const index = loadSearchIndex();
+  if (index) {
+    const page = index.search(search, offset, limit);
+    return {
+      paintings: page.paintings.map(toPainting),
+      total: page.total,
+      hasMore: offset + limit < page.total,
+    };
+  }
+
   const allPaintings = await loadPaintingsData();
   
   let filteredPaintings = allPaintings;
@@ -73,6 +118,12 @@ export async function getPaintings(args: GetPaintingsArgs): Promise<PaintingsRes
 }
 
 export async function getPaintingById(id: string): Promise<Painting | null> {
+  const index = loadSearchIndex();
+  if (index) {
+    const record = /^\d+$/.test(id) ? index.get(Number(id)) : null;
+    return record ? toPainting(record) : null;
+  }
+
   const allPaintings = await loadPaintingsData();
   return allPaintings.find(painting => painting.id === id) || null;
 }
\ No newline at end of file
@@ -0,0 +1,242 @@
+import fs from 'fs-extra';
+import path from 'path';
+import zlib from 'zlib';
+
+// Reader for the index built by finetuning-llm/search_index.py (see its module docstring for the layout)
+
+const INDEX_VERSION = 1;
+
+export interface IndexedPainting {
+  met_id: number;
+  title: string;
+  artist: string;
+  date?: string;
+  medium?: string;
+  dimensions?: string;
+  department?: string;
+  culture?: string;
+  period?: string;
+  primary_image?: string;
+  primary_image_small?: string;
+  object_url?: string;
+}
+
+export interface IndexPage {
+  paintings: IndexedPainting[];
+  total: number;
+}
+
+// Must match search_index.normalize
+export function normalize(text: string | null | undefined): string {
+  if (!text) {
+    return '';
+  }
+  return text
+    .normalize('NFKD')
+    .replace(/\p{M}/gu, '')
+    .toLowerCase()
+    .split(/\s+/)
+    .filter(Boolean)
+    .join(' ');
+}
+
+function trigrams(text: string): Set<string> {
+  const chars = Array.from(text);
+  const grams = new Set<string>();
+  for (let i = 0; i + 3 <= chars.length; i++) {
+    grams.add(chars.slice(i, i + 3).join(''));
+  }
+  return grams;
+}
+
+function readUint32(file: string): Uint32Array {
+  const buffer = fs.readFileSync(file);
+  const values = new Uint32Array(buffer.length / 4);
+  for (let i = 0; i < values.length; i++) {
+    values[i] = buffer.readUInt32LE(i * 4);
+  }
+  return values;
+}
+
+function readUint64(file: string): number[] {
+  const buffer = fs.readFileSync(file);
+  const values: number[] = new Array(buffer.length / 8);
+  for (let i = 0; i < values.length; i++) {
+    values[i] = Number(buffer.readBigUInt64LE(i * 8));
+  }
+  return values;
+}
+
+function lowerBound(values: Uint32Array, target: number): number {
+  let low = 0;
+  let high = values.length;
+  while (low < high) {
+    const mid = (low + high) >>> 1;
+    if (values[mid] < target) {
+      low = mid + 1;
+    } else {
+      high = mid;
+    }
+  }
+  return low;
+}
+
+export class SearchIndex {
+  readonly count: number;
+  private readonly fields: string[];
+  private readonly offsets: number[];
+  private readonly ids: Uint32Array;
+  private readonly idDocs: Uint32Array;
+  private readonly terms: string[];
+  private readonly postingOffsets: number[];
+  private readonly postings: Buffer;
+  private readonly recordsFd: number;
+  private texts: string[][] | null = null;
+
+  constructor(private readonly indexDir: string) {
+    const manifest = fs.readJsonSync(path.join(indexDir, 'manifest.json'));
+    if (manifest.version !== INDEX_VERSION) {
+      throw new Error(`${indexDir} is index version ${manifest.version}, expected ${INDEX_VERSION}`);
+    }
+    this.count = manifest.count;
+    this.fields = manifest.fields;
+    this.offsets = readUint64(path.join(indexDir, 'offsets.bin'));
+    this.ids = readUint32(path.join(indexDir, 'ids.bin'));
+    this.idDocs = readUint32(path.join(indexDir, 'id_docs.bin'));
+    this.terms = fs.readFileSync(path.join(indexDir, 'terms.txt'), 'utf8').split('\n');
+    this.postingOffsets = readUint64(path.join(indexDir, 'postings_offsets.bin'));
+    this.postings = fs.readFileSync(path.join(indexDir, 'postings.bin'));
+    this.recordsFd = fs.openSync(path.join(indexDir, 'records.jsonl'), 'r');
+  }
+
+  static exists(indexDir: string): boolean {
+    return fs.pathExistsSync(path.join(indexDir, 'manifest.json'));
+  }
+
+  record(doc: number): IndexedPainting {
+    const start = this.offsets[doc];
+    const buffer = Buffer.alloc(this.offsets[doc + 1] - start);
+    fs.readSync(this.recordsFd, buffer, 0, buffer.length, start);
+    return JSON.parse(buffer.toString('utf8'));
+  }
+
+  get(metId: number): IndexedPainting | null {
+    const i = lowerBound(this.ids, metId);
+    return i < this.ids.length && this.ids[i] === metId ? this.record(this.idDocs[i]) : null;
+  }
+
+  private posting(term: string): number[] {
+    // Terms are sorted by code point in Python; compare the same way here
+    let low = 0;
+    let high = this.terms.length;
+    while (low < high) {
+      const mid = (low + high) >>> 1;
+      if (compareCodePoints(this.terms[mid], term) < 0) {
+        low = mid + 1;
+      } else {
+        high = mid;
+      }
+    }
+    if (low === this.terms.length || this.terms[low] !== term) {
+      return [];
+    }
+    const blob = this.postings.subarray(this.postingOffsets[low], this.postingOffsets[low + 1]);
+    const raw = blob[0] === 1 ? zlib.inflateRawSync(blob.subarray(1)) : blob.subarray(1);
+    const docs: number[] = new Array(raw.length / 4);
+    let doc = 0;
+    for (let i = 0; i < docs.length; i++) {
+      doc += raw.readUInt32LE(i * 4);
+      docs[i] = doc;
+    }
+    return docs;
+  }
+
+  private loadTexts(): string[][] {
+    if (!this.texts) {
+      this.texts = fs
+        .readFileSync(path.join(this.indexDir, 'text.txt'), 'utf8')
+        .split('\n')
+        .slice(0, this.count)
+        .map(line => line.split('\t'));
+    }
+    return this.texts;
+  }
+
+  private intersect(terms: string[]): Set<number> {
+    const postings = terms.map(term => this.posting(term)).sort((a, b) => a.length - b.length);
+    let matches = new Set(postings[0]);
+    for (const docs of postings.slice(1)) {
+      if (matches.size === 0) {
+        break;
+      }
+      const next = new Set<number>();
+      for (const doc of docs) {
+        if (matches.has(doc)) {
+          next.add(doc);
+        }
+      }
+      matches = next;
+    }
+    return matches;
+  }
+
+  // Records whose normalised `fields` contain the normalised query, in record order
+  matchSubstring(query: string, fields: string[]): number[] {
+    const positions = fields.map(field => this.fields.indexOf(field));
+    if (positions.includes(-1)) {
+      throw new Error(`Fields ${fields} are not all indexed; indexed fields are ${this.fields}`);
+    }
+    if (Array.from(query).length < 3) {
+      const texts = this.loadTexts();
+      const docs: number[] = [];
+      texts.forEach((row, doc) => {
+        if (positions.some(p => row[p].includes(query))) {
+          docs.push(doc);
+        }
+      });
+      return docs;
+    }
+    const grams = Array.from(trigrams(query));
+    let candidates = new Set<number>();
+    for (const field of fields) {
+      for (const doc of this.intersect(grams.map(gram => `${field}:${gram}`))) {
+        candidates.add(doc);
+      }
+    }
+    if (Array.from(query).length > 3) {
+      const texts = this.loadTexts();
+      candidates = new Set([...candidates].filter(doc => positions.some(p => texts[doc][p].includes(query))));
+    }
+    return [...candidates].sort((a, b) => a - b);
+  }
+
+  search(query: string | undefined, offset: number, limit: number, fields: string[] = ['title', 'artist']): IndexPage {
+    const normalized = normalize(query);
+    let docs: number[];
+    let total: number;
+    if (!normalized) {
+      total = this.count;
+      docs = [];
+      for (let doc = offset; doc < Math.min(offset + limit, total); doc++) {
+        docs.push(doc);
+      }
+    } else {
+      const matches = this.matchSubstring(normalized, fields);
+      total = matches.length;
+      docs = matches.slice(offset, offset + limit);
+    }
+    return { paintings: docs.map(doc => this.record(doc)), total };
+  }
+}
+
+function compareCodePoints(a: string, b: string): number {
+  const left = Array.from(a);
+  const right = Array.from(b);
+  for (let i = 0; i < Math.min(left.length, right.length); i++) {
+    const diff = left[i].codePointAt(0)! - right[i].codePointAt(0)!;
+    if (diff !== 0) {
+      return diff;
+    }
+  }
+  return left.length - right.length;
+}